@@ -1,47 +1,360 @@
-import numpy as np
-
-
-def get_exponentially_weighted_mean(l, decay=0.5, depth=100):
-    if len(l) == 0:
-        return np.nan
-    depth = min([len(l), depth])
-    weights = [1]
-    for _ in range(1, depth):
-        weights.append(weights[-1]*decay)
-    weights = np.array(weights[::-1])
-    l_end = np.array(l[-depth:])
-    try:
-        E = np.average(l_end[~np.isnan(l_end)], weights=weights[~np.isnan(l_end)])
-    except ZeroDivisionError:
-        return np.nan
-    return E
-
-class DelayDiscountAgent:
-    def __init__(self, decay, depth=400, reset_on_block=False,
-                 ):
-        self.decay = decay
-        self.depth = depth
-        self.reset_on_block = reset_on_block
-        self.prev_p = []
-        self.prev_r = []
-        self.prev_subject_response_bool = []
-        self.prev_block = -1
-
-    def process_row(self, row):
-        if row.block_number != self.prev_block and self.reset_on_block:
-            self.prev_p = []
-            self.prev_r = []
-            self.prev_subject_response_bool = []
-            self.prev_block = row.block_number
-
-        E_p = get_exponentially_weighted_mean(self.prev_p, self.decay,
-                                              self.depth)
-        E_r = get_exponentially_weighted_mean(self.prev_r, self.decay,
-                                              self.depth)
-
-        if row.role == 'p':
-            self.prev_p.append(row.subjectTake)
-        elif row.role == 'r':
-            self.prev_r.append(row.proposerTake)
-            self.prev_subject_response_bool.append(row.subject_response_bool)
-        return E_p, E_r#, E_resp
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+
+def get_exponentially_weighted_mean(l, decay=0.5, depth=100):
+    if len(l) == 0:
+        return np.nan
+    depth = min([len(l), depth])
+    weights = [1]
+    for _ in range(1, depth):
+        weights.append(weights[-1]*decay)
+    weights = np.array(weights[::-1])
+    l_end = np.array(l[-depth:])
+    try:
+        E = np.average(l_end[~np.isnan(l_end)], weights=weights[~np.isnan(l_end)])
+    except ZeroDivisionError:
+        return np.nan
+    return E
+
+def get_window_start(groups, depth=100):
+    '''
+    For every position t, returns the index of the first position in the
+        look-back window of get_grouped_ewm(...), i.e., the window spans
+        [start, t] and never crosses into a previous group. groups must label
+        contiguous runs (e.g., blocks in the order they appear).
+    '''
+    groups = np.asarray(groups)
+    n = len(groups)
+    idx = np.arange(n)
+    is_start = np.ones(n, dtype=bool)
+    is_start[1:] = groups[1:] != groups[:-1]
+    group_start = np.maximum.accumulate(np.where(is_start, idx, 0))
+    if depth is None:
+        return group_start
+    return np.maximum(idx - depth + 1, group_start)
+
+
+def windowed_decay_sum(x, window_start, decay=0.5):
+    '''
+    Returns sum(decay**(t-k) * x[k] for k in [window_start[t], t]) for every t.
+        The recursion s[t] = decay * s[t-1] + x[t] is run once over the whole
+        array (O(n), independent of the window length) and the part of s that
+        precedes each window is subtracted back out.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    if len(x) == 0:
+        return x
+    if decay == 1:
+        s = np.cumsum(x)
+    else:
+        s = lfilter([1.], [1., -decay], x)
+    idx = np.arange(len(x))
+    anchor = window_start - 1
+    s_anchor = np.where(anchor >= 0, s[np.maximum(anchor, 0)], 0.)
+    return s - decay ** (idx - anchor) * s_anchor
+
+
+def get_grouped_ewm(values, groups, decay=0.5, depth=100):
+    '''
+    Vectorized get_exponentially_weighted_mean(...). For every position t,
+        returns the weighted mean of values up to and including t, restricted
+        to t's group and to the last depth positions. Like the list-based
+        version, NaNs are skipped but still take up a slot of the depth, and
+        windows with no valid values yield NaN.
+    '''
+    x = np.asarray(values, dtype=np.float64)
+    window_start = get_window_start(groups, depth)
+    valid = ~np.isnan(x)
+    num = windowed_decay_sum(np.where(valid, x, 0.), window_start, decay)
+    den = windowed_decay_sum(valid, window_start, decay)
+
+    # The number of valid values is counted exactly so that windows holding
+    #   only NaNs give NaN rather than a ratio of two rounding errors
+    n_valid = np.cumsum(valid)
+    n_valid = n_valid - np.where(window_start > 0,
+                                 n_valid[np.maximum(window_start - 1, 0)], 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        E = num / den
+    E[(n_valid == 0) | (den == 0)] = np.nan
+    return E
+
+
+def get_E_before(values, is_role, segments, decay=0.5, depth=100):
+    '''
+    For every row, the expectation based on the previous rows of one role
+        (is_role) within the same segment. This is what DelayDiscountAgent
+        computes before appending the current row to its history.
+    '''
+    return get_E_before_multi_decay(values, is_role, segments, [decay],
+                                    depth)[:, 0]
+
+
+def get_E_before_multi_decay(values, is_role, segments, decays, depth=100):
+    '''
+    get_E_before(...) for several decays at once. The role/segment
+        bookkeeping is shared and only the decay filter is rerun per decay.
+        Returns a (rows x decays) array.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    segments = np.asarray(segments)
+    is_role = np.asarray(is_role, dtype=bool)
+    role_idx = np.flatnonzero(is_role)
+    role_segments = segments[role_idx]
+    role_values = values[role_idx]
+
+    last = np.cumsum(is_role) - is_role - 1  # most recent role row before t
+    has_prev = last >= 0
+    has_prev[has_prev] = role_segments[last[has_prev]] == segments[has_prev]
+    last = last[has_prev]
+
+    E = np.full((len(values), len(decays)), np.nan)
+    for i, decay in enumerate(decays):
+        E_role = get_grouped_ewm(role_values, role_segments, decay, depth)
+        E[has_prev, i] = E_role[last]
+    return E
+
+
+def get_segments(df, reset_on_block=False, by=None):
+    '''
+    Labels the runs of rows that share a history. DelayDiscountAgent resets
+        whenever block_number differs from that of the previous row, so
+        segments are runs of consecutive rows with the same block_number
+        (or the whole dataframe if reset_on_block is False). If by is given
+        (e.g., 'id'), a new segment also starts whenever that column
+        changes, so that each participant has a history of their own.
+    '''
+    cols = ['block_number'] if reset_on_block else []
+    if by is not None:
+        cols.append(by)
+    new_segment = np.zeros(len(df), dtype=bool)
+    for col in cols:
+        values = df[col].to_numpy()
+        new_segment[1:] |= values[1:] != values[:-1]
+    return np.cumsum(new_segment)
+
+
+def get_E_p_E_r(df, decay, depth=400, reset_on_block=False, by=None):
+    '''
+    Vectorized equivalent of applying DelayDiscountAgent.process_row(...) to
+        every row of df. Returns the E_p and E_r columns as arrays. by is
+        passed to get_segments(...).
+    '''
+    segments = get_segments(df, reset_on_block=reset_on_block, by=by)
+    role = df['role'].to_numpy()
+    E_p = get_E_before(df['subjectTake'], role == 'p', segments, decay, depth)
+    E_r = get_E_before(df['proposerTake'], role == 'r', segments, decay, depth)
+    return E_p, E_r
+
+
+def get_E_p_E_r_multi_decay(df, decays, depth=400, reset_on_block=False):
+    '''
+    get_E_p_E_r(...) for a vector of decays in one pass over df. Returns the
+        E_p and E_r columns as two (rows x decays) arrays, where column i
+        corresponds to decays[i].
+    '''
+    segments = get_segments(df, reset_on_block=reset_on_block)
+    role = df['role'].to_numpy()
+    E_p = get_E_before_multi_decay(df['subjectTake'], role == 'p', segments,
+                                   decays, depth)
+    E_r = get_E_before_multi_decay(df['proposerTake'], role == 'r', segments,
+                                   decays, depth)
+    return E_p, E_r
+
+
+def get_E_p_E_r_chunked(chunks, decay, depth=400, reset_on_block=False,
+                        by=None):
+    '''
+    get_E_p_E_r(...) over a dataframe that arrives in chunks (e.g., from
+        data_store.iter_csv_chunks(...)). Yields (chunk, E_p, E_r) per chunk.
+        The history that the next chunk's expectations can still draw on
+        (the last depth rows of each role in the last segment) is carried
+        over and prepended to it, so the results match get_E_p_E_r(...) on
+        the whole dataframe (up to floating point error), including the
+        history running on from one participant to the next when by is None.
+    '''
+    cols = ['role', 'subjectTake', 'proposerTake', 'block_number']
+    if by is not None:
+        cols.append(by)
+    carry = None
+    for chunk in chunks:
+        df = chunk[cols].reset_index(drop=True)
+        n_carry = 0
+        if carry is not None:
+            n_carry = len(carry)
+            df = pd.concat([carry, df], ignore_index=True)
+        E_p, E_r = get_E_p_E_r(df, decay, depth, reset_on_block, by)
+        carry = get_history_tail(df, depth, reset_on_block, by)
+        yield chunk, E_p[n_carry:], E_r[n_carry:]
+
+
+def get_history_tail(df, depth=400, reset_on_block=False, by=None):
+    '''
+    The rows of df that can still enter the expectations of rows appended
+        after it. The last row is always kept, as the next segment is
+        detected by comparing to it.
+    '''
+    segments = get_segments(df, reset_on_block=reset_on_block, by=by)
+    in_last = segments == segments[-1]
+    role = df['role'].to_numpy()
+    keep = np.zeros(len(df), dtype=bool)
+    keep[-1] = True
+    for r in ['p', 'r']:
+        rows = np.flatnonzero(in_last & (role == r))
+        keep[rows if depth is None else rows[-depth:]] = True
+    return df[keep]
+
+
+class DelayDiscountAgent:
+    def __init__(self, decay, depth=400, reset_on_block=False,
+                 ):
+        self.decay = decay
+        self.depth = depth
+        self.reset_on_block = reset_on_block
+        self.prev_p = []
+        self.prev_r = []
+        self.prev_subject_response_bool = []
+        self.prev_block = -1
+
+    def process_row(self, row):
+        if row.block_number != self.prev_block and self.reset_on_block:
+            self.prev_p = []
+            self.prev_r = []
+            self.prev_subject_response_bool = []
+            self.prev_block = row.block_number
+
+        E_p = get_exponentially_weighted_mean(self.prev_p, self.decay,
+                                              self.depth)
+        E_r = get_exponentially_weighted_mean(self.prev_r, self.decay,
+                                              self.depth)
+
+        if row.role == 'p':
+            self.prev_p.append(row.subjectTake)
+        elif row.role == 'r':
+            self.prev_r.append(row.proposerTake)
+            self.prev_subject_response_bool.append(row.subject_response_bool)
+        return E_p, E_r#, E_resp
+
+
+class RoleHistory:
+    '''
+    Running state of get_exponentially_weighted_mean(...) over one role's
+        history: the decayed sum of the values, the decayed sum of their
+        weights and the number of valid (non-NaN) values in the window.
+        Appending a value takes constant time. With depth=None the state is
+        just those three numbers. Otherwise, the last depth values are also
+        kept in a ring buffer so that the value leaving the window can be
+        subtracted back out.
+    '''
+    def __init__(self, decay=0.5, depth=400):
+        self.decay = decay
+        self.depth = depth
+        self.decay_depth = decay ** depth if depth is not None else 0.
+        self.buffer = deque(maxlen=depth) if depth is not None else None
+        self.reset()
+
+    def reset(self):
+        self.num = 0.
+        self.den = 0.
+        self.n_valid = 0
+        if self.buffer is not None:
+            self.buffer.clear()
+
+    def append(self, x):
+        valid = x == x  # False for NaN
+        self.num = self.decay * self.num + (x if valid else 0.)
+        self.den = self.decay * self.den + valid
+        self.n_valid += valid
+        if self.buffer is None:
+            return
+        if len(self.buffer) == self.depth:
+            old = self.buffer[0]  # popped by the append below
+            if old == old:
+                self.num -= self.decay_depth * old
+                self.den -= self.decay_depth
+                self.n_valid -= 1
+        self.buffer.append(x)
+
+    def get_E(self):
+        if self.n_valid == 0 or self.den <= 0:
+            return np.nan
+        return self.num / self.den
+
+
+class StreamingExpectations:
+    '''
+    Computes E_p and E_r online, as trials arrive one at a time (e.g., during
+        a session), with constant work per trial regardless of how long the
+        history is or of depth. A separate history is kept per participant
+        (events are told apart by their key field, 'id' by default). Events
+        are dicts or objects (e.g., namedtuples or DataFrame rows) with the
+        fields that DelayDiscountAgent.process_row(...) reads: role,
+        subjectTake, proposerTake and block_number.
+    Like DelayDiscountAgent, the expectations returned for a trial are those
+        held before the trial, so E_p and E_r match get_E_p_E_r(...) run on
+        each participant's rows separately (up to floating point error).
+    '''
+    def __init__(self, decay, depth=400, reset_on_block=False, key='id'):
+        self.decay = decay
+        self.depth = depth
+        self.reset_on_block = reset_on_block
+        self.key = key
+        self.participants = {}
+
+    def get_state(self, participant):
+        if participant not in self.participants:
+            self.participants[participant] = {
+                'p': RoleHistory(self.decay, self.depth),
+                'r': RoleHistory(self.decay, self.depth),
+                'prev_block': -1}
+        return self.participants[participant]
+
+    def update(self, event):
+        state = self.get_state(get_field(event, self.key, None))
+        block_number = get_field(event, 'block_number', None)
+        if block_number != state['prev_block'] and self.reset_on_block:
+            state['p'].reset()
+            state['r'].reset()
+            state['prev_block'] = block_number
+
+        E_p = state['p'].get_E()
+        E_r = state['r'].get_E()
+
+        role = get_field(event, 'role')
+        if role == 'p':
+            state['p'].append(float(get_field(event, 'subjectTake')))
+        elif role == 'r':
+            state['r'].append(float(get_field(event, 'proposerTake')))
+        return E_p, E_r
+
+    def process(self, events):
+        '''
+        Yields (event, E_p, E_r) for each event of an iterable or generator
+        '''
+        for event in events:
+            E_p, E_r = self.update(event)
+            yield event, E_p, E_r
+
+    async def process_queue(self, queue, stop=None):
+        '''
+        Yields (event, E_p, E_r) for each event put on an asyncio.Queue until
+            the stop sentinel is received
+        '''
+        while True:
+            event = await queue.get()
+            try:
+                if event is stop:
+                    return
+                E_p, E_r = self.update(event)
+            finally:
+                queue.task_done()
+            yield event, E_p, E_r
+
+
+def get_field(event, name, default=np.nan):
+    if isinstance(event, dict):
+        return event.get(name, default)
+    return getattr(event, name, default)
@@ -1,49 +1,318 @@
-import pandas as pd
-from Agent import DelayDiscountAgent
-
-
-
-def get_df_with_E_p_E_r(df, reset_on_block=True, delay_discount=1):
-    '''
-    Adds E_p and E_r columns to df. This works by essentially "simulating"
-        an Agent, which processes each row of the dataframe one by one.
-    Can handle exponential weighing of previous trials by temporal distance,
-        which was used for the Supplemental Materials. That analysis involved
-        not resetting each block the pool of trials contributing to expectations
-    '''
-    print('---------------------------')
-    print(f'\t{delay_discount=:.3f}')
-    print(f'\t{reset_on_block=}')
-    DDA = DelayDiscountAgent(delay_discount, reset_on_block=reset_on_block)
-    df[['E_p', 'E_r']] = df.apply(lambda row: DDA.process_row(row), axis=1,
-                                  result_type="expand")
-    return df
-
-def proc_data(study, reset_on_block=True, delay_discount=1, save=False,
-              do_exclusion=True):
-    '''
-    Loads data .csv and adds expectation (E[proposed] & E[received]) columns.
-    If save == true, then this function saves a new .csv, otherwise it returns
-        the processed Pandas dataframe.
-    '''
-    fp_in = fr'UG_data\RoleChange_Study{study}_anonymized.csv'
-    df = pd.read_csv(fp_in)
-
-    df = get_df_with_E_p_E_r(df, reset_on_block=reset_on_block,
-                             delay_discount=delay_discount)
-
-    if do_exclusion: df = df[~df['excluded'].astype(bool)]   # remove excluded participants
-    df['received'] = 10 - df['proposerTake'] # proposerTake represents amount computer proposed to subject
-                                             # this is converted to the amount received by the subject
-                                             # e.g., for a recived $3:$7 offer: proposeTake = 7, M2 = 3
-    if save:
-        fp_out = fr'UG_data\processed_RoleChange_Study{study}.csv'
-        df.to_csv(fp_out, index=False)
-    else:
-        return df
-
-
-
-if __name__ == '__main__':
-    for STUDY in [4]:
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from Agent import DelayDiscountAgent, get_E_before, get_E_p_E_r, \
+    get_E_p_E_r_chunked, get_E_p_E_r_multi_decay, get_segments
+from data_store import iter_csv_chunks, read_csv, write_csv_chunks
+from profiling import profiled
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+
+@profiled()
+def get_df_with_E_p_E_r(df, reset_on_block=True, delay_discount=1,
+                        vectorized=True, per_participant=False, n_workers=1,
+                        depth=400):
+    '''
+    Adds E_p and E_r columns to df. This works by essentially "simulating"
+        an Agent, which processes each row of the dataframe one by one.
+    Can handle exponential weighing of previous trials by temporal distance,
+        which was used for the Supplemental Materials. That analysis involved
+        not resetting each block the pool of trials contributing to expectations
+    If vectorized is True, the same columns are computed in one pass with
+        Agent.get_E_p_E_r(...) instead of replaying the agent row by row (see
+        check_vectorized_E(...) for the comparison between the two).
+    A single agent processes the whole dataframe, so, with reset_on_block
+        False, a participant's first expectations are based on the previous
+        participant's trials. This is how the published results were
+        computed and remains the default. per_participant=True instead gives
+        each participant a history of their own (see get_E_p_E_r_sharded).
+    depth is the number of past trials of each role that the expectations
+        weigh (400, i.e., all of them in these studies, by default).
+    '''
+    print('---------------------------')
+    print(f'\t{delay_discount=:.3f}')
+    print(f'\t{reset_on_block=}')
+    if per_participant:
+        df['E_p'], df['E_r'] = get_E_p_E_r_sharded(
+            df, delay_discount, depth=depth, reset_on_block=reset_on_block,
+            n_workers=n_workers)
+        return df
+    if vectorized:
+        df['E_p'], df['E_r'] = get_E_p_E_r(df, delay_discount, depth=depth,
+                                           reset_on_block=reset_on_block)
+        return df
+    DDA = DelayDiscountAgent(delay_discount, depth=depth,
+                             reset_on_block=reset_on_block)
+    df[['E_p', 'E_r']] = df.apply(lambda row: DDA.process_row(row), axis=1,
+                                  result_type="expand")
+    return df
+
+
+def get_E_p_E_r_sharded(df, decay, depth=400, reset_on_block=False,
+                        n_workers=1, shards_per_worker=4):
+    '''
+    Computes E_p and E_r with an independent history per participant. The
+        participants (id) are split into shards, which are processed by
+        n_workers processes (in this process if n_workers is 1). Returns the
+        columns as arrays in df's original row order.
+    '''
+    ids = df['id'].to_numpy()
+    unique_ids = pd.unique(ids)
+    n_shards = 1 if n_workers == 1 else \
+        min(len(unique_ids), (n_workers or os.cpu_count()) * shards_per_worker)
+    shard_of_id = dict(zip(unique_ids, np.arange(len(unique_ids)) * n_shards //
+                           max(len(unique_ids), 1)))
+    shard = np.array([shard_of_id[i] for i in ids], dtype=np.int64)
+    order = np.lexsort((pd.factorize(ids)[0], shard))  # stable: keeps trial order
+    bounds = np.searchsorted(shard[order], np.arange(n_shards + 1))
+    cols = ['id', 'role', 'subjectTake', 'proposerTake', 'block_number']
+    df_sorted = df[cols].iloc[order]
+    shards = [df_sorted.iloc[start:end] for start, end in zip(bounds[:-1],
+                                                              bounds[1:])]
+    args = ([decay] * n_shards, [depth] * n_shards, [reset_on_block] * n_shards)
+    if n_workers == 1:
+        results = map(_get_shard_E, shards, *args)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(_get_shard_E, shards, *args))
+
+    E_p = np.empty(len(df))
+    E_r = np.empty(len(df))
+    for (start, end), (E_p_shard, E_r_shard) in zip(zip(bounds[:-1], bounds[1:]),
+                                                    results):
+        E_p[order[start:end]] = E_p_shard
+        E_r[order[start:end]] = E_r_shard
+    return E_p, E_r
+
+
+def _get_shard_E(df_shard, decay, depth, reset_on_block):
+    # Each participant is computed on its own (rather than as a segment of
+    #   the shard) so that the rounding, and thus the output, does not depend
+    #   on how the participants were sharded
+    segments = get_segments(df_shard, reset_on_block=reset_on_block, by='id')
+    role = df_shard['role'].to_numpy()
+    is_p, is_r = role == 'p', role == 'r'
+    subjectTake = df_shard['subjectTake'].to_numpy(dtype=np.float64)
+    proposerTake = df_shard['proposerTake'].to_numpy(dtype=np.float64)
+    ids = df_shard['id'].to_numpy()
+    bounds = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1], True])
+
+    E_p = np.empty(len(df_shard))
+    E_r = np.empty(len(df_shard))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        rows = slice(start, end)
+        E_p[rows] = get_E_before(subjectTake[rows], is_p[rows],
+                                 segments[rows], decay, depth)
+        E_r[rows] = get_E_before(proposerTake[rows], is_r[rows],
+                                 segments[rows], decay, depth)
+    return E_p, E_r
+
+
+LAG_COLS = ['subjectTake', 'response_bool', 'proposerTake', 'subject_response',
+            'subject_response_bool']
+
+
+def add_lag_features(df, cols=LAG_COLS, k=2, by=('id', 'block_number')):
+    '''
+    Adds lags 1..k of cols, named like the prev_/prev_prev_ columns of the
+        raw data (lag 3 is prev_prev_prev_<col>, etc.). Lags are taken within
+        the groups of by, in row order. By default that is per participant
+        and block, which is how the raw data's prev_ columns were made (see
+        check_lag_features(...)). Adding 'role' to by lags to the previous
+        trial of the same role instead. The numeric columns are shifted
+        together, as one (columns x rows) block laid out as pandas stores
+        it, with the rows sorted by group. Usually (e.g., per id and block)
+        the rows already are, and the shifts are just slices. Returns df with
+        the lag columns (existing ones are overwritten in place).
+    '''
+    n = len(df)
+    codes = df.groupby(list(by), sort=False).ngroup().to_numpy() if by \
+        else np.zeros(n, dtype=np.int64)
+    order = np.argsort(codes, kind='stable')  # rows of a group together
+    in_order = bool(np.all(order == np.arange(n)))
+    codes_sorted = codes[order]
+    numeric = [col for col in cols if df[col].dtype.kind in 'biuf']
+    other = [col for col in cols if col not in numeric]
+    values = df[numeric].to_numpy(dtype=np.float64).T
+    if not in_order:
+        values = np.take(values, order, axis=1)
+    block = np.full((k * len(numeric), n), np.nan)
+    names = []
+    other_lags = {}
+    for lag in range(1, k + 1):
+        same = codes_sorted[lag:] == codes_sorted[:-lag]
+        rows = slice((lag - 1) * len(numeric), lag * len(numeric))
+        block[rows, lag:] = np.where(same, values[:, :-lag], np.nan)
+        prefix = 'prev_' * lag
+        names += [f'{prefix}{col}' for col in numeric]
+        if other:
+            source = np.full(n, -1, dtype=np.int64)
+            source[order[lag:][same]] = order[:-lag][same]
+            for col in other:
+                other_lags[f'{prefix}{col}'] = df[col].array.take(
+                    source, allow_fill=True)
+    if not in_order:  # back to df's row order
+        unsort = np.empty(n, dtype=np.int64)
+        unsort[order] = np.arange(n)
+        block = np.take(block, unsort, axis=1)
+    df_lags = pd.DataFrame(block.T, columns=names, index=df.index, copy=False)
+    for col, values in other_lags.items():
+        df_lags[col] = values
+    existing = [col for col in df_lags.columns if col in df.columns]
+    if existing:
+        df[existing] = df_lags[existing]
+    new = [col for col in df_lags.columns if col not in df.columns]
+    return pd.concat([df, df_lags[new]], axis=1)
+
+
+def check_lag_features(study, groupings=(('id',), ('id', 'block_number'),
+                                         ('id', 'block_number', 'role'))):
+    '''
+    Compares the prev_/prev_prev_ columns of the raw data to those of
+        add_lag_features(...) for several groupings. Prints the share of rows
+        that match per grouping and column.
+    '''
+    df_raw = load_raw_data(study)
+    out = {}
+    for by in groupings:
+        df = add_lag_features(df_raw[LAG_COLS + ['id', 'block_number',
+                                                 'role']].copy(), by=by)
+        for prefix in ['prev_', 'prev_prev_']:
+            for col in LAG_COLS:
+                a = df[f'{prefix}{col}'].to_numpy()
+                b = df_raw[f'{prefix}{col}'].to_numpy(dtype=np.float64)
+                same = (a == b) | (np.isnan(a) & np.isnan(b))
+                out[(by, f'{prefix}{col}')] = same.mean()
+    df_out = pd.Series(out).unstack(0)
+    print(f'Study {study}: share of rows matching the raw data')
+    print(df_out.to_string())
+    return df_out
+
+
+def check_vectorized_E(study, delays=(.01, .25, .5, .75, .99, 1)):
+    '''
+    Verifies that the vectorized expectations match those of the
+        row-by-row DelayDiscountAgent for a handful of decays, both with and
+        without resetting on each block.
+    '''
+    df = load_raw_data(study)
+    for reset_on_block in [True, False]:
+        for delay in delays:
+            df_agent = get_df_with_E_p_E_r(df.copy(), reset_on_block, delay,
+                                           vectorized=False)
+            df_vec = get_df_with_E_p_E_r(df.copy(), reset_on_block, delay,
+                                         vectorized=True)
+            for col in ['E_p', 'E_r']:
+                assert np.allclose(df_agent[col], df_vec[col], rtol=1e-9,
+                                   atol=1e-12, equal_nan=True), \
+                    f'{col} mismatch: {study=}, {delay=}, {reset_on_block=}'
+    print(f'Study {study}: vectorized E_p/E_r match DelayDiscountAgent')
+
+@profiled()
+def load_raw_data(study, data_dir=None):
+    '''
+    data_dir can point to another folder with the raw data, e.g., the
+        synthetic data of synthetic_data.py
+    '''
+    fp_in = os.path.join(data_dir or os.path.join(DIR, 'UG_data'),
+                         f'RoleChange_Study{study}_anonymized.csv')
+    return read_csv(fp_in)
+
+
+def finish_processing(df, do_exclusion=True):
+    '''
+    Steps applied after the expectation columns have been added.
+    '''
+    if do_exclusion: df = df[~df['excluded'].astype(bool)]   # remove excluded participants
+    df['received'] = 10 - df['proposerTake'] # proposerTake represents amount computer proposed to subject
+                                             # this is converted to the amount received by the subject
+                                             # e.g., for a recived $3:$7 offer: proposeTake = 7, M2 = 3
+    return df
+
+
+@profiled()
+def proc_data(study, reset_on_block=True, delay_discount=1, save=False,
+              do_exclusion=True, per_participant=False, n_workers=1,
+              data_dir=None, depth=400):
+    '''
+    Loads data .csv and adds expectation (E[proposed] & E[received]) columns.
+    If save == true, then this function saves a new .csv, otherwise it returns
+        the processed Pandas dataframe. With data_dir, the raw data is read
+        from (and the processed data saved to) data_dir.
+    '''
+    df = load_raw_data(study, data_dir)
+
+    df = get_df_with_E_p_E_r(df, reset_on_block=reset_on_block,
+                             delay_discount=delay_discount,
+                             per_participant=per_participant,
+                             n_workers=n_workers, depth=depth)
+
+    df = finish_processing(df, do_exclusion=do_exclusion)
+    if save:
+        fp_out = os.path.join(data_dir or os.path.join(DIR, 'UG_data'),
+                              f'processed_RoleChange_Study{study}.csv')
+        df.to_csv(fp_out, index=False)
+    else:
+        return df
+
+
+@profiled()
+def proc_data_chunked(study, fp_out=None, chunk_size=100_000,
+                      reset_on_block=True, delay_discount=1,
+                      do_exclusion=True, per_participant=False, data_dir=None,
+                      depth=400):
+    '''
+    Out-of-core proc_data(..., save=True) for datasets too large to load at
+        once. The raw .csv is read in chunks of about chunk_size rows that
+        don't split participants, and each chunk is written to fp_out as soon
+        as it is processed, so memory depends on chunk_size rather than on
+        the size of the dataset. The expectation history is carried from one
+        chunk to the next (see Agent.get_E_p_E_r_chunked), so the output
+        matches proc_data(...) with the same depth up to floating point
+        error. depth=None uses the whole history, which is then carried in
+        full from chunk to chunk. fp_out defaults to
+        processed_RoleChange_Study{study}.csv next to the raw data. Returns
+        the number of rows written.
+    '''
+    data_dir = data_dir or os.path.join(DIR, 'UG_data')
+    fp_in = os.path.join(data_dir, f'RoleChange_Study{study}_anonymized.csv')
+    if fp_out is None:
+        fp_out = os.path.join(data_dir, f'processed_RoleChange_Study{study}.csv')
+    chunks = iter_csv_chunks(fp_in, 'id', chunksize=chunk_size)
+    chunks_E = get_E_p_E_r_chunked(chunks, delay_discount, depth=depth,
+                                   reset_on_block=reset_on_block,
+                                   by='id' if per_participant else None)
+
+    def processed():
+        for df, E_p, E_r in chunks_E:
+            df['E_p'] = E_p
+            df['E_r'] = E_r
+            yield finish_processing(df, do_exclusion=do_exclusion)
+
+    return write_csv_chunks(processed(), fp_out)
+
+
+def proc_data_multi_decay(study, delay_discounts, reset_on_block=True,
+                          do_exclusion=True, depth=400):
+    '''
+    Like proc_data(...), but loads the data once and computes the
+        expectations for every delay_discount in one pass. Returns the
+        processed dataframe (without E_p/E_r) along with E_p and E_r as
+        (rows x delay_discounts) arrays aligned with its rows.
+    '''
+    df = load_raw_data(study)
+    E_p, E_r = get_E_p_E_r_multi_decay(df, delay_discounts, depth=depth,
+                                       reset_on_block=reset_on_block)
+    df = finish_processing(df, do_exclusion=do_exclusion)
+    kept = df.index.to_numpy()  # the raw data has a default RangeIndex
+    return df, E_p[kept], E_r[kept]
+
+
+
+if __name__ == '__main__':
+    for STUDY in [4]:
         proc_data(STUDY, save=True, do_exclusion=False)
\ No newline at end of file
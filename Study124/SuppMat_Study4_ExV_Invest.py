@@ -1,19 +1,64 @@
+import os
+import time
+
 import pandas as pd
 import numpy as np
 from collections import defaultdict
 from tqdm import tqdm
 from SuppMat_delay_discount import rescale
+from fit_cache import fit_lmer
+from data_store import read_csv
 
 # Finalized: 9/27/2022
 
-def load_Study3_processed():
-    fp_in = r'UG_data\processed_RoleChange_Study3.csv'
-    df = pd.read_csv(fp_in)
+BLOCK_COLS = ['invest', 'proposerTake', 'subjectTake', 'ExV_r', 'ExV_r_abs',
+              'ExV_p', 'ExV_p_abs', 'E_p', 'E_r']
+
+
+def load_Study4_processed():
+    fp_in = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'UG_data',
+                         'processed_RoleChange_Study4.csv')
+    df = read_csv(fp_in)
     return df
 
 
 def prepare_data():
-    df = load_Study3_processed()
+    df = load_Study4_processed()
+    return get_block_means(df)
+
+
+def get_block_means(df):
+    '''
+    One row per participant block: the block's condition, the mean of each of
+        BLOCK_COLS, and the condition and mean proposerTake of the
+        participant's previous block.
+    '''
+    df = df.assign(ExV_r=df['proposerTake'] - df['E_r'],
+                   ExV_p=df['proposerTake'] - df['E_p'])
+    df['ExV_r_abs'] = df['ExV_r'].abs()
+    df['ExV_p_abs'] = df['ExV_p'].abs()
+
+    df_out = df.groupby(['id', 'block_number']).agg(
+        condition=('condition', 'first'), **{col: (col, 'mean') for col in BLOCK_COLS})
+    df_out = df_out.reset_index(level='block_number', drop=True)
+    df_out.insert(1, 'sn', df_out.index.astype(int))
+    df_out = df_out.reset_index(drop=True)
+    df_out['condition'] = df_out['condition'].astype(str)
+
+    prev = df_out.groupby('sn')[['condition', 'proposerTake']].shift(1)
+    df_out['prev_condition'] = prev['condition']
+    df_out['prev_proposerTake'] = prev['proposerTake'] # used for regress_invest_on_prev_partner(...)
+    df_out['proposerTake'] = -df_out['proposerTake'] # proposerTake originally
+    # represented the amount the computer proposer took. This is inverted to
+    # represented the amount the participant received, which may be more intuitive
+    return df_out
+
+
+def get_block_means_by_block(df):
+    '''
+    The original, block-by-block version of get_block_means(...). It is kept
+        for check_vectorized_prepare_data().
+    '''
     prev_sn = None
     prev_d = defaultdict(lambda: np.nan)
     df_as_l = []
@@ -29,8 +74,7 @@ def prepare_data():
             prev_d = defaultdict(lambda: np.nan)
             prev_sn = sn
 
-        cols_kept = ['invest', 'proposerTake', 'subjectTake', 'ExV_r', 'ExV_r_abs', 'ExV_p', 'ExV_p_abs',
-                     'E_p', 'E_r']
+        cols_kept = BLOCK_COLS
         d = {'condition': df_sn_b['condition'].iloc[0][:], 'sn': int(sn)}
 
         for col in cols_kept:
@@ -49,6 +93,23 @@ def prepare_data():
     return df_out
 
 
+def check_vectorized_prepare_data():
+    '''
+    Times get_block_means(...) against the block-by-block version on the
+        Study 4 data and checks that their outputs match
+    '''
+    df = load_Study4_processed()
+    outs = {}
+    for name, func in [('vectorized', get_block_means),
+                       ('by block', get_block_means_by_block)]:
+        t0 = time.perf_counter()
+        outs[name] = func(df.copy())
+        print(f'{name}: {time.perf_counter() - t0:.3f} s')
+    pd.testing.assert_frame_equal(outs['vectorized'], outs['by block'],
+                                  check_dtype=False, rtol=1e-12)
+    print('Outputs match')
+
+
 def regress_invest_on_prev_partner(only_3_computers=True):
     # This function was used for a response to reviewer comments but these results
     #   were not included in the final manuscript.
@@ -82,9 +143,7 @@ def regress_invest_on_prev_partner(only_3_computers=True):
     print(summary)
 
 
-def regress_invest_on_ExV(only_3_computers=False):
-    from pymer4.models import Lmer # pymer4 import is rather slow. it's placed here
-                                   # in case the present file is used as a module
+def regress_invest_on_ExV(only_3_computers=False, backend=None):
     df = prepare_data()
     df.dropna(subset=['proposerTake', 'invest', 'subjectTake'], inplace=True)
 
@@ -108,9 +167,8 @@ def regress_invest_on_ExV(only_3_computers=False):
                            'proposerTake + ExV_p_abs + ExV_r_abs + condition + ' \
                            '(1 | sn)'
 
-    mod = Lmer(formula, data=df)
-    summary = mod.fit(REML=False)
-    print(summary)
+    result = fit_lmer(formula, df, REML=False, backend=backend)
+    print(result['coefs'])
 
 if __name__ == '__main__':
     regress_invest_on_ExV(only_3_computers=True)
@@ -1,22 +1,35 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
-from Main_process_data_expectations import proc_data
+from Main_process_data_expectations import proc_data_multi_decay
+from fit_cache import fit_lmer
+from model_backends import get_backend
+from profiling import profiled
 
 '''
-Although not explicitly imported, running the delay discount analyses requires
-    rpy2, as it uses pymer4. pymer4 is imported in do_lmer(...) because it is
-    slow to load. I believe using rpy2 and pymer4 requires you to have R 
-    installed with the lme4 and lmerTest packages. If you do not have this set
+Although not explicitly imported, running the delay discount analyses with the
+    default backend requires rpy2, as it uses pymer4. The models are fit by
+    fit_cache.fit_lmer(...) with the backend given by
+    model_backends.get_backend(...) (the backend argument or LMER_BACKEND).
+    pymer4 is slow to load, so it is only imported by the pymer4 backend's
+    first fit or once per worker of the sweep pool (see open_sweep_pool(...)).
+    The numpy backend needs neither R nor rpy2. I believe using rpy2 and
+    pymer4 requires you to have R installed with the lme4 and lmerTest
+    packages. If you do not have this set
     up, I think the easiest way to set this up (or at least to install rpy2)
     is via Anaconda. pip sometimes mishandles complex packages like this.
     (tensorflow and CUDA is another example of software that pip struggles with)  
 '''
 
 def delay_discount_analysis(study=1, reset_on_block=False,
-                            both_E=True):
+                            both_E=True, n_workers=None, backend=None,
+                            warm_start=False, depth=400):
     '''
     This code runes the lmer for every level of exponential temporal decay.
         Although not reported in the paper (for brevity), preliminary analyses
@@ -26,6 +39,10 @@ def delay_discount_analysis(study=1, reset_on_block=False,
         and model fit led to two local maxima, suggesting both shorter
         and longer term expectations. None of the analyses on model fit were
         reported in the main text or Supplemental Materials.
+    The fits are run in parallel by run_delay_sweep(...) (n_workers=None uses
+        every core) and plotted once they are all in. See run_delay_sweep(...)
+        for warm_start. sweep_store.py runs the same fits over a grid of
+        settings (including depth), keeping every fit in a database.
     '''
 
     pd.options.mode.chained_assignment = None
@@ -34,13 +51,19 @@ def delay_discount_analysis(study=1, reset_on_block=False,
     #   concerned about because, here, the df and the df copy aren't used after
     #   the warning arises.
 
+    delays = np.linspace(.01, .99, 99)
+    jobs = [(study, delay, both_E, reset_on_block, depth) for delay in delays]
+    results = run_delay_sweep(jobs, n_workers=n_workers, backend=backend,
+                              warm_start=warm_start)
+
     fits = []
-    for delay in tqdm(np.linspace(.01, .99, 99), desc='delay_loop'):
-        df = proc_data(study, reset_on_block, do_exclusion=True,
-                       delay_discount=delay, save=False)
-        fit, coefs = do_lmer(df, both_E=both_E)
-        plot_delay_stats(delay, fit, coefs)
-        fits.append(fit)
+    for delay, result in zip(delays, results):
+        plot_delay_stats(delay, result['logLike'], result['coefs'])
+        fits.append(result['logLike'])
+    finish_delay_plot(fits, f'Study {study} | {both_E=} | {reset_on_block=}')
+
+
+def finish_delay_plot(fits, title):
     min_fit = min(fits)
     max_fit = max(fits)
     if max_fit - min_fit < 14:
@@ -48,13 +71,250 @@ def delay_discount_analysis(study=1, reset_on_block=False,
     else:
         plt.yticks(range(int(min_fit), int(max_fit) + 5, 5))
 
-    plt.title(f'Study {study} | {both_E=} | {reset_on_block=}')
+    plt.title(title)
     plt.ylabel('Model fit (log-likelihood)')
     plt.xlabel('Delay (λ)')
     plt.show()
 
 
-def do_lmer(df, both_E=True):
+def run_delay_sweep(jobs, n_workers=None, backend=None, warm_start=False):
+    '''
+    Runs do_lmer(...) for every (study, delay, both_E, reset_on_block, depth)
+        job in a pool of n_workers processes and returns the fit results
+        (dicts, see fit_cache.fit_lmer(...), plus the runtime of each fit)
+        in the same order as jobs.
+    If warm_start, the jobs are instead split into n_workers contiguous
+        stretches of the delay path. Each worker fits its stretch in order,
+        starting each fit from the previous fit's estimates (see
+        _fit_delay_path(...)). The iterations per fit are reported as n_iter.
+        Fits read from the fit cache (cached=True) did no iterations now, so
+        they are left out of the iteration count.
+    '''
+    n_workers = n_workers or os.cpu_count()
+    if warm_start:
+        paths = split_delay_path(jobs, n_workers)
+    else:
+        paths = [[job] for job in jobs]
+    with open_sweep_pool(prepare_sweep_data(jobs), n_workers,
+                         backend) as executor:
+        results = [result for path_results in
+                   tqdm(executor.map(_fit_delay_path, paths),
+                        total=len(paths), desc='delay_loop')
+                   for result in path_results]
+    if warm_start:
+        fitted = [result for result in results if not result.get('cached')]
+        n_iter = [result['n_iter'] for result in fitted]
+        if None not in n_iter:
+            print(f'Warm-started sweep: {sum(n_iter)} optimizer iterations, '
+                  f'{sum(not result["warm_started"] for result in fitted)} '
+                  f'cold starts, {len(results) - len(fitted)} cached fits')
+    return results
+
+
+def split_delay_path(jobs, n_paths):
+    '''
+    Splits jobs into contiguous paths that each cover a single model
+        (study, both_E, reset_on_block, depth), with up to n_paths paths per
+        model.
+    '''
+    runs = []
+    for job in jobs:
+        if runs and get_model_key(runs[-1][-1]) == get_model_key(job):
+            runs[-1].append(job)
+        else:
+            runs.append([job])
+    paths = []
+    for run in runs:
+        for idxs in np.array_split(np.arange(len(run)), min(n_paths, len(run))):
+            paths.append([run[i] for i in idxs])
+    return paths
+
+
+def get_model_key(job):
+    study, delay, both_E, reset_on_block, depth = job
+    return study, both_E, reset_on_block, depth
+
+
+def get_data_key(job):
+    study, delay, both_E, reset_on_block, depth = job
+    return study, reset_on_block, depth
+
+
+def prepare_sweep_data(jobs):
+    '''
+    The expectations for all delays of a (study, reset_on_block, depth) are
+        computed up front in one pass, so that they can be handed to each
+        worker once, when it starts.
+    '''
+    sweep_data = {}
+    for key in dict.fromkeys(map(get_data_key, jobs)):
+        study, reset_on_block, depth = key
+        delays = sorted({job[1] for job in jobs if get_data_key(job) == key})
+        df, E_p, E_r = proc_data_multi_decay(study, delays, reset_on_block,
+                                             do_exclusion=True, depth=depth)
+        delay_to_col = {delay: i for i, delay in enumerate(delays)}
+        sweep_data[key] = (df, delay_to_col, E_p, E_r)
+    return sweep_data
+
+
+def open_sweep_pool(sweep_data, n_workers=None, backend=None):
+    '''
+    Each worker receives sweep_data and imports pymer4 (if that is the
+        backend) when it starts, so neither the data nor the import are
+        repeated per fit.
+    '''
+    return ProcessPoolExecutor(max_workers=n_workers,
+                               initializer=_init_sweep_worker,
+                               initargs=(sweep_data, backend))
+
+
+_sweep_data = {}  # filled in each worker by _init_sweep_worker(...)
+_sweep_backend = None
+
+
+def _init_sweep_worker(sweep_data, backend):
+    global _sweep_data, _sweep_backend
+    _sweep_data = sweep_data
+    _sweep_backend = get_backend(backend)
+    pd.options.mode.chained_assignment = None
+    if _sweep_backend.name == 'pymer4':
+        import pymer4.models  # imported once per worker, see model_backends.py
+
+
+def _fit_delay_job(job, start=None, use_cache=True):
+    study, delay, both_E, reset_on_block, depth = job
+    df, delay_to_col, E_p, E_r = _sweep_data[get_data_key(job)]
+    i = delay_to_col[delay]
+    df_delay = df.assign(E_p=E_p[:, i], E_r=E_r[:, i])
+    t0 = time.perf_counter()
+    result = fit_delay_model(df_delay, both_E=both_E, backend=_sweep_backend,
+                             start=start, use_cache=use_cache)
+    result['runtime'] = time.perf_counter() - t0
+    return result
+
+
+def _fit_delay_path(jobs):
+    '''
+    Fits jobs in order, starting each from the previous fit's fixed effects
+        and variance components (if the backend supports it). A warm-started
+        fit that fails to converge is redone from a cold start, bypassing the
+        fit cache so that the fit is really redone.
+    '''
+    results = []
+    start = None
+    for job in jobs:
+        result = _fit_delay_job(job, start=start)
+        result['warm_started'] = start is not None
+        if start is not None and not result['converged']:
+            result = _fit_delay_job(job, use_cache=False)
+            result['warm_started'] = False
+        results.append(result)
+        if getattr(_sweep_backend, 'supports_start', False):
+            start = result
+    return results
+
+
+def adaptive_delay_search(study=1, reset_on_block=False, both_E=True,
+                          delays=np.linspace(.01, .99, 99), coarse_step=10,
+                          tol=1, n_workers=None, backend=None, depth=400):
+    '''
+    Finds the log-likelihood peak(s) over delays without fitting every delay.
+        The search starts with every coarse_step-th delay (plus the last one).
+        Then, around each local maximum, it fits the delays halfway to the
+        nearest fitted neighbours on either side. This repeats until every
+        local maximum is within tol grid points of its fitted neighbours.
+        With tol=1 (the default), the peaks are exact on the delays grid,
+        provided the fit is unimodal within the coarse brackets.
+    Returns a dict with the best delay and its fit, every local peak, the
+        number of fits run and the trace of delays in the order they were
+        evaluated.
+    '''
+    pd.options.mode.chained_assignment = None
+    delays = np.asarray(delays)
+    jobs = [(study, delay, both_E, reset_on_block, depth) for delay in delays]
+    fits = {}
+    coefs = {}
+    trace = []
+
+    with open_sweep_pool(prepare_sweep_data(jobs), n_workers,
+                         backend) as executor:
+        to_fit = sorted(set(range(0, len(delays), coarse_step)) |
+                        {len(delays) - 1})
+        while to_fit:
+            results = executor.map(_fit_delay_job, [jobs[i] for i in to_fit])
+            for i, result in zip(to_fit, results):
+                fits[i] = result['logLike']
+                coefs[i] = result['coefs']
+                trace.append(float(delays[i]))
+
+            fitted = sorted(fits)
+            peaks = get_local_maxima(fitted, fits)
+            to_fit = set()
+            for peak in peaks:
+                k = fitted.index(peak)
+                for neighbour in fitted[k - 1:k] + fitted[k + 1:k + 2]:
+                    if abs(neighbour - peak) > tol:
+                        to_fit.add((neighbour + peak) // 2)
+            to_fit = sorted(to_fit - set(fits))
+
+    best = max(fits, key=fits.get)
+    out = {'delay': float(delays[best]), 'fit': fits[best],
+           'coefs': coefs[best],
+           'peaks': [(float(delays[i]), fits[i]) for i in peaks],
+           'n_fits': len(fits), 'trace': trace}
+    print(f'Best delay: {out["delay"]:.3f} (log-likelihood = {out["fit"]:.3f})')
+    print(f'\tLocal peaks: {[(round(d, 3), round(f, 3)) for d, f in out["peaks"]]}')
+    print(f'\t{out["n_fits"]} fits instead of {len(delays)}')
+    return out
+
+
+def get_local_maxima(idxs, fits):
+    '''
+    idxs are the sorted grid indices that have been fit
+    '''
+    peaks = []
+    for k, i in enumerate(idxs):
+        left = fits[idxs[k - 1]] if k > 0 else -np.inf
+        right = fits[idxs[k + 1]] if k < len(idxs) - 1 else -np.inf
+        if fits[i] >= left and fits[i] >= right:
+            peaks.append(i)
+    return peaks
+
+
+@profiled()
+def do_lmer(df, both_E=True, backend=None):
+    result = fit_delay_model(df, both_E=both_E, backend=backend)
+    fit = result['logLike']
+    coefs = result['coefs']
+    return fit, coefs
+
+
+# The optimx optimizer helps with achieving convergence.
+#   Its use requires the optimx R package to be installed.
+LMER_CONTROL = "optimizer='optimx', optCtrl = list(method='nlminb', kkt=FALSE)"
+
+
+def fit_delay_model(df, both_E=True, backend=None, start=None,
+                    use_cache=True):
+    '''
+    The fit behind do_lmer(...), returning the whole result dict. start can
+        be an earlier result to start the optimizer from.
+    '''
+    df, formula = get_lmer_data(df, both_E=both_E)
+
+    print('Lmering...')
+    result = fit_lmer(formula, df, family='binomial', REML=False,
+                      control=LMER_CONTROL, backend=backend, start=start,
+                      use_cache=use_cache)
+
+    print(result['coefs'])
+    return result
+
+
+def get_lmer_data(df, both_E=True):
+    '''
+    Prepares df for do_lmer(...) and returns it with the formula
+    '''
     df.dropna(subset=['proposerTake', 'E_p', 'E_r', 'subject_response_bool',
                       'prev_response_bool'], inplace=True)
     df = df[df['proposerTake'] > 5]
@@ -75,20 +335,7 @@ def do_lmer(df, both_E=True):
 
     formula = fr'subject_response_bool ~ 1 + {fx} + ' \
               fr'(1 + {fx} | id)'
-
-    print('Lmering...')
-    from pymer4.models import Lmer  # this package is slow to load, so it's
-                                    # imported within this function.
-    mod = Lmer(formula, data=df, family='binomial')
-    summary = mod.fit(REML=False, control="optimizer='optimx', "
-                                          "optCtrl = list(method='nlminb', kkt=FALSE)")
-    # The optimx optimizer helps with achieving convergence.
-    #   Its use requires the optimx R package to be installed.
-
-    print(summary)
-    fit = mod.logLike
-    coefs = mod.coefs
-    return fit, coefs
+    return df, formula
 
 def rescale(col):
     return (col - col.mean()) / col.std()
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pandas as pd
+
+from data_store import read_csv
+from model_backends import compare_backends
+from SuppMat_delay_discount import get_lmer_data
+
+'''
+Compares the speed and agreement of the model backends (model_backends.py) on
+    the shipped processed data: the do_lmer(...) model for Studies 2 and 4
+    and the base/ExV punishment models of herrmann_lmer.py.
+'''
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_benchmark_cases():
+    cases = []
+    for study in [2, 4]:
+        fp = os.path.join(DIR, 'UG_data', f'processed_RoleChange_Study{study}.csv')
+        df = read_csv(fp)
+        df = df[~df['excluded'].astype(bool)]
+        df, formula = get_lmer_data(df.copy(), both_E=True)
+        cases.append((f'Study {study} do_lmer', formula, df, 'binomial', False))
+
+    sys.path.append(os.path.dirname(DIR))
+    from Study3.herrmann_lmer import load_and_basic_preprocess
+    df = load_and_basic_preprocess()
+    for fixed_ef in ['1 + r + E_punished',
+                     '1 + r + E_punished + ExV_p_abs + ExV_r_sans_trial_abs']:
+        formula = f'punish ~ {fixed_ef} + ({fixed_ef} | sn)'
+        cases.append((f'Herrmann {fixed_ef}', formula, df, 'gaussian', False))
+    return cases
+
+
+def benchmark_backends(backends=('pymer4', 'numpy')):
+    pd.options.mode.chained_assignment = None
+    out = []
+    for name, formula, df, family, REML in get_benchmark_cases():
+        print(f'Benchmarking: {name}')
+        df_cmp = compare_backends(formula, df, family=family, REML=REML,
+                                  backends=backends)
+        df_cmp.insert(0, 'model', name)
+        out.append(df_cmp)
+    df_out = pd.concat(out, ignore_index=True)
+    print(df_out.to_string())
+    return df_out
+
+
+if __name__ == '__main__':
+    benchmark_backends()
@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(DIR))  # for Study3
+
+from Agent import get_exponentially_weighted_mean
+from data_store import read_csv
+from fit_cache import fit_lmer
+from Main_process_data_expectations import add_lag_features, \
+    get_df_with_E_p_E_r, load_raw_data
+from SuppMat_delay_discount import get_lmer_data, LMER_CONTROL
+from SuppMat_Study4_ExV_Invest import get_block_means, \
+    get_block_means_by_block, load_Study4_processed
+
+'''
+Benchmarks the expectation and modeling hot paths:
+    - get_exponentially_weighted_mean(...) at several depths and NaN densities
+    - E_p/E_r on Studies 2 and 4: the DelayDiscountAgent replay and the
+        vectorized version
+    - the Herrmann expectations: RowProcessor and the vectorized version
+    - SuppMat_Study4_ExV_Invest's block means (prepare_data(...))
+    - the prev_ lag columns (add_lag_features(...)) for several lag depths
+    - one do_lmer(...) fit (without the fit cache)
+The vectorized paths are also run on the shipped data scaled 10x and 100x
+    (the participants are copied under new ids). The slow row-by-row paths
+    are only run on the shipped data.
+Each case is timed repeat times (after an untimed setup) and the fastest run
+    is kept. python benchmark_suite.py --save-baseline records the results
+    in benchmark_baseline.json. Later runs are compared to that file, and any
+    case that got slower by more than threshold (e.g., 0.2 = 20%) is flagged
+    as a regression, which also sets a nonzero exit code. Baselines are
+    machine specific, so they should be recorded on the machine that runs
+    the comparison.
+'''
+
+BASELINE_FP = os.path.join(DIR, 'benchmark_baseline.json')
+SCALES = [1, 10, 100]
+
+
+def scale_dataset(df, factor, id_cols=('id',)):
+    '''
+    Returns df with its participants copied factor times, each copy under new
+        ids (for every column in id_cols), in the same order
+    '''
+    if factor == 1:
+        return df
+    copies = []
+    for k in range(factor):
+        df_k = df.copy()
+        for col in id_cols:
+            values = df[col].astype(np.int64)
+            df_k[col] = values + k * (int(values.max()) + 1)
+        copies.append(df_k)
+    return pd.concat(copies, ignore_index=True)
+
+
+def get_cases():
+    '''
+    Returns {name: case}, where a case is a dict with a setup function
+        (untimed, returns the arguments), the function to time, the number of
+        calls per timing and whether the case is slow (skipped by --quick).
+    '''
+    cases = {}
+    for depth in [10, 100, 400]:
+        for nan_frac in [0, .3]:
+            cases[f'ewm:depth={depth}:nan={nan_frac}'] = {
+                'setup': lambda depth=depth, nan_frac=nan_frac:
+                    (get_ewm_history(2 * depth, nan_frac), depth),
+                'run': run_ewm, 'number': 200, 'slow': False}
+
+    for study in [2, 4]:
+        cases[f'E_agent:study{study}'] = {
+            'setup': lambda study=study: (load_raw_data(study),),
+            'run': lambda df: get_df_with_E_p_E_r(df.copy(), vectorized=False),
+            'number': 1, 'slow': True}
+        for scale in SCALES:
+            cases[f'E_vectorized:study{study}:x{scale}'] = {
+                'setup': lambda study=study, scale=scale:
+                    (scale_dataset(load_raw_data(study), scale),),
+                'run': lambda df: get_df_with_E_p_E_r(df.copy()),
+                'number': 1, 'slow': scale == 100}
+
+    cases['PGG_RowProcessor'] = {
+        'setup': lambda: (get_PGG_rows(1),),
+        'run': run_PGG_by_row, 'number': 1, 'slow': True}
+    for scale in SCALES:
+        cases[f'PGG_vectorized:x{scale}'] = {
+            'setup': lambda scale=scale: (get_PGG_rows(scale),),
+            'run': run_PGG_vectorized, 'number': 1, 'slow': scale == 100}
+
+    cases['block_means:by_block'] = {
+        'setup': lambda: (load_Study4_processed(),),
+        'run': lambda df: get_block_means_by_block(df.copy()),
+        'number': 1, 'slow': True}
+    for scale in SCALES:
+        cases[f'block_means:x{scale}'] = {
+            'setup': lambda scale=scale:
+                (scale_dataset(load_Study4_processed(), scale),),
+            'run': get_block_means, 'number': 1, 'slow': scale == 100}
+
+    for k in [2, 10, 30]:
+        cases[f'lags:k={k}:x10'] = {
+            'setup': lambda: (scale_dataset(load_raw_data(4), 10),),
+            'run': lambda df, k=k: add_lag_features(df.copy(), k=k),
+            'number': 1, 'slow': False}
+
+    cases['lmer_fit:study2'] = {
+        'setup': get_lmer_case, 'run': run_lmer, 'number': 1, 'slow': False}
+    return cases
+
+
+def get_ewm_history(n, nan_frac, seed=0):
+    rng = np.random.default_rng(seed)
+    history = rng.integers(0, 11, n).astype(np.float64)
+    history[rng.random(n) < nan_frac] = np.nan
+    return list(history)
+
+
+def run_ewm(history, depth):
+    return get_exponentially_weighted_mean(history, decay=.9, depth=depth)
+
+
+def get_PGG_rows(scale):
+    from Study3.herrmann_ExV_calculate import get_combined_rows_from_processed
+    return scale_dataset(get_combined_rows_from_processed(), scale,
+                         id_cols=('sn', 'groupid'))
+
+
+def run_PGG_by_row(df):
+    from Study3.herrmann_ExV_calculate import get_PGG_expectations_by_row
+    return get_PGG_expectations_by_row(df)
+
+
+def run_PGG_vectorized(df):
+    from Study3.herrmann_ExV_calculate import get_PGG_expectations
+    return get_PGG_expectations(df)
+
+
+def get_lmer_case():
+    fp = os.path.join(DIR, 'UG_data', 'processed_RoleChange_Study2.csv')
+    df = read_csv(fp)
+    df = df[~df['excluded'].astype(bool)]
+    return get_lmer_data(df.copy(), both_E=True)
+
+
+def run_lmer(df, formula):
+    return fit_lmer(formula, df, family='binomial', REML=False,
+                    control=LMER_CONTROL, use_cache=False)
+
+
+def time_case(case, repeat=3):
+    args = case['setup']()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(case['number']):
+            case['run'](*args)
+        times.append((time.perf_counter() - t0) / case['number'])
+    return {'min_s': min(times), 'median_s': float(np.median(times)),
+            'repeat': repeat, 'number': case['number']}
+
+
+def run_benchmarks(name_filter=None, quick=False, repeat=3):
+    pd.options.mode.chained_assignment = None
+    results = {}
+    for name, case in get_cases().items():
+        if name_filter and name_filter not in name:
+            continue
+        if quick and case['slow']:
+            continue
+        print(f'Benchmarking: {name}', flush=True)
+        results[name] = time_case(case, repeat=1 if case['slow'] else repeat)
+        print(f'\t{results[name]["min_s"]:.6f} s')
+    return results
+
+
+def get_environment():
+    return {'python': platform.python_version(),
+            'machine': platform.machine(), 'processor': platform.processor(),
+            'numpy': np.__version__, 'pandas': pd.__version__,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def save_baseline(results, fp=BASELINE_FP):
+    with open(fp, 'w') as f:
+        json.dump({'environment': get_environment(), 'results': results}, f,
+                  indent=1)
+    print(f'Saved baseline: {fp}')
+
+
+def compare_to_baseline(results, fp=BASELINE_FP, threshold=.2):
+    '''
+    Returns a dataframe comparing the results to the baseline. Cases whose
+        fastest time grew by more than threshold are flagged as regressions.
+    '''
+    with open(fp) as f:
+        baseline = json.load(f)['results']
+    rows = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['min_s'] / baseline[name]['min_s']
+        rows.append({'case': name, 'baseline_s': baseline[name]['min_s'],
+                     'current_s': result['min_s'], 'ratio': ratio,
+                     'regression': ratio > 1 + threshold})
+    df = pd.DataFrame(rows, columns=['case', 'baseline_s', 'current_s',
+                                     'ratio', 'regression'])
+    print(df.to_string(index=False))
+    return df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the hot paths (see benchmark_suite.py)')
+    parser.add_argument('--filter', default=None,
+                        help='only run the cases whose name contains this')
+    parser.add_argument('--quick', action='store_true',
+                        help='skip the slow cases')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE_FP)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=.2)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.filter, quick=args.quick,
+                             repeat=args.repeat)
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}. Use --save-baseline.')
+        return 0
+    df = compare_to_baseline(results, args.baseline, args.threshold)
+    if df['regression'].any():
+        print(f'Regressions: {list(df.loc[df["regression"], "case"])}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
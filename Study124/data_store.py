@@ -0,0 +1,285 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+try:
+    from profiling import profiled
+except ImportError:  # imported from the repo root, e.g., by Study3
+    from Study124.profiling import profiled
+
+'''
+Shared data loading. read_csv(fp) parses a .csv once and saves it as a column
+    store next to it (.column_store/<file name>/: one .npy per column plus a
+    meta.json), which later calls load instead of reparsing the text.
+    The store uses compact dtypes:
+    - text columns (e.g., role, condition, city) as categorical codes
+    - integer columns as the smallest int type (e.g., int8 responses)
+    - float columns that only hold whole numbers (pandas reads any integer
+        column with blanks as float) as small ints with a missing-value mask
+    The store is rebuilt if the source file changes: when its mtime or size
+    differ from those recorded, the file is rehashed and the store is
+    rebuilt unless the hash is unchanged. Processes that find the store
+    missing at the same time (e.g., the workers of a process pool) build it
+    one at a time, behind a lock file, and the later ones then find it
+    built.
+
+By default, read_csv(...) returns the text columns as categoricals and the
+    integer columns in their compact type, but whole-number float columns as
+    float64, exactly as pd.read_csv would. The analyses rely on those being
+    floats (e.g., herrmann_lmer standardizes every float64 column), so the
+    pandas nullable ints (Int8, Int16, ...) are only returned when asked for
+    with nullable_ints=True. compact=False returns pd.read_csv's dtypes.
+
+For data too large to load at once, iter_csv_chunks(fp, key) reads a .csv in
+    chunks that never split the rows of a participant (key), and
+    write_csv_chunks(...) writes processed chunks to one .csv as they come.
+'''
+
+STORE_DIR = '.column_store'
+INT_TYPES = [np.int8, np.int16, np.int32, np.int64]
+
+
+@profiled('read_csv')
+def read_csv(fp, compact=True, nullable_ints=False, columns=None):
+    store_dir = get_store(fp)
+    with open(os.path.join(store_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    data = {}
+    for i, col_meta in enumerate(meta['columns']):
+        if columns is not None and col_meta['name'] not in columns:
+            continue
+        data[col_meta['name']] = decode_column(store_dir, i, col_meta,
+                                               compact, nullable_ints)
+    return pd.DataFrame(data)
+
+
+def load_columns(fp, columns=None):
+    '''
+    The stored (compact) columns of fp as read-only memory-mapped arrays,
+        e.g., to share a dataset between processes without copying it. Text
+        columns are returned as codes. Returns the arrays and the column meta.
+    '''
+    store_dir = get_store(fp)
+    with open(os.path.join(store_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    arrays = {}
+    for i, col_meta in enumerate(meta['columns']):
+        if columns is None or col_meta['name'] in columns:
+            arrays[col_meta['name']] = np.load(
+                os.path.join(store_dir, f'{i}.npy'), mmap_mode='r')
+    return arrays, meta['columns']
+
+
+def get_store(fp):
+    '''
+    Returns the store directory for fp, (re)building it if it is missing or
+        out of date.
+    '''
+    fp = os.path.abspath(fp)
+    store_dir = os.path.join(os.path.dirname(fp), STORE_DIR,
+                             os.path.basename(fp))
+    stat = os.stat(fp)
+    if is_store_current(fp, store_dir, stat):
+        return store_dir
+    with store_lock(store_dir):
+        if not is_store_current(fp, store_dir, stat):  # or built meanwhile
+            build_store(fp, store_dir, stat)
+    return store_dir
+
+
+def is_store_current(fp, store_dir, stat):
+    meta_fp = os.path.join(store_dir, 'meta.json')
+    if not os.path.exists(meta_fp):
+        return False
+    with open(meta_fp) as f:
+        meta = json.load(f)
+    if (meta['mtime_ns'], meta['size']) == (stat.st_mtime_ns, stat.st_size):
+        return True
+    if meta['sha256'] == hash_file(fp):  # e.g., the file was only touched
+        meta['mtime_ns'], meta['size'] = stat.st_mtime_ns, stat.st_size
+        with open(meta_fp, 'w') as f:
+            json.dump(meta, f)
+        return True
+    return False
+
+
+@contextmanager
+def store_lock(store_dir):
+    '''
+    An exclusive lock (store_dir + '.lock') held while a store is built
+    '''
+    os.makedirs(os.path.dirname(store_dir), exist_ok=True)
+    with file_lock(f'{store_dir}.lock'):
+        yield
+
+
+@contextmanager
+def file_lock(fp):
+    '''
+    An exclusive lock between processes, held by locking the file fp (which
+        is created if needed)
+    '''
+    with open(fp, 'a+') as f:
+        if sys.platform == 'win32':
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after 10 s
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def build_store(fp, store_dir, stat):
+    df = pd.read_csv(fp)
+    tmp_dir = f'{store_dir}.tmp{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    col_metas = []
+    for i, col in enumerate(df.columns):
+        values, col_meta = encode_column(df[col])
+        np.save(os.path.join(tmp_dir, f'{i}.npy'), values, allow_pickle=False)
+        if 'mask' in col_meta:
+            np.save(os.path.join(tmp_dir, f'{i}_mask.npy'), col_meta.pop('mask'))
+        col_metas.append(col_meta)
+    meta = {'source': os.path.basename(fp), 'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size, 'sha256': hash_file(fp),
+            'columns': col_metas}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(tmp_dir, store_dir)
+
+
+def encode_column(col):
+    col_meta = {'name': col.name, 'dtype': str(col.dtype)}
+    if col.dtype.kind == 'b':
+        col_meta['kind'] = 'bool'
+        return col.to_numpy(), col_meta
+    if col.dtype.kind in 'iu':
+        values = col.to_numpy()
+        col_meta['kind'] = 'int'
+        return values.astype(get_int_type(values)), col_meta
+    if col.dtype.kind == 'f':
+        values = col.to_numpy()
+        valid = ~np.isnan(values)
+        whole = np.all(values[valid] == np.round(values[valid])) and \
+            (not valid.any() or np.abs(values[valid]).max() < 2 ** 31)
+        if not whole:
+            col_meta['kind'] = 'float'
+            return values, col_meta
+        ints = np.where(valid, values, 0).astype(np.int64)
+        col_meta['kind'] = 'whole_float'
+        col_meta['mask'] = ~valid
+        return ints.astype(get_int_type(ints)), col_meta
+
+    # text
+    is_na = col.isna().to_numpy()
+    if not all(isinstance(v, str) for v in col[~is_na]):
+        raise TypeError(f'Column {col.name} mixes text and other values')
+    codes, categories = pd.factorize(col, sort=True)
+    col_meta['kind'] = 'text'
+    col_meta['categories'] = list(categories)
+    return codes.astype(get_int_type(codes)), col_meta
+
+
+def decode_column(store_dir, i, col_meta, compact=True, nullable_ints=False):
+    values = np.load(os.path.join(store_dir, f'{i}.npy'))
+    kind = col_meta['kind']
+    if kind in ('bool', 'float'):
+        return values
+    if kind == 'int':
+        return values if compact else values.astype(col_meta['dtype'])
+    if kind == 'whole_float':
+        mask = np.load(os.path.join(store_dir, f'{i}_mask.npy'))
+        if compact and nullable_ints:
+            return pd.arrays.IntegerArray(values, mask)
+        values = values.astype(np.float64)
+        values[mask] = np.nan
+        return values
+    categorical = pd.Categorical.from_codes(values, col_meta['categories'])
+    if compact:
+        return categorical
+    return pd.Series(np.asarray(categorical, dtype=object))
+
+
+def get_int_type(values):
+    if len(values) == 0:
+        return np.int8
+    lo, hi = values.min(), values.max()
+    for int_type in INT_TYPES:
+        if np.iinfo(int_type).min <= lo and hi <= np.iinfo(int_type).max:
+            return int_type
+    return np.int64
+
+
+def iter_csv_chunks(fp, key, chunksize=100_000, usecols=None):
+    '''
+    Yields fp's rows in dataframes of about chunksize rows, aligned on key
+        (e.g., 'id'): the rows of the last key in each chunk are held back and
+        prepended to the next one. A participant's rows must be contiguous.
+        Rows are numbered as in the whole file (the index).
+    '''
+    pending = None
+    for df in pd.read_csv(fp, chunksize=chunksize, usecols=usecols):
+        if pending is not None:
+            df = pd.concat([pending, df])
+        keys = df[key].to_numpy()
+        last = np.flatnonzero(keys != keys[-1])
+        if not len(last):  # one participant so far
+            pending = df
+            continue
+        split = last[-1] + 1
+        pending = df.iloc[split:]
+        yield df.iloc[:split]
+    if pending is not None and len(pending):
+        yield pending
+
+
+def write_csv_chunks(chunks, fp):
+    '''
+    Writes the dataframes of chunks to fp one at a time (with the header
+        once). Returns the number of rows written. The chunks go to a
+        temporary file that only replaces fp once all of them are written,
+        so fp is left as it was if producing a chunk fails.
+    '''
+    tmp_fp = f'{fp}.tmp{os.getpid()}'
+    n_rows = 0
+    try:
+        for i, df in enumerate(chunks):
+            df.to_csv(tmp_fp, mode='w' if i == 0 else 'a', header=i == 0,
+                      index=False)
+            n_rows += len(df)
+    except BaseException:
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+        raise
+    if os.path.exists(tmp_fp):  # nothing is written if there are no chunks
+        os.replace(tmp_fp, fp)
+    return n_rows
+
+
+def hash_file(fp):
+    h = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import pickle
+import re
+
+import numpy as np
+import pandas as pd
+
+try:
+    from model_backends import get_backend
+    from profiling import profiled
+except ImportError:  # imported from the repo root, e.g., by Study3
+    from Study124.model_backends import get_backend
+    from Study124.profiling import profiled
+
+'''
+On-disk cache for lme4 fits. Rerunning an analysis (e.g., to tweak a plot)
+    otherwise refits every model from scratch. A fit is keyed on a hash of the
+    model frame (the formula's columns, after dropping rows with missing
+    values, as lme4 would) together with the formula, family, REML, optimizer
+    control string and model backend (see model_backends.py). The logLike, the coefs table and any
+    convergence warnings are stored as one pickle per fit. When the cache
+    grows past max_bytes, the least recently used fits are evicted.
+Warm-started fits (start) are keyed on their starting values as well, so they
+    are never mistaken for cold fits of the same model (or vice versa). A
+    result read from the cache has cached=True, as its n_iter describes the
+    fit that was cached rather than any work done now.
+'''
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '.fit_cache')
+MAX_BYTES = 500 * 2 ** 20
+
+
+@profiled()
+def fit_lmer(formula, df, family='gaussian', REML=True, control='',
+             backend=None, start=None, design=None, use_cache=True,
+             cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    '''
+    Fits formula to df with the given model backend (pymer4 by default), or
+        returns the cached result of an identical earlier fit. Returns a dict
+        with the logLike, coefs and warnings of the fit (plus whatever else the
+        backend reports). start, an earlier result for the same model, is
+        passed on to the backend as starting values, and its values are part
+        of the cache key. design, prebuilt design matrices for formula on
+        df's rows (for backends that support_design), is passed on as well.
+    '''
+    backend = get_backend(backend)
+    model_frame = get_model_frame(formula, df)
+    key = get_fit_key(model_frame, formula, family, REML, control,
+                      backend.name, start=start)
+    fp = os.path.join(cache_dir, f'{key}.pkl')
+    if use_cache and os.path.exists(fp):
+        with open(fp, 'rb') as f:
+            result = pickle.load(f)
+        os.utime(fp)  # marks the fit as recently used for eviction
+        result['cached'] = True
+        return result
+
+    result = backend.fit(formula, model_frame, family=family, REML=REML,
+                         control=control, start=start, design=design)
+    result['cached'] = False
+
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(fp, 'wb') as f:
+            pickle.dump(result, f)
+        evict(cache_dir, max_bytes)
+    return result
+
+
+def get_model_frame(formula, df):
+    '''
+    The columns of df named in formula, without the rows lme4 would drop
+    '''
+    cols = [col for col in df.columns
+            if re.search(rf'(?<![\w.]){re.escape(col)}(?![\w.])', formula)]
+    return df[cols].dropna()
+
+
+def get_fit_key(model_frame, formula, family, REML, control,
+                backend_name='pymer4', start=None):
+    h = hashlib.sha256()
+    h.update(repr((formula, family, bool(REML), control,
+                   backend_name)).encode())
+    h.update(repr(list(zip(model_frame.columns,
+                           map(str, model_frame.dtypes)))).encode())
+    h.update(pd.util.hash_pandas_object(model_frame, index=False).to_numpy()
+             .tobytes())
+    if start is not None:  # cold fits keep the keys they always had
+        for name in ['theta', 'fixef']:
+            if start.get(name) is not None:
+                h.update(name.encode())
+                h.update(np.asarray(start[name], dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    '''
+    Deletes the least recently used fits until the cache fits in max_bytes
+    '''
+    entries = []
+    for fn in os.listdir(cache_dir):
+        if fn.endswith('.pkl'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, fn))
+            except FileNotFoundError:  # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fn))
+    total = sum(size for _, size, _ in entries)
+    for _, size, fn in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, fn))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def clear(cache_dir=CACHE_DIR):
+    if os.path.isdir(cache_dir):
+        evict(cache_dir, max_bytes=0)
@@ -0,0 +1,445 @@
+import copy
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import optimize, stats
+from scipy.special import expit
+
+try:
+    from profiling import profile_block
+except ImportError:  # imported from the repo root, e.g., by Study3
+    from Study124.profiling import profile_block
+
+'''
+Model backends used by fit_cache.fit_lmer(...). Each backend fits an lme4-style
+    formula and returns a dict with (at least) the logLike, coefs table and
+    warnings of the fit.
+
+Pymer4Backend goes through pymer4/rpy2 to lme4 and is what every reported
+    result used. NumpyBackend is an in-process alternative that avoids the R
+    round trip (and the slow pymer4 import). It supports formulas with a
+    single random-effects term, e.g., y ~ 1 + a + b + (1 + a | id), and fits:
+    - family='gaussian': a linear mixed model by profiled (RE)ML, as lme4 does
+    - family='binomial': a logistic mixed model by the Laplace approximation
+        (lme4's default, nAGQ=1)
+    The R-specific control string is ignored. Fits can be warm-started from
+    an earlier result (start), which must have the same fixed and random
+    effects. The design matrices can be passed in prebuilt (design, a
+    MixedModelData), e.g., a submodel of a larger model sharing its model
+    frame (see model_comparison.py). Because it lacks lmerTest's
+    Satterthwaite degrees of freedom, gaussian p-values use a normal
+    approximation. See benchmark_backends.py for its speed and agreement
+    with lme4.
+RWorkerBackend sends the fits to the persistent R service of rworker.py
+    (starting it if needed), which fits them with pymer4 but keeps R loaded
+    between scripts, so only the first script pays for loading it.
+
+The default backend can be set with the LMER_BACKEND environment variable.
+'''
+
+
+class Pymer4Backend:
+    name = 'pymer4'
+    supports_start = False  # pymer4 does not pass starting values to lme4
+    supports_design = False  # the data is always sent to R as a dataframe
+
+    def fit(self, formula, df, family='gaussian', REML=True, control='',
+            start=None, design=None):
+        with profile_block('import pymer4'):
+            from pymer4.models import Lmer  # this package is slow to load, so it's
+                                            # imported within this function.
+        with profile_block('Lmer (data transfer to R)'):
+            mod = Lmer(formula, data=df, family=family)
+        with profile_block('Lmer.fit') as frame:
+            mod.fit(REML=REML, control=control, summary=False)
+            frame['rows'] = len(df)
+        warnings = list(getattr(mod, 'warnings', []))
+        return {'logLike': mod.logLike,
+                'coefs': mod.coefs,
+                'warnings': warnings,
+                'fixef': mod.coefs['Estimate'],
+                'n_iter': None,
+                'converged': not warnings}
+
+
+class NumpyBackend:
+    name = 'numpy'
+    supports_start = True
+    supports_design = True
+
+    def __init__(self, max_iter=1000):
+        self.max_iter = max_iter
+
+    def fit(self, formula, df, family='gaussian', REML=True, control='',
+            start=None, design=None):
+        if design is not None:
+            model = design
+        else:
+            with profile_block('MixedModelData'):
+                model = MixedModelData(formula, df)
+        if family == 'gaussian':
+            return fit_lmm(model, REML=REML, max_iter=self.max_iter,
+                           start=start)
+        elif family == 'binomial':
+            return fit_binomial_glmm(model, max_iter=self.max_iter,
+                                     start=start)
+        raise NotImplementedError(f'NumpyBackend does not support {family=}')
+
+
+class RWorkerBackend:
+    name = 'rworker'
+    supports_start = False  # same as pymer4, which the service runs
+    supports_design = False
+
+    def __init__(self, address=None, autostart=True):
+        self.address = address
+        self.autostart = autostart
+
+    def fit(self, formula, df, family='gaussian', REML=True, control='',
+            start=None, design=None):
+        try:
+            from rworker import ensure_server, fit_remote
+        except ImportError:  # imported from the repo root, e.g., by Study3
+            from Study124.rworker import ensure_server, fit_remote
+        if self.autostart:
+            with profile_block('rworker start'):
+                ensure_server(self.address)
+            self.autostart = False  # checked once per backend instance
+        with profile_block('rworker fit') as frame:
+            result = fit_remote(formula, df, family=family, REML=REML,
+                                control=control, address=self.address)
+            frame['rows'] = len(df)
+        return result
+
+
+BACKENDS = {'pymer4': Pymer4Backend, 'numpy': NumpyBackend,
+            'rworker': RWorkerBackend}
+DEFAULT_BACKEND = os.environ.get('LMER_BACKEND', 'pymer4')
+
+
+def get_backend(backend=None):
+    '''
+    backend can be None (the default backend), a name in BACKENDS or an
+        already constructed backend.
+    '''
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if isinstance(backend, str):
+        return BACKENDS[backend]()
+    return backend
+
+
+def parse_formula(formula):
+    '''
+    Splits 'y ~ 1 + a + (1 + a | id)' into ('y', ['1', 'a'], ['1', 'a'], 'id')
+    '''
+    lhs, rhs = formula.split('~')
+    rfx = re.findall(r'\(([^()|]*)\|([^()]*)\)', rhs)
+    if len(rfx) != 1:
+        raise NotImplementedError('Only formulas with a single random-effects '
+                                  f'term are supported: {formula}')
+    fixed = re.sub(r'\([^()]*\)', '', rhs)
+    fixed_terms = [term.strip() for term in fixed.split('+') if term.strip()]
+    rand_terms = [term.strip() for term in rfx[0][0].split('+') if term.strip()]
+    return lhs.strip(), fixed_terms, rand_terms, rfx[0][1].strip()
+
+
+def get_design_matrix(df, terms, cache=None):
+    '''
+    Builds the model matrix the way R would: an intercept unless the terms
+        include 0 (or -1), numeric columns as is and categorical columns as
+        treatment-coded dummies named like R does (e.g., conditionselfish).
+        cache, a dict, keeps the columns of each term so that models sharing
+        terms (and df) don't build them again.
+    '''
+    intercept = not ('0' in terms or '-1' in terms)
+    cols = [np.ones(len(df))] if intercept else []
+    names = ['(Intercept)'] if intercept else []
+    for term in terms:
+        if term in ('0', '-1', '1'):
+            continue
+        if cache is not None and term in cache:
+            term_cols, term_names, is_factor = cache[term]
+        else:
+            term_cols, term_names, is_factor = get_term_columns(df[term], term)
+            if cache is not None:
+                cache[term] = term_cols, term_names, is_factor
+        if not is_factor:
+            cols += term_cols
+            names += term_names
+            continue
+        first = 1 if intercept else 0  # the reference level is dropped
+        cols += term_cols[first:]
+        names += term_names[first:]
+        intercept = True  # only the first factor is coded fully without one
+    return np.column_stack(cols), names
+
+
+def get_term_columns(col, term):
+    '''
+    The columns of one term: the column itself if it is numeric, otherwise
+        a dummy for every level. Returns the columns, their names and
+        whether the term is a factor.
+    '''
+    if pd.api.types.is_numeric_dtype(col) and \
+            not isinstance(col.dtype, pd.CategoricalDtype):
+        return [col.to_numpy(dtype=np.float64)], [term], False
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        levels = list(col.cat.remove_unused_categories().cat.categories)
+    else:
+        levels = sorted(col.unique())
+    return [(col == level).to_numpy(dtype=np.float64) for level in levels], \
+        [f'{term}{level}' for level in levels], True
+
+
+class MixedModelData:
+    '''
+    Design matrices for a model with a single grouping factor. Rows are sorted
+        by group so that per-group sums can be taken with np.add.reduceat.
+        get_submodel(formula) gives the design of a model with a subset of
+        the terms (e.g., a base model and its extensions) on the same rows,
+        reusing the sorted model frame and the columns of each term.
+    '''
+    def __init__(self, formula, df):
+        y_col, fixed_terms, rand_terms, group_col = parse_formula(formula)
+        cols = [y_col, group_col] + [term for term in fixed_terms + rand_terms
+                                     if term in df.columns]
+        df = df[list(dict.fromkeys(cols))].dropna()
+        groups, self.group_names = pd.factorize(df[group_col], sort=True)
+        order = np.argsort(groups, kind='stable')
+        self.df = df.iloc[order]
+        self.groups = groups[order]
+        self.starts = np.flatnonzero(np.r_[True, np.diff(self.groups) != 0])
+        self.n_groups = len(self.starts)
+
+        self.y = self.df[y_col].to_numpy(dtype=np.float64)
+        self.y_col = y_col
+        self.group_col = group_col
+        self.term_cache = {}
+        self.set_design(fixed_terms, rand_terms)
+
+    def set_design(self, fixed_terms, rand_terms):
+        self.X, self.fixed_names = get_design_matrix(self.df, fixed_terms,
+                                                     self.term_cache)
+        self.Z, self.rand_names = get_design_matrix(self.df, rand_terms,
+                                                    self.term_cache)
+        self.n, self.p = self.X.shape
+        self.q = self.Z.shape[1]
+
+        # theta holds the lower triangle of the relative covariance factor
+        #   Lambda, column by column (as in lme4)
+        rows, cols = np.triu_indices(self.q)
+        self.theta_idx = (cols, rows)
+        self.theta_lower = np.where(cols == rows, 0., -np.inf)
+
+    def get_submodel(self, formula):
+        y_col, fixed_terms, rand_terms, group_col = parse_formula(formula)
+        missing = [term for term in fixed_terms + rand_terms
+                   if term not in ('0', '-1', '1') and
+                   term not in self.df.columns]
+        if (y_col, group_col) != (self.y_col, self.group_col) or missing:
+            raise ValueError(f'{formula} is not a submodel of this model '
+                             f'(response {self.y_col}, grouping '
+                             f'{self.group_col}, missing terms: {missing})')
+        submodel = copy.copy(self)
+        submodel.set_design(fixed_terms, rand_terms)
+        return submodel
+
+    def get_lambda(self, theta):
+        Lam = np.zeros((self.q, self.q))
+        Lam[self.theta_idx] = theta
+        return Lam
+
+    def group_sum(self, a):
+        return np.add.reduceat(a, self.starts, axis=0)
+
+
+def fit_lmm(model, REML=True, max_iter=1000, start=None):
+    '''
+    Linear mixed model by profiled (RE)ML. For a given theta, the fixed
+        effects and residual variance have closed forms, so only theta is
+        optimized. Everything is computed from per-group cross products.
+    '''
+    X, Z, y = model.X, model.Z, model.y
+    ZtZ = model.group_sum(Z[:, :, None] * Z[:, None, :])
+    ZtX = model.group_sum(Z[:, :, None] * X[:, None, :])
+    Zty = model.group_sum(Z * y[:, None])
+    XtX = X.T @ X
+    Xty = X.T @ y
+    yty = y @ y
+    I_q = np.eye(model.q)
+    n, p = model.n, model.p
+    n_eff = n - p if REML else n
+
+    def solve_theta(theta):
+        Lam = model.get_lambda(theta)
+        L = np.linalg.cholesky(Lam.T @ ZtZ @ Lam + I_q)
+        c = np.linalg.solve(L, (Lam.T @ Zty[:, :, None]))
+        C = np.linalg.solve(L, Lam.T @ ZtX)
+        XtVX = XtX - np.einsum('gqi,gqj->ij', C, C)
+        XtVy = Xty - np.einsum('gqi,gq->i', C, c[:, :, 0])
+        beta = np.linalg.solve(XtVX, XtVy)
+        pwrss = yty - np.sum(c ** 2) - beta @ XtVy
+        ldL2 = 2 * np.sum(np.log(np.diagonal(L, axis1=1, axis2=2)))
+        return beta, pwrss, ldL2, XtVX
+
+    def deviance(theta):
+        beta, pwrss, ldL2, XtVX = solve_theta(theta)
+        dev = ldL2 + n_eff * (1 + np.log(2 * np.pi * pwrss / n_eff))
+        if REML:
+            dev += np.linalg.slogdet(XtVX)[1]
+        return dev
+
+    start = start or {}
+    theta0 = start.get('theta')
+    if theta0 is None:
+        theta0 = np.where(model.theta_lower == 0, 1., 0.)
+    res = optimize.minimize(deviance, theta0, method='L-BFGS-B',
+                            bounds=[(lb, None) for lb in model.theta_lower],
+                            options={'maxiter': max_iter})
+    beta, pwrss, _, XtVX = solve_theta(res.x)
+    sigma2 = pwrss / n_eff
+    se = np.sqrt(np.diag(sigma2 * np.linalg.inv(XtVX)))
+    Lam = model.get_lambda(res.x)
+    return get_result(model, -res.fun / 2, beta, se, 'T-stat', res,
+                      rfx_cov=sigma2 * Lam @ Lam.T, sigma2=sigma2)
+
+
+def fit_binomial_glmm(model, max_iter=1000, start=None):
+    '''
+    Logistic mixed model by the Laplace approximation. For a given (theta,
+        beta), the conditional modes of the spherical random effects u are
+        found by Newton's method, separately for every group (but vectorized
+        across groups). theta and beta are then optimized jointly.
+    '''
+    X, Z, y = model.X, model.Z, model.y
+    ZZ = Z[:, :, None] * Z[:, None, :]
+    I_q = np.eye(model.q)
+    n_theta = len(model.theta_lower)
+    u_last = [np.zeros((model.n_groups, model.q))]  # warm starts the modes
+
+    def solve_u(theta, beta, tol=1e-10, max_newton=50):
+        Lam = model.get_lambda(theta)
+        offset = X @ beta
+        ZL = Z @ Lam
+        LtZZL = Lam.T @ ZZ @ Lam
+        u = u_last[0].copy()
+
+        def objective(u):
+            eta = offset + np.sum(ZL * u[model.groups], axis=1)
+            return np.sum(y * eta - np.logaddexp(0, eta)) - np.sum(u ** 2) / 2, eta
+
+        obj, eta = objective(u)
+        for _ in range(max_newton):
+            mu = expit(eta)
+            grad = model.group_sum(ZL * (y - mu)[:, None]) - u
+            H = model.group_sum(LtZZL * (mu * (1 - mu))[:, None, None]) + I_q
+            step = np.linalg.solve(H, grad[:, :, None])[:, :, 0]
+            for _ in range(20):  # step halving, in case Newton overshoots
+                obj_new, eta_new = objective(u + step)
+                if obj_new >= obj - 1e-12:
+                    break
+                step /= 2
+            u, obj, eta = u + step, obj_new, eta_new
+            if np.max(np.abs(step)) < tol:
+                break
+        mu = expit(eta)
+        W = mu * (1 - mu)
+        H = model.group_sum(LtZZL * W[:, None, None]) + I_q
+        u_last[0] = u
+        return u, obj, H, W, ZL
+
+    def deviance(params):
+        theta, beta = params[:n_theta], params[n_theta:]
+        u, obj, H, _, _ = solve_u(theta, beta)
+        ldL2 = 2 * np.sum(np.log(np.diagonal(np.linalg.cholesky(H),
+                                             axis1=1, axis2=2)))
+        return -2 * obj + ldL2
+
+    # Either part of start can be missing, and then starts at the default
+    start = start or {}
+    beta0 = fit_glm(X, y) if start.get('fixef') is None \
+        else np.asarray(start['fixef'])
+    theta0 = start.get('theta')
+    if theta0 is None:
+        theta0 = np.where(model.theta_lower == 0, 1., 0.)
+    res = optimize.minimize(deviance, np.r_[theta0, beta0], method='L-BFGS-B',
+                            bounds=[(lb, None) for lb in model.theta_lower] +
+                                   [(None, None)] * model.p,
+                            options={'maxiter': max_iter})
+    theta, beta = res.x[:n_theta], res.x[n_theta:]
+
+    # The standard errors are conditional on theta, as in lme4
+    u, _, H, W, ZL = solve_u(theta, beta)
+    ZtWX = model.group_sum(ZL[:, :, None] * (W[:, None] * X)[:, None, :])
+    HiZtWX = np.linalg.solve(H, ZtWX)
+    XtVX = (X * W[:, None]).T @ X - np.einsum('gqi,gqj->ij', ZtWX, HiZtWX)
+    se = np.sqrt(np.diag(np.linalg.inv(XtVX)))
+    Lam = model.get_lambda(theta)
+    return get_result(model, -res.fun / 2, beta, se, 'Z-stat', res,
+                      rfx_cov=Lam @ Lam.T)
+
+
+def fit_glm(X, y, n_iter=25):
+    '''
+    Plain logistic regression (IRLS), used for the starting fixed effects
+    '''
+    beta = np.zeros(X.shape[1])
+    for _ in range(n_iter):
+        mu = expit(X @ beta)
+        W = np.maximum(mu * (1 - mu), 1e-10)
+        step = np.linalg.solve((X * W[:, None]).T @ X, X.T @ (y - mu))
+        beta += step
+        if np.max(np.abs(step)) < 1e-10:
+            break
+    return beta
+
+
+def get_result(model, logLike, beta, se, stat_name, res, **extra):
+    z = beta / se
+    z_crit = stats.norm.ppf(.975)
+    coefs = pd.DataFrame({'Estimate': beta,
+                          '2.5_ci': beta - z_crit * se,
+                          '97.5_ci': beta + z_crit * se,
+                          'SE': se,
+                          stat_name: z,
+                          'P-val': 2 * stats.norm.sf(np.abs(z))},
+                         index=model.fixed_names)
+    warnings = [] if res.success else [f'Optimizer did not converge: '
+                                       f'{res.message}']
+    n_theta = len(model.theta_lower)
+    rfx_cov = pd.DataFrame(extra.pop('rfx_cov'), index=model.rand_names,
+                           columns=model.rand_names)
+    return {'logLike': logLike,
+            'coefs': coefs,
+            'warnings': warnings,
+            'fixef': coefs['Estimate'],
+            'theta': res.x[:n_theta],
+            'rfx_cov': rfx_cov,
+            'n_iter': res.nit,
+            'n_evals': res.nfev,
+            'converged': bool(res.success),
+            **extra}
+
+
+def compare_backends(formula, df, family='gaussian', REML=True, control='',
+                     backends=('pymer4', 'numpy')):
+    '''
+    Fits the same model with each backend and reports the time taken and the
+        agreement with the first backend (logLike and fixed effects).
+    '''
+    out = []
+    for name in backends:
+        t0 = time.perf_counter()
+        result = get_backend(name).fit(formula, df, family=family, REML=REML,
+                                       control=control)
+        out.append({'backend': name, 'time': time.perf_counter() - t0,
+                    'logLike': result['logLike'], 'fixef': result['fixef']})
+    ref = out[0]
+    for d in out:
+        d['d_logLike'] = d['logLike'] - ref['logLike']
+        d['max_d_fixef'] = np.max(np.abs(d['fixef'] - ref['fixef']))
+    return pd.DataFrame(out).drop(columns='fixef')
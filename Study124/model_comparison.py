@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+try:
+    from fit_cache import fit_lmer, get_model_frame
+    from model_backends import get_backend, MixedModelData, parse_formula
+    from profiling import profiled
+except ImportError:  # imported from the repo root, e.g., by Study3
+    from Study124.fit_cache import fit_lmer, get_model_frame
+    from Study124.model_backends import get_backend, MixedModelData, \
+        parse_formula
+    from Study124.profiling import profiled
+
+'''
+Nested-model comparisons: a base model against several extensions of it, each
+    adding one or more terms (e.g., the Table 1 ΔLL rows of herrmann_lmer.py
+    or the base/E_p/E_r models of do_lmer_by_city(...)). compare_models(...)
+    returns the ΔlogLik and likelihood-ratio test of every extension in one
+    call:
+    - every model is fit to the same model frame (the rows complete for all
+        the formulas), so the models are nested and the logLiks comparable
+    - for backends that accept prebuilt designs (the numpy backend), the
+        model frame is sorted and the columns of each term are built once,
+        and every model takes its design matrices from that shared design
+    - the base model is fit once, and, for backends that accept starting
+        values, every extension starts from the base model's estimates (the
+        new fixed effects at 0 and the new random effects uncorrelated, at
+        lme4's default starting value)
+The fits go through fit_lmer(...), so they are cached like any other.
+'''
+
+
+@profiled()
+def compare_models(df, formula_base, candidates, family='gaussian',
+                   REML=False, control='', backend=None, extend_rfx=False,
+                   warm_start=True, use_cache=True):
+    '''
+    Fits formula_base and every candidate extension of it. candidates is a
+        list of terms (e.g., ['E_p', 'E_r']), each named by itself, or a dict
+        {name: term or list of terms}. If extend_rfx, the terms are also
+        added to the random-effects term. Returns a dataframe with a row per
+        model (base first) and a dict {name: fit result}.
+    Note that ΔlogLik of REML fits only compares models with the same fixed
+        effects (see, Meteyard & Davies, 2020). The LRT columns are still
+        reported for them, as lme4's anova(...) refits with ML instead.
+    '''
+    backend = get_backend(backend)
+    candidates = get_candidates(candidates)
+    formulas = {'base': formula_base}
+    for name, terms in candidates.items():
+        formulas[name] = extend_formula(formula_base, terms, extend_rfx)
+    df = get_model_frame(' '.join(formulas.values()), df)
+
+    design = None
+    if backend.supports_design:
+        all_terms = [term for terms in candidates.values() for term in terms]
+        design = MixedModelData(extend_formula(formula_base, all_terms, True),
+                                df)
+    fit_kwargs = {'family': family, 'REML': REML, 'control': control,
+                  'backend': backend, 'use_cache': use_cache}
+
+    fits = {}
+    for name, formula in formulas.items():
+        model = None if design is None else design.get_submodel(formula)
+        start = None
+        if name != 'base' and warm_start and backend.supports_start:
+            start = get_extension_start(fits['base'], model)
+        fits[name] = fit_lmer(formula, df, design=model, start=start,
+                              **fit_kwargs)
+
+    df_out = get_comparison_table(fits, formulas, family)
+    return df_out, fits
+
+
+def get_candidates(candidates):
+    '''
+    Returns {name: [terms]}
+    '''
+    if not isinstance(candidates, dict):
+        candidates = {term: term for term in candidates}
+    return {name: [terms] if isinstance(terms, str) else list(terms)
+            for name, terms in candidates.items()}
+
+
+def extend_formula(formula, terms, extend_rfx=False):
+    '''
+    Adds terms to the fixed effects of formula (and to its random effects if
+        extend_rfx). Terms already in the model are not added again.
+    '''
+    y_col, fixed_terms, rand_terms, group_col = parse_formula(formula)
+    fixed_terms = list(dict.fromkeys(fixed_terms + list(terms)))
+    if extend_rfx:
+        rand_terms = list(dict.fromkeys(rand_terms + list(terms)))
+    return f'{y_col} ~ {" + ".join(fixed_terms)} + ' \
+           f'({" + ".join(rand_terms)} | {group_col})'
+
+
+def get_extension_start(fit_base, model):
+    '''
+    Starting values for model, an extension of the base model, from the base
+        model's fit: its fixed effects (0 for the new ones) and its relative
+        covariance factor (Lambda), with 1 on the diagonal for the new random
+        effects. Returns None if fit_base lacks the estimates, e.g., if it
+        was fit by another backend. If Lambda cannot be embedded, only the
+        fixed effects are returned, and theta starts at the backend's default.
+    '''
+    if model is None or 'theta' not in fit_base or 'rfx_cov' not in fit_base:
+        return None
+    fixef = pd.Series(0., index=model.fixed_names)
+    shared = [name for name in fit_base['fixef'].index if name in fixef.index]
+    fixef[shared] = fit_base['fixef'][shared]
+
+    idx = [model.rand_names.index(name) for name in fit_base['rfx_cov'].index]
+    if np.any(np.diff(idx) < 0):  # Lambda would no longer be triangular
+        return {'fixef': fixef}
+    rows, cols = np.triu_indices(len(idx))
+    lambda_base = np.zeros((len(idx), len(idx)))
+    lambda_base[cols, rows] = fit_base['theta']
+    lambda_ext = np.eye(model.q)
+    lambda_ext[np.ix_(idx, idx)] = lambda_base
+    return {'fixef': fixef, 'theta': lambda_ext[model.theta_idx]}
+
+
+def get_n_params(fit, formula, family):
+    '''
+    The number of estimated parameters: fixed effects, random-effects
+        (co)variances and, for gaussian models, the residual variance
+    '''
+    if 'rfx_cov' in fit:
+        q = len(fit['rfx_cov'])
+    else:
+        _, _, rand_terms, _ = parse_formula(formula)
+        intercept = not ('0' in rand_terms or '-1' in rand_terms)
+        q = intercept + len([term for term in rand_terms
+                             if term not in ('0', '-1', '1')])
+    return len(fit['fixef']) + q * (q + 1) // 2 + (family == 'gaussian')
+
+
+def get_comparison_table(fits, formulas, family):
+    '''
+    One row per model with its logLike and, relative to the base model,
+        ΔlogLik, the LRT statistic (2 ΔlogLik), its degrees of freedom and
+        p-value
+    '''
+    base = fits['base']
+    n_params_base = get_n_params(base, formulas['base'], family)
+    rows = []
+    for name, fit in fits.items():
+        n_params = get_n_params(fit, formulas[name], family)
+        d_logLike = fit['logLike'] - base['logLike']
+        d_params = n_params - n_params_base
+        chi2 = 2 * d_logLike
+        rows.append({'model': name, 'formula': formulas[name],
+                     'logLike': fit['logLike'], 'n_params': n_params,
+                     'd_logLike': d_logLike, 'chi2': chi2,
+                     'd_params': d_params,
+                     'p': stats.chi2.sf(max(chi2, 0.), d_params)
+                          if d_params > 0 else np.nan,
+                     'converged': fit.get('converged',
+                                          not fit.get('warnings')),
+                     'n_iter': fit.get('n_iter')})
+    return pd.DataFrame(rows).set_index('model')
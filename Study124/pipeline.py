@@ -0,0 +1,403 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(DIR))  # for Study3 (also in the workers)
+
+from data_store import hash_file
+from fit_cache import fit_lmer
+from model_backends import DEFAULT_BACKEND
+from Main_process_data_expectations import add_lag_features, proc_data, \
+    LAG_COLS
+from SuppMat_delay_discount import get_lmer_data, LMER_CONTROL
+
+'''
+Runs the analyses as one pipeline of stages, from the command line, e.g.:
+    python pipeline.py                          (everything)
+    python pipeline.py fit:2 --backend numpy    (a stage and what it needs)
+    python pipeline.py figure --studies 2 4     (all figure stages)
+    python pipeline.py --list
+The stages are:
+    expectations:<study>  raw .csv -> E_p/E_r added (proc_data(...))
+    lags:<study>          -> prev_ columns rebuilt up to --n-lags (only with
+                          --n-lags, see add_lag_features(...))
+    model_frame:<study>   -> the do_lmer(...) frame and formula
+    fit:<study>           -> the do_lmer(...) fit
+    model_frame:3         the processed Herrmann data (load_and_basic_preprocess)
+    fit:3:<model>         -> the Table 1 fits (base, E_p, E_r, ExV_p, ExV_r)
+    figure:coefs          E_p/E_r coefficients by study
+    figure:table1         ΔLL of the Table 1 models
+Every stage is keyed by a hash of its parameters, its input files, the code
+    it runs and the keys of the stages it depends on. A stage whose key
+    matches the one saved with its output is skipped, so only stale stages
+    rerun. Stages whose dependencies are done run concurrently in a process
+    pool. Outputs are pickled to pipeline_out/ (figures are saved as .png).
+The raw Herrmann et al. data isn't distributed, so the Study 3 stages start
+    from the processed file. With --data-dir, the raw data of every study is
+    read from that folder instead (e.g., synthetic data written by
+    synthetic_data.py), and Study 3 then starts with an expectations:3 stage
+    (process_PGG_data(...)).
+'''
+
+OUT_DIR = os.path.join(DIR, 'pipeline_out')
+STUDY3_DIR = os.path.join(os.path.dirname(DIR), 'Study3')
+UG_STUDIES = [2, 4]
+TABLE1_MODELS = {'base': {'do_ExV': False, 'do_p': False, 'do_r': False},
+                 'E_p': {'do_ExV': False, 'do_p': True, 'do_r': False},
+                 'E_r': {'do_ExV': False, 'do_p': False, 'do_r': True},
+                 'ExV_p': {'do_ExV': True, 'do_p': True, 'do_r': False},
+                 'ExV_r': {'do_ExV': True, 'do_p': False, 'do_r': True}}
+
+# the data is read through data_store.read_csv(...), whose dtypes the
+#   expectations and model frames depend on
+DATA_CODE = [os.path.join(DIR, 'data_store.py')]
+EXPECTATION_CODE = DATA_CODE + [os.path.join(DIR, fn) for fn in
+                                ['Agent.py',
+                                 'Main_process_data_expectations.py']]
+FIT_CODE = DATA_CODE + [os.path.join(DIR, fn) for fn in
+                        ['fit_cache.py', 'model_backends.py',
+                         'SuppMat_delay_discount.py']]
+HERRMANN_CODE = [os.path.join(STUDY3_DIR, 'herrmann_lmer.py')]
+
+
+def get_stages(studies=(2, 4, 3), reset_on_block=True, delay_discount=1,
+               per_participant=False, both_E=True, backend=None,
+               data_dir=None, n_lags=None, lag_cols=LAG_COLS,
+               lag_by=('id', 'block_number')):
+    '''
+    Returns {name: stage}. A stage is a dict with the function to run, its
+        parameters (keyword arguments), the stages whose outputs are passed
+        to it (in order) and its input files (data and code).
+    '''
+    backend = backend or DEFAULT_BACKEND  # so that the key names the backend
+    stages = {}
+    for study in [s for s in studies if s in UG_STUDIES]:
+        params = {'study': study, 'reset_on_block': reset_on_block,
+                  'delay_discount': delay_discount,
+                  'per_participant': per_participant}
+        if data_dir:  # only then, so that the default keys stay the same
+            params['data_dir'] = data_dir
+        stages[f'expectations:{study}'] = {
+            'func': stage_expectations,
+            'params': params,
+            'deps': [],
+            'inputs': [os.path.join(data_dir or os.path.join(DIR, 'UG_data'),
+                                    f'RoleChange_Study{study}_anonymized.csv')] +
+                      EXPECTATION_CODE}
+        frame_dep = f'expectations:{study}'
+        if n_lags:
+            stages[f'lags:{study}'] = {
+                'func': stage_lags,
+                'params': {'cols': list(lag_cols), 'k': n_lags,
+                           'by': list(lag_by)},
+                'deps': [f'expectations:{study}'],
+                'inputs': EXPECTATION_CODE}
+            frame_dep = f'lags:{study}'
+        stages[f'model_frame:{study}'] = {
+            'func': stage_model_frame,
+            'params': {'both_E': both_E},
+            'deps': [frame_dep],
+            'inputs': FIT_CODE}
+        stages[f'fit:{study}'] = {
+            'func': stage_fit,
+            'params': {'family': 'binomial', 'REML': False,
+                       'control': LMER_CONTROL, 'backend': backend},
+            'deps': [f'model_frame:{study}'],
+            'inputs': FIT_CODE}
+    ug_fits = [name for name in stages if name.startswith('fit:')]
+    if ug_fits:
+        stages['figure:coefs'] = {
+            'func': stage_figure_coefs,
+            'params': {'studies': [int(name.split(':')[1])
+                                   for name in ug_fits]},
+            'deps': ug_fits,
+            'inputs': []}
+
+    if 3 in studies:
+        if data_dir:
+            stages['expectations:3'] = {
+                'func': stage_herrmann_expectations,
+                'params': {'data_dir': data_dir},
+                'deps': [],
+                'inputs': [os.path.join(data_dir, 'Herrmann_Data.csv'),
+                           os.path.join(STUDY3_DIR,
+                                        'herrmann_ExV_calculate.py')] +
+                          DATA_CODE}
+            stages['model_frame:3'] = {
+                'func': stage_herrmann_frame,
+                'params': {},
+                'deps': ['expectations:3'],
+                'inputs': DATA_CODE + HERRMANN_CODE}
+        else:
+            stages['model_frame:3'] = {
+                'func': stage_herrmann_frame,
+                'params': {},
+                'deps': [],
+                'inputs': [os.path.join(STUDY3_DIR, 'PGG_data',
+                                        'Herrmann_Data_Processed.csv')] +
+                          DATA_CODE + HERRMANN_CODE}
+        for model, settings in TABLE1_MODELS.items():
+            stages[f'fit:3:{model}'] = {
+                'func': stage_herrmann_fit,
+                'params': {**settings, 'do_REML': True, 'backend': backend},
+                'deps': ['model_frame:3'],
+                'inputs': FIT_CODE + HERRMANN_CODE}
+        stages['figure:table1'] = {
+            'func': stage_figure_table1,
+            'params': {'models': list(TABLE1_MODELS)},
+            'deps': [f'fit:3:{model}' for model in TABLE1_MODELS],
+            'inputs': []}
+    return stages
+
+
+def stage_expectations(study, reset_on_block, delay_discount,
+                       per_participant, data_dir=None):
+    return proc_data(study, reset_on_block=reset_on_block,
+                     delay_discount=delay_discount,
+                     per_participant=per_participant, data_dir=data_dir)
+
+
+def stage_lags(df, cols, k, by):
+    return add_lag_features(df.copy(), cols=cols, k=k, by=by)
+
+
+def stage_model_frame(df, both_E):
+    return get_lmer_data(df.copy(), both_E=both_E)
+
+
+def stage_fit(frame, family, REML, control, backend):
+    df, formula = frame
+    result = fit_lmer(formula, df, family=family, REML=REML, control=control,
+                      backend=backend)
+    print(result['coefs'])
+    return result
+
+
+def stage_herrmann_expectations(data_dir):
+    from Study3.herrmann_ExV_calculate import process_PGG_data
+    return process_PGG_data(data_dir=data_dir)
+
+
+def stage_herrmann_frame(df=None):
+    from Study3.herrmann_lmer import load_and_basic_preprocess
+    return load_and_basic_preprocess(df)
+
+
+def stage_herrmann_fit(df, do_ExV, do_p, do_r, do_REML, backend):
+    from Study3.herrmann_lmer import get_E_ExV_formula, E_EXV_CONTROL
+    formula = get_E_ExV_formula(do_ExV=do_ExV, do_p=do_p, do_r=do_r)
+    result = fit_lmer(formula, df, REML=do_REML, control=E_EXV_CONTROL,
+                      backend=backend)
+    print(f'{formula}: log-likelihood = {result["logLike"]:.2f}')
+    return result
+
+
+def stage_figure_coefs(*fits, studies, out_fp):
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    fig, ax = plt.subplots(figsize=(5, 4))
+    for i, key in enumerate(['E_p', 'E_r']):
+        for j, (study, fit) in enumerate(zip(studies, fits)):
+            coefs = fit['coefs']
+            if key not in coefs.index:
+                continue
+            x = j + (i - .5) * .2
+            err = [[coefs.loc[key, 'Estimate'] - coefs.loc[key, '2.5_ci']],
+                   [coefs.loc[key, '97.5_ci'] - coefs.loc[key, 'Estimate']]]
+            ax.errorbar([x], [coefs.loc[key, 'Estimate']], yerr=err, fmt='o',
+                        color='b' if key == 'E_p' else 'r',
+                        label=key if j == 0 else None)
+    ax.axhline(0, color='k', linestyle='--')
+    ax.set_xticks(range(len(studies)))
+    ax.set_xticklabels([f'Study {study}' for study in studies])
+    ax.set_ylabel('Coefficient (95% CI)')
+    ax.legend()
+    fig.savefig(out_fp, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+    return out_fp
+
+
+def stage_figure_table1(*fits, models, out_fp):
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    logLikes = dict(zip(models, [fit['logLike'] for fit in fits]))
+    d_LL = {model: logLike - logLikes['base'] for model, logLike
+            in logLikes.items() if model != 'base'}
+    fig, ax = plt.subplots(figsize=(5, 4))
+    ax.bar(list(d_LL), list(d_LL.values()),
+           color=['b' if model.endswith('p') else 'r' for model in d_LL])
+    ax.set_ylabel('ΔLL vs. base model')
+    fig.savefig(out_fp, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+    return out_fp
+
+
+def get_stage_keys(stages, names):
+    '''
+    names must be in dependency order (see get_required(...))
+    '''
+    keys = {}
+    for name in names:
+        stage = stages[name]
+        h = hashlib.sha256()
+        h.update(json.dumps([stage['func'].__name__, stage['params']],
+                            sort_keys=True, default=str).encode())
+        for fp in stage['inputs']:
+            h.update(hash_file(fp).encode())
+        for dep in stage['deps']:
+            h.update(keys[dep].encode())
+        keys[name] = h.hexdigest()
+    return keys
+
+
+def get_required(stages, targets=None):
+    '''
+    The target stages (names, or prefixes such as 'fit' or 'fit:3') and all
+        the stages they depend on, in dependency order
+    '''
+    if not targets:
+        selected = list(stages)
+    else:
+        selected = [name for name in stages if any(
+            name == target or name.startswith(f'{target}:')
+            for target in targets)]
+        if not selected:
+            raise ValueError(f'No stages match {targets}. '
+                             f'Stages: {list(stages)}')
+    ordered = []
+
+    def visit(name):
+        if name in ordered:
+            return
+        for dep in stages[name]['deps']:
+            visit(dep)
+        ordered.append(name)
+
+    for name in selected:
+        visit(name)
+    return ordered
+
+
+def get_out_fp(out_dir, name, ext='.pkl'):
+    return os.path.join(out_dir, name.replace(':', '_') + ext)
+
+
+def is_fresh(out_dir, name, key):
+    key_fp = get_out_fp(out_dir, name, '.key')
+    if not os.path.exists(key_fp) or \
+            not os.path.exists(get_out_fp(out_dir, name)):
+        return False
+    with open(key_fp) as f:
+        return f.read() == key
+
+
+def load_output(out_dir, name):
+    with open(get_out_fp(out_dir, name), 'rb') as f:
+        return pickle.load(f)
+
+
+def run_stage(stage, name, key, out_dir):
+    pd.options.mode.chained_assignment = None
+    args = [load_output(out_dir, dep) for dep in stage['deps']]
+    params = dict(stage['params'])
+    if name.startswith('figure:'):
+        params['out_fp'] = get_out_fp(out_dir, name, '.png')
+    output = stage['func'](*args, **params)
+
+    out_fp = get_out_fp(out_dir, name)
+    with open(f'{out_fp}.tmp', 'wb') as f:
+        pickle.dump(output, f)
+    os.replace(f'{out_fp}.tmp', out_fp)
+    with open(get_out_fp(out_dir, name, '.key'), 'w') as f:
+        f.write(key)  # written last: the stage only counts as done now
+    return name
+
+
+def run_pipeline(stages, targets=None, out_dir=OUT_DIR, n_workers=None,
+                 force=False, dry_run=False):
+    '''
+    Runs the stale stages needed for targets, each as soon as the stages it
+        depends on are done. Returns the names of the stages that were run.
+    '''
+    names = get_required(stages, targets)
+    keys = get_stage_keys(stages, names)
+    stale = [name for name in names
+             if force or not is_fresh(out_dir, name, keys[name])]
+    for name in names:
+        print(f'{"stale" if name in stale else "up to date":>10}: {name}')
+    if dry_run or not stale:
+        return stale
+    os.makedirs(out_dir, exist_ok=True)
+
+    done = set(names) - set(stale)
+    todo = list(stale)
+    running = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        while todo or running:
+            for name in [name for name in todo
+                         if all(dep in done for dep in stages[name]['deps'])]:
+                print(f'Running: {name}')
+                future = pool.submit(run_stage, stages[name], name,
+                                     keys[name], out_dir)
+                running[future] = name
+                todo.remove(name)
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                future.result()  # raises if the stage failed
+                print(f'Finished: {name}')
+                done.add(name)
+    return stale
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Runs the analysis pipeline (see pipeline.py)')
+    parser.add_argument('targets', nargs='*',
+                        help='stages or stage prefixes (default: all)')
+    parser.add_argument('--studies', nargs='+', type=int, default=[2, 4, 3])
+    parser.add_argument('--delay-discount', type=float, default=1)
+    parser.add_argument('--no-reset-on-block', dest='reset_on_block',
+                        action='store_false')
+    parser.add_argument('--per-participant', action='store_true')
+    parser.add_argument('--one-E', dest='both_E', action='store_false',
+                        help='fit E_r only in the do_lmer(...) model')
+    parser.add_argument('--n-lags', type=int, default=None,
+                        help='rebuild the prev_ columns up to this lag')
+    parser.add_argument('--lag-cols', nargs='+', default=LAG_COLS)
+    parser.add_argument('--lag-by', nargs='+', default=['id', 'block_number'],
+                        help='the groups lags are taken within')
+    parser.add_argument('--backend', default=None,
+                        help='model backend (see model_backends.py)')
+    parser.add_argument('--n-workers', type=int, default=None)
+    parser.add_argument('--data-dir', default=None,
+                        help='folder with the raw data of every study '
+                             '(default: the shipped data)')
+    parser.add_argument('--out-dir', default=OUT_DIR)
+    parser.add_argument('--force', action='store_true',
+                        help='rerun the stages even if they are up to date')
+    parser.add_argument('--list', action='store_true',
+                        help='only list the stages and whether they are stale')
+    args = parser.parse_args(argv)
+
+    stages = get_stages(studies=args.studies,
+                        reset_on_block=args.reset_on_block,
+                        delay_discount=args.delay_discount,
+                        per_participant=args.per_participant,
+                        both_E=args.both_E, backend=args.backend,
+                        data_dir=args.data_dir, n_lags=args.n_lags,
+                        lag_cols=args.lag_cols, lag_by=args.lag_by)
+    run_pipeline(stages, targets=args.targets, out_dir=args.out_dir,
+                 n_workers=args.n_workers, force=args.force,
+                 dry_run=args.list)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.special import expit
+
+from data_store import read_csv
+from fit_cache import fit_lmer, get_model_frame
+from model_backends import get_backend, get_design_matrix, parse_formula
+from resampling import get_replicate_rng
+from SuppMat_delay_discount import get_lmer_data
+
+'''
+Simulation-based power and sensitivity analyses, as done in R with
+    simr::powerSim for the R_analysis/*PowerAnalysis.R and
+    Study1_sensitivity_analysis.R scripts. The model is fit once, its fixed
+    effects can be overridden (e.g., fixef(m)['E_p'] = 0.5 in R is
+    effects={'E_p': 0.5}), and responses are then simulated from it: new
+    random effects are drawn for every cluster from the fitted random-effects
+    covariance, and then the responses themselves. Each simulated dataset is
+    refit and the tested effect counts as detected if its p-value is below
+    alpha. The running power and its 95% Clopper-Pearson CI are printed as
+    replicates finish, and the simulation stops early once the CI is no
+    wider than ci_width.
+
+The model must be fit with a backend that reports the random-effects
+    covariance (the numpy backend, see model_backends.py). Replicate i is
+    simulated from its own seeded generator and the running estimates only
+    use replicates 0..k once all of them are done, so the results, including
+    where an early stop happens, don't depend on n_workers.
+'''
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def power_sim(df, formula, test, effects=None, family='binomial', nsim=1000,
+              alpha=.05, ci_width=None, seed=0, backend='numpy',
+              n_workers=None, batch_size=10, fit=None):
+    '''
+    Estimates the power to detect the fixed effect test. fit can be an
+        earlier fit of formula to df (otherwise it is fit here). Returns a
+        dict with the power, its CI, the number of replicates simulated,
+        detected and failed and the running estimates (trace).
+    '''
+    if nsim < 1 or batch_size < 1:
+        raise ValueError(f'nsim and batch_size must be at least 1, got '
+                         f'{nsim=} and {batch_size=}')
+    backend = get_backend(backend)
+    df = get_model_frame(formula, df)
+    if fit is None:
+        fit = fit_lmer(formula, df, family=family, REML=False,
+                       backend=backend)
+    if 'rfx_cov' not in fit:
+        raise ValueError(f'Simulating requires the random-effects covariance, '
+                         f'which the {backend.name} backend does not report')
+    fixef = fit['fixef'].copy()
+    unknown = [name for name in [test, *(effects or {})]
+               if name not in fixef.index]
+    if unknown:
+        raise ValueError(f'Not fixed effects of the model: {unknown} '
+                         f'(the fixed effects are {list(fixef.index)})')
+    for name, value in (effects or {}).items():
+        fixef[name] = value
+    job = {'df': df, 'formula': formula, 'family': family, 'test': test,
+           'alpha': alpha, 'seed': seed, 'backend': backend,
+           'fixef': fixef, 'rfx_cov': fit['rfx_cov'],
+           'sigma2': fit.get('sigma2'),
+           'start': fit if backend.supports_start and 'theta' in fit
+                    else None}
+
+    detected = {}
+    trace = []
+    stop = False
+    n_printed = 0
+    batches = [list(range(i, min(i + batch_size, nsim)))
+               for i in range(0, nsim, batch_size)]
+    for reps in iter_power_batches(job, batches, n_workers):
+        detected.update(reps)
+        while len(trace) < nsim and len(trace) in detected:
+            # the running estimate uses replicates 0..k only, in order
+            k = len(trace) + 1
+            trace.append(get_power_estimate(
+                [detected[i] for i in range(k)], k))
+            if ci_width is not None and \
+                    trace[-1]['ci'][1] - trace[-1]['ci'][0] <= ci_width:
+                stop = True
+                break
+        if len(trace) > n_printed:
+            n_printed = len(trace)
+            est = trace[-1]
+            print(f'{est["n"]} simulations: power = {est["power"]:.3f} '
+                  f'[{est["ci"][0]:.3f}, {est["ci"][1]:.3f}]')
+        if stop:
+            break
+    # no estimate if no batch finished (e.g., the workers were interrupted)
+    out = dict(trace[-1]) if trace else get_power_estimate([], 0)
+    out['trace'] = pd.DataFrame(trace)
+    return out
+
+
+def get_power_estimate(detected, n):
+    '''
+    detected holds True/False per replicate, or None for failed fits, which
+        are left out (as simr does)
+    '''
+    valid = [d for d in detected if d is not None]
+    k = sum(valid)
+    if valid:
+        ci = stats.binomtest(k, len(valid)).proportion_ci(method='exact')
+        ci = (ci.low, ci.high)
+    else:
+        ci = (0., 1.)
+    return {'n': n, 'n_detected': k, 'n_failed': n - len(valid),
+            'power': k / len(valid) if valid else np.nan, 'ci': ci}
+
+
+def iter_power_batches(job, batches, n_workers=None):
+    '''
+    Yields {replicate: detected} per batch as batches finish. Only a couple of
+        batches per worker are queued at a time, so that stopping early
+        leaves little unfinished work.
+    '''
+    if n_workers == 1:
+        _init_power_worker(job)
+        for batch in batches:
+            yield _simulate_batch(batch)
+        return
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             initializer=_init_power_worker,
+                             initargs=(job,)) as pool:
+        max_queued = 2 * (n_workers or os.cpu_count())
+        batches = iter(batches)
+        pending = set()
+        try:
+            while True:
+                for batch in batches:
+                    pending.add(pool.submit(_simulate_batch, batch))
+                    if len(pending) >= max_queued:
+                        break
+                if not pending:
+                    return
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def simulate_response(df, formula, fixef, rfx_cov, family, rng, sigma2=None):
+    '''
+    Returns df with its response column replaced by responses simulated
+        from the fixed effects (fixef), new random effects drawn from rfx_cov
+        for every cluster and, for gaussian models, residual noise.
+    '''
+    y_col, fixed_terms, rand_terms, group_col = parse_formula(formula)
+    X, fixed_names = get_design_matrix(df, fixed_terms)
+    Z, rand_names = get_design_matrix(df, rand_terms)
+    groups, group_names = pd.factorize(df[group_col])
+    cov = np.asarray(rfx_cov.loc[rand_names, rand_names], dtype=np.float64)
+    b = rng.multivariate_normal(np.zeros(len(rand_names)), cov,
+                                size=len(group_names))
+    eta = X @ fixef[fixed_names].to_numpy() + np.sum(Z * b[groups], axis=1)
+    df_sim = df.copy()
+    if family == 'binomial':
+        df_sim[y_col] = (rng.random(len(df)) < expit(eta)).astype(np.float64)
+    elif family == 'gaussian':
+        df_sim[y_col] = eta + rng.normal(0, np.sqrt(sigma2), len(df))
+    else:
+        raise NotImplementedError(f'Cannot simulate {family=}')
+    return df_sim
+
+
+_power_job = {}  # filled in each worker by _init_power_worker(...)
+
+
+def _init_power_worker(job):
+    _power_job.update(job)
+    pd.options.mode.chained_assignment = None
+
+
+def _simulate_batch(batch):
+    job = _power_job
+    detected = {}
+    for i in batch:
+        rng = get_replicate_rng(job['seed'], i)
+        df_sim = simulate_response(job['df'], job['formula'], job['fixef'],
+                                   job['rfx_cov'], job['family'], rng,
+                                   job['sigma2'])
+        try:
+            result = fit_lmer(job['formula'], df_sim, family=job['family'],
+                              REML=False, backend=job['backend'],
+                              start=job['start'], use_cache=False)
+        except (ValueError, np.linalg.LinAlgError) as e:
+            print(f'Simulation {i} failed: {e}')
+            detected[i] = None
+            continue
+        detected[i] = bool(result['coefs'].loc[job['test'], 'P-val'] <
+                           job['alpha'])
+    return detected
+
+
+def sensitivity_analysis(df, formula, test, effect_sizes, **kwargs):
+    '''
+    power_sim(...) for a range of effect sizes of test. Returns a dataframe
+        with the power and CI per effect size.
+    '''
+    out = []
+    for effect_size in effect_sizes:
+        print(f'--- {test} = {effect_size} ---')
+        result = power_sim(df, formula, test, effects={test: effect_size},
+                           **kwargs)
+        out.append({'effect_size': effect_size, 'power': result['power'],
+                    'ci_low': result['ci'][0], 'ci_high': result['ci'][1],
+                    'n': result['n'], 'n_failed': result['n_failed']})
+    return pd.DataFrame(out)
+
+
+def power_do_lmer(study, test='E_p', effect=None, both_E=True, **kwargs):
+    '''
+    power_sim(...) for the do_lmer(...) model of SuppMat_delay_discount.py
+        on a study's processed data, e.g., power_do_lmer(2, 'E_p', 0.5) for
+        the power to detect an E_p effect of 0.5
+    '''
+    fp = os.path.join(DIR, 'UG_data', f'processed_RoleChange_Study{study}.csv')
+    df = read_csv(fp)
+    df = df[~df['excluded'].astype(bool)]
+    df, formula = get_lmer_data(df.copy(), both_E=both_E)
+    effects = None if effect is None else {test: effect}
+    return power_sim(df, formula, test, effects=effects, family='binomial',
+                     **kwargs)
+
+
+if __name__ == '__main__':
+    power_do_lmer(2, test='E_p', effect=0.5, nsim=300, ci_width=.1)
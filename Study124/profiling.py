@@ -0,0 +1,187 @@
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+'''
+Opt-in timing and memory instrumentation of the analysis stages. Nothing is
+    recorded (and the decorated functions run as usual) unless profiling is
+    enabled, either with enable() or by setting the PROFILE_STAGES
+    environment variable. Then, every call of a function decorated with
+    @profiled(...), and every profile_block(...) section, records:
+    - its wall time (and self time, i.e., not spent in nested stages)
+    - the peak traced memory (tracemalloc) while it ran
+    - the number of rows it processed (len of a DataFrame result/argument)
+    - the number of optimizer iterations, for fits that report n_iter
+    Stages nest, e.g., proc_data > get_df_with_E_p_E_r. Functions called per
+    row (e.g., RowProcessor.process_row) are profiled with per_call=False:
+    they are only timed and counted, without per-call records or memory.
+write_report(out_prefix) saves <out_prefix>.json (every record plus a
+    summary per stage), <out_prefix>.csv (the summary) and <out_prefix>.folded
+    (self time in microseconds per stack, which flamegraph.pl or speedscope
+    render as a flame graph). Only the current process is profiled, not the
+    workers of a process pool.
+'''
+
+_state = {'enabled': bool(os.environ.get('PROFILE_STAGES')),
+          'stack': [],
+          'records': [],
+          'totals': {}}
+
+# Study3 imports this module as Study124.profiling and Study124 as profiling.
+#   Both share one state so that a run is reported as a whole.
+for _name in ['profiling', 'Study124.profiling']:
+    if _name != __name__ and _name in sys.modules:
+        _state = sys.modules[_name]._state
+
+
+def enable():
+    _state['enabled'] = True
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    _state['enabled'] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def reset():
+    _state['stack'] = []
+    _state['records'] = []
+    _state['totals'] = {}
+
+
+def is_enabled():
+    return _state['enabled']
+
+
+if _state['enabled']:
+    enable()
+
+
+def profiled(name=None, per_call=True):
+    '''
+    Decorator that profiles every call of the function as a stage named name
+        (by default the function's qualified name)
+    '''
+    def decorator(func):
+        stage = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return func(*args, **kwargs)
+            with profile_block(stage, per_call=per_call) as frame:
+                result = func(*args, **kwargs)
+                frame['rows'] = get_rows(result, args)
+                frame['n_iter'] = get_n_iter(result)
+            return result
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profile_block(name, per_call=True):
+    '''
+    Profiles the enclosed code as a stage. Yields a dict in which rows and
+        n_iter can be set.
+    '''
+    if not _state['enabled']:
+        yield {}
+        return
+    stack = _state['stack']
+    path = ';'.join([frame['path'] for frame in stack[-1:]] + [name])
+    frame = {'path': path, 'rows': None, 'n_iter': None, 'child_time': 0.,
+             'peak': 0}
+    if per_call:
+        if stack:  # the parent's peak so far, before the peak is reset
+            stack[-1]['peak'] = max(stack[-1]['peak'],
+                                    tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    stack.append(frame)
+    t0 = time.perf_counter()
+    try:
+        yield frame
+    finally:
+        wall = time.perf_counter() - t0
+        stack.pop()
+        if stack:
+            stack[-1]['child_time'] += wall
+        if per_call:
+            frame['peak'] = peak = max(frame['peak'],
+                                       tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            _state['records'].append({
+                'stage': name, 'path': path, 'wall_s': wall,
+                'self_s': wall - frame['child_time'],
+                'peak_mb': peak / 2 ** 20, 'rows': frame['rows'],
+                'n_iter': frame['n_iter'], 'time': time.time()})
+        add_to_totals(path, wall, wall - frame['child_time'], frame)
+
+
+def add_to_totals(path, wall, self_time, frame):
+    totals = _state['totals'].setdefault(path, {
+        'path': path, 'calls': 0, 'wall_s': 0., 'self_s': 0., 'peak_mb': 0.,
+        'rows': 0, 'n_iter': 0})
+    totals['calls'] += 1
+    totals['wall_s'] += wall
+    totals['self_s'] += self_time
+    totals['peak_mb'] = max(totals['peak_mb'], frame['peak'] / 2 ** 20)
+    totals['rows'] += frame['rows'] or 0
+    totals['n_iter'] += frame['n_iter'] or 0
+
+
+def get_rows(result, args):
+    for obj in [result] + list(args):
+        if isinstance(obj, pd.DataFrame):
+            return len(obj)
+    return None
+
+
+def get_n_iter(result):
+    if isinstance(result, dict):
+        return result.get('n_iter')
+    return None
+
+
+def get_summary():
+    return pd.DataFrame(list(_state['totals'].values()),
+                        columns=['path', 'calls', 'wall_s', 'self_s',
+                                 'peak_mb', 'rows', 'n_iter'])
+
+
+def write_report(out_prefix='profile_report'):
+    '''
+    Saves the JSON/CSV run report and the folded stacks (see above) and
+        returns the summary per stage
+    '''
+    df_summary = get_summary()
+    with open(f'{out_prefix}.json', 'w') as f:
+        json.dump({'records': _state['records'],
+                   'summary': df_summary.to_dict(orient='records')}, f,
+                  indent=1, default=str)
+    df_summary.to_csv(f'{out_prefix}.csv', index=False)
+    with open(f'{out_prefix}.folded', 'w') as f:
+        for totals in _state['totals'].values():
+            f.write(f'{totals["path"]} {round(totals["self_s"] * 1e6)}\n')
+    print(df_summary.to_string(index=False))
+    return df_summary
+
+
+if __name__ == '__main__':
+    # Profiles the expectation processing and do_lmer(...) fit of Study 2
+    import profiling  # the instance the decorated modules use
+    profiling.enable()
+    from Main_process_data_expectations import proc_data
+    from SuppMat_delay_discount import do_lmer
+    df = proc_data(2)
+    do_lmer(df)
+    profiling.write_report()
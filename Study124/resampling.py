@@ -0,0 +1,290 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+try:
+    from fit_cache import fit_lmer, get_model_frame
+    from model_backends import get_backend
+except ImportError:  # imported from the repo root, e.g., by Study3
+    from Study124.fit_cache import fit_lmer, get_model_frame
+    from Study124.model_backends import get_backend
+
+'''
+Resampling inference for log-likelihood differences (ΔlogLik) between a base
+    model and a model with added predictors, e.g., the Table 1 comparisons of
+    herrmann_lmer.py. Two methods are supported:
+    - 'bootstrap': clusters (e.g., participants, sn/id) are drawn with
+        replacement. A cluster drawn more than once is relabeled each time so
+        that the random effects treat the copies as different clusters.
+        Gives a percentile CI for ΔlogLik.
+    - 'permutation': the added predictors (permute_cols) are shuffled, within
+        cluster by default, which gives the null distribution of ΔlogLik
+        and a p-value for the observed ΔlogLik.
+Replicate i always draws from the i-th child of np.random.SeedSequence(seed),
+    so the replicates do not depend on the number of workers or on the batch
+    size. Batches of replicates are fit in parallel, and, if checkpoint_fp is
+    given, every finished replicate is appended to that file (JSON lines).
+    Rerunning with the same settings resumes from it, and n_reps can be
+    raised to extend an earlier run.
+In permutation mode, the base model is only refit if it uses one of the
+    permuted columns. Otherwise its logLik is the same on every replicate,
+    and the observed one is reused.
+run_replicates(...) is the engine behind resample_delta_loglik(...) and can
+    run other per-replicate statistics (e.g., the per-city comparisons of
+    herrmann_lmer.resample_city_p_higher(...)). The bootstrap can also draw
+    clusters within strata (e.g., participants within cities), which keeps
+    the number of clusters of every stratum.
+'''
+
+
+def resample_delta_loglik(df, formula_base, formula_full, cluster='sn',
+                          method='bootstrap', permute_cols=None,
+                          within_cluster=True, n_reps=1000, seed=0,
+                          family='gaussian', REML=False, control='',
+                          backend=None, n_workers=None, batch_size=10,
+                          checkpoint_fp=None):
+    '''
+    Returns a dict with the observed ΔlogLik (full - base), the replicate
+        ΔlogLiks (in replicate order, NaN where a fit failed), the number of
+        replicates that did not converge and, for method='bootstrap', the 95%
+        percentile CI or, for method='permutation', the p-value.
+    '''
+    if method == 'permutation' and not permute_cols:
+        raise ValueError('permute_cols must be given for method=permutation')
+    backend = get_backend(backend)
+    df = get_model_frame(f'{formula_base} {formula_full}', df)
+    settings = {'formula_base': formula_base, 'formula_full': formula_full,
+                'cluster': cluster, 'method': method,
+                'permute_cols': permute_cols, 'within_cluster': within_cluster,
+                'seed': seed, 'family': family, 'REML': REML,
+                'control': control, 'backend': backend.name}
+    fit_kwargs = {'family': family, 'REML': REML, 'control': control,
+                  'backend': backend}
+    fit_base = fit_lmer(formula_base, df, **fit_kwargs)
+    fit_full = fit_lmer(formula_full, df, **fit_kwargs)
+    observed = fit_full['logLike'] - fit_base['logLike']
+
+    base_cols = get_model_frame(formula_base, df.head(0)).columns
+    reuse_base = method == 'permutation' and \
+        not set(permute_cols) & set(base_cols)
+    done = run_replicates(
+        df, settings, _fit_delta_replicate, n_reps, fit_kwargs,
+        n_workers=n_workers, batch_size=batch_size,
+        checkpoint_fp=checkpoint_fp, desc=f'{method} ΔlogLik',
+        starts=(fit_base, fit_full) if backend.supports_start else
+               (None, None),
+        base_logLike=fit_base['logLike'] if reuse_base else None)
+
+    deltas = np.array([done[i]['delta'] for i in range(n_reps)])
+    out = {'observed': observed,
+           'replicates': deltas,
+           'n_not_converged': sum(not done[i]['converged']
+                                  for i in range(n_reps))}
+    valid = deltas[~np.isnan(deltas)]
+    if method == 'bootstrap':
+        out['ci'] = tuple(np.percentile(valid, [2.5, 97.5]))
+    else:
+        out['p'] = (1 + np.sum(valid >= observed)) / (1 + len(valid))
+    return out
+
+
+def run_replicates(df, settings, replicate_fn, n_reps, fit_kwargs,
+                   n_workers=None, batch_size=10, checkpoint_fp=None,
+                   desc='replicates', **job):
+    '''
+    Runs replicate_fn(df_i, job) on replicates 0..n_reps-1 of df (see
+        get_replicate_df(...)) in batches, in a pool of n_workers processes,
+        checkpointing every finished batch. replicate_fn, a module-level
+        function, returns a JSON-serializable dict. job holds settings,
+        fit_kwargs and the extra keyword arguments. Returns {rep: record}.
+    '''
+    done = load_checkpoint(checkpoint_fp, settings, df)
+    todo = [i for i in range(n_reps) if i not in done]
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    job = {'df': df, 'settings': settings, 'fit_kwargs': fit_kwargs,
+           'replicate_fn': replicate_fn, **job}
+    with tqdm(total=n_reps, initial=n_reps - len(todo), desc=desc) as pbar:
+        if n_workers == 1:
+            _init_resample_worker(job)
+            batch_results = map(_fit_replicates, batches)
+            for reps in batch_results:
+                save_replicates(checkpoint_fp, reps, done)
+                pbar.update(len(reps))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers,
+                                     initializer=_init_resample_worker,
+                                     initargs=(job,)) as pool:
+                futures = [pool.submit(_fit_replicates, batch)
+                           for batch in batches]
+                for future in as_completed(futures):
+                    reps = future.result()
+                    save_replicates(checkpoint_fp, reps, done)
+                    pbar.update(len(reps))
+    return done
+
+
+def get_replicate_rng(seed, i):
+    '''
+    The generator of replicate i: depends only on seed and i
+    '''
+    return np.random.default_rng(np.random.SeedSequence(seed,
+                                                        spawn_key=(i,)))
+
+
+def bootstrap_clusters(df, cluster, rng, strata=None):
+    '''
+    Draws len(clusters) clusters with replacement. Each draw gets its own
+        label in the cluster column (0, 1, ...), so duplicates stay separate.
+        With strata (a column), the clusters of each stratum are drawn from
+        that stratum only.
+    '''
+    if strata is not None:
+        parts = []
+        n_labels = 0
+        for _, df_stratum in df.groupby(strata, sort=True):
+            df_boot = bootstrap_clusters(df_stratum, cluster, rng)
+            df_boot[cluster] += n_labels
+            n_labels = df_boot[cluster].max() + 1
+            parts.append(df_boot)
+        return pd.concat(parts, ignore_index=True)
+    codes, uniques = pd.factorize(df[cluster], sort=True)
+    order = np.argsort(codes, kind='stable')
+    starts = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    draws = rng.integers(len(uniques), size=len(uniques))
+    sizes = starts[draws + 1] - starts[draws]
+    rows = np.concatenate([order[starts[c]:starts[c + 1]] for c in draws])
+    df_boot = df.iloc[rows].reset_index(drop=True)
+    df_boot[cluster] = np.repeat(np.arange(len(draws)), sizes)
+    return df_boot
+
+
+def permute_predictors(df, cols, cluster, rng, within_cluster=True):
+    '''
+    Shuffles the rows of cols (jointly), within each cluster or overall
+    '''
+    df_perm = df.reset_index(drop=True)
+    if within_cluster:
+        codes = pd.factorize(df_perm[cluster])[0]
+        by_cluster = np.argsort(codes, kind='stable')
+        shuffled = np.lexsort((rng.random(len(df_perm)), codes))
+        source = np.empty(len(df_perm), dtype=np.int64)
+        source[by_cluster] = shuffled
+    else:
+        source = rng.permutation(len(df_perm))
+    for col in cols:
+        df_perm[col] = df_perm[col].to_numpy()[source]
+    return df_perm
+
+
+def get_replicate_df(df, settings, i):
+    rng = get_replicate_rng(settings['seed'], i)
+    if settings['method'] == 'bootstrap':
+        return bootstrap_clusters(df, settings['cluster'], rng,
+                                  settings.get('strata'))
+    return permute_predictors(df, settings['permute_cols'],
+                              settings['cluster'], rng,
+                              settings['within_cluster'])
+
+
+_resample_job = {}  # filled in each worker by _init_resample_worker(...)
+
+
+def _init_resample_worker(job):
+    _resample_job.update(job)
+    pd.options.mode.chained_assignment = None
+    if job['fit_kwargs']['backend'].name == 'pymer4':
+        import pymer4.models  # imported once per worker, see model_backends.py
+
+
+def _fit_replicates(batch):
+    df, settings = _resample_job['df'], _resample_job['settings']
+    reps = []
+    for i in batch:
+        df_i = get_replicate_df(df, settings, i)
+        reps.append({'rep': i,
+                     **_resample_job['replicate_fn'](df_i, _resample_job)})
+    return reps
+
+
+def _fit_delta_replicate(df_i, job):
+    settings = job['settings']
+    logLikes = []
+    converged = True
+    for formula, start in zip([settings['formula_base'],
+                               settings['formula_full']], job['starts']):
+        if formula == settings['formula_base'] and \
+                job['base_logLike'] is not None:
+            logLikes.append(job['base_logLike'])  # unchanged by permutation
+            continue
+        result = _fit_replicate(formula, df_i, start)
+        logLikes.append(result['logLike'])
+        converged &= bool(result.get('converged', True))
+    return {'delta': logLikes[1] - logLikes[0], 'converged': converged}
+
+
+def _fit_replicate(formula, df, start):
+    # Replicates are not cached: thousands of one-off fits would only evict
+    #   the fits worth keeping
+    kwargs = dict(_resample_job['fit_kwargs'], use_cache=False)
+    if start is not None:
+        try:  # warm start from the fit to the original data
+            return fit_lmer(formula, df, start=start, **kwargs)
+        except (ValueError, np.linalg.LinAlgError):
+            pass  # e.g., a factor level is missing from the resample
+    try:
+        return fit_lmer(formula, df, **kwargs)
+    except (ValueError, np.linalg.LinAlgError) as e:
+        print(f'Replicate fit failed: {e}')
+        return {'logLike': np.nan, 'converged': False}
+
+
+def get_checkpoint_key(settings, df):
+    h = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def load_checkpoint(checkpoint_fp, settings, df):
+    '''
+    Returns {rep: replicate} for the replicates saved in checkpoint_fp. A new
+        checkpoint is started (with a header line holding the settings key)
+        if the file does not exist.
+    '''
+    if checkpoint_fp is None:
+        return {}
+    key = get_checkpoint_key(settings, df)
+    if not os.path.exists(checkpoint_fp):
+        with open(checkpoint_fp, 'w') as f:
+            f.write(json.dumps({'key': key, 'settings': settings}) + '\n')
+        return {}
+    with open(checkpoint_fp) as f:
+        lines = f.read().split('\n')
+    header = json.loads(lines[0])
+    if header['key'] != key:
+        raise ValueError(f'{checkpoint_fp} was written with different '
+                         f'settings or data: {header["settings"]}')
+    if lines[-1]:  # a line cut off by an interruption, which is dropped
+        with open(checkpoint_fp, 'w') as f:
+            f.write('\n'.join(lines[:-1]) + '\n')
+    done = {}
+    for line in lines[1:-1]:
+        rep = json.loads(line)
+        done[rep['rep']] = rep
+    return done
+
+
+def save_replicates(checkpoint_fp, reps, done):
+    for rep in reps:
+        done[rep['rep']] = rep
+    if checkpoint_fp is None:
+        return
+    with open(checkpoint_fp, 'a') as f:
+        for rep in reps:
+            f.write(json.dumps(rep) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
@@ -0,0 +1,316 @@
+import argparse
+import hashlib
+import os
+import re
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from multiprocessing import AuthenticationError, resource_tracker, \
+    shared_memory
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+import pandas as pd
+
+try:
+    from data_store import file_lock
+    from model_backends import get_backend
+except ImportError:  # imported from the repo root, e.g., by Study3
+    from Study124.data_store import file_lock
+    from Study124.model_backends import get_backend
+
+'''
+A long-lived local service that keeps R (with lme4, lmerTest and optimx)
+    loaded, so that scripts fitting lme4 models don't each pay the pymer4/rpy2
+    start-up cost. Start it once with
+        python rworker.py serve
+    and fit through it with the 'rworker' backend (e.g., LMER_BACKEND=rworker,
+    see model_backends.py), which starts the service itself if it is not
+    running yet. python rworker.py stop shuts it down.
+The service listens on a local socket (a Unix socket in the temporary
+    directory, or a named pipe on Windows; RWORKER_ADDRESS can set another,
+    including host:port) and only accepts clients that know the key in
+    ~/.rworker_key (or RWORKER_AUTHKEY), which is created on first use. Each
+    request is a dict sent with multiprocessing.connection: a fit request
+    holds the formula, family, REML and control string plus the model frame.
+    The numeric columns of frames over SHM_MIN_BYTES are passed through
+    shared memory rather than through the socket. The reply holds the fit
+    result of the service's backend (Pymer4Backend by default), i.e., the
+    logLike, coefs and warnings, or the error the fit raised.
+R is single-threaded, so the service runs one fit at a time. Clients that
+    connect while it is busy (e.g., the workers of a process pool) wait their
+    turn.
+'''
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+KEY_FP = os.path.join(os.path.expanduser('~'), '.rworker_key')
+LOG_FP = os.path.join(tempfile.gettempdir(), 'rworker.log')
+SHM_MIN_BYTES = 2 ** 20  # smaller frames are simply sent through the socket
+
+
+def get_address(address=None):
+    address = address or os.environ.get('RWORKER_ADDRESS')
+    if address is None:
+        if sys.platform == 'win32':
+            return r'\\.\pipe\rworker'
+        return os.path.join(tempfile.gettempdir(),
+                            f'rworker-{os.getuid()}.sock')
+    if isinstance(address, str) and re.fullmatch(r'[\w.-]+:\d+', address):
+        host, port = address.split(':')
+        return host, int(port)
+    return address
+
+
+def get_authkey():
+    if os.environ.get('RWORKER_AUTHKEY'):
+        return os.environ['RWORKER_AUTHKEY'].encode()
+    if not os.path.exists(KEY_FP):
+        fd = os.open(KEY_FP, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+    with open(KEY_FP) as f:
+        return f.read().strip().encode()
+
+
+def pack_frame(df):
+    '''
+    Returns the payload describing df and the shared memory block holding its
+        numeric columns (None if df is sent as is). The caller unlinks the
+        block once the reply is in.
+    '''
+    numeric = [col for col in df.columns
+               if pd.api.types.is_numeric_dtype(df[col]) and
+               not isinstance(df[col].dtype, pd.CategoricalDtype)]
+    arrays = {col: np.ascontiguousarray(df[col].to_numpy()) for col in numeric}
+    n_bytes = sum(a.nbytes for a in arrays.values())
+    if n_bytes < SHM_MIN_BYTES:
+        return {'df': df}, None
+    shm = shared_memory.SharedMemory(create=True, size=n_bytes)
+    layout = []
+    offset = 0
+    for col, a in arrays.items():
+        shm.buf[offset:offset + a.nbytes] = a.view(np.uint8).reshape(-1)
+        layout.append((col, a.dtype.str, offset, len(a)))
+        offset += a.nbytes
+    payload = {'shm': shm.name, 'layout': layout,
+               'df_other': df.drop(columns=numeric),
+               'columns': list(df.columns), 'index': df.index}
+    return payload, shm
+
+
+def unpack_frame(payload):
+    if 'df' in payload:
+        return payload['df']
+    shm = attach_shared_memory(payload['shm'])
+    try:
+        data = {col: np.ndarray(n, dtype=np.dtype(dtype), buffer=shm.buf,
+                                offset=offset).copy()
+                for col, dtype, offset, n in payload['layout']}
+    finally:
+        shm.close()
+    df = pd.DataFrame(data, index=payload['index'])
+    for col in payload['df_other'].columns:
+        df[col] = payload['df_other'][col]
+    return df[payload['columns']]
+
+
+def attach_shared_memory(name):
+    '''
+    Attaches to a client's block without registering it with this process's
+        resource tracker, which would otherwise unlink it (again) when the
+        service exits
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def load_R(backend):
+    if backend.name != 'pymer4':
+        return
+    import pymer4.models  # loads R, lme4 and lmerTest
+    from rpy2.robjects.packages import importr
+    try:
+        importr('optimx')
+    except Exception as e:  # the fits that don't use optimx still work
+        print(f'Could not load optimx: {e}')
+
+
+def serve(address=None, backend='pymer4'):
+    '''
+    Runs the service until it receives a shutdown request
+    '''
+    address = get_address(address)
+    backend = get_backend(backend)
+    t0 = time.perf_counter()
+    load_R(backend)
+    print(f'Loaded {backend.name} in {time.perf_counter() - t0:.1f} s',
+          flush=True)
+    pd.options.mode.chained_assignment = None
+    if is_running(address):  # e.g., started meanwhile by another client
+        raise RuntimeError(f'An rworker is already running at {address}')
+    if isinstance(address, str) and os.path.exists(address):
+        os.unlink(address)  # left behind by a service that crashed
+    status = {'backend': backend.name, 'pid': os.getpid(), 'n_fits': 0}
+    with Listener(address, authkey=get_authkey(), backlog=64) as listener:
+        print(f'rworker listening on {listener.address}', flush=True)
+        while True:
+            try:
+                with listener.accept() as conn:
+                    if not handle_request(conn, backend, status):
+                        break
+            except (OSError, EOFError, AuthenticationError) as e:
+                # a client that failed to authenticate or went away
+                print(f'Dropped a connection: {e!r}', flush=True)
+    print('rworker stopped', flush=True)
+
+
+def handle_request(conn, backend, status):
+    '''
+    Answers one request. Returns False if the service should stop.
+    '''
+    request = conn.recv()
+    if request['cmd'] == 'shutdown':
+        conn.send({'ok': True})
+        return False
+    if request['cmd'] == 'ping':
+        conn.send({'ok': True, **status})
+    elif request['cmd'] == 'fit':
+        conn.send(run_fit(request, backend))
+        status['n_fits'] += 1
+    else:
+        conn.send({'ok': False, 'error': f'Unknown request: {request["cmd"]}'})
+    return True
+
+
+def run_fit(request, backend):
+    t0 = time.perf_counter()
+    try:
+        df = unpack_frame(request['data'])
+        result = backend.fit(request['formula'], df, family=request['family'],
+                             REML=request['REML'], control=request['control'])
+    except Exception as e:
+        print(f'Fit failed: {request["formula"]}: {e!r}', flush=True)
+        return {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+    print(f'{time.perf_counter() - t0:.2f} s: {request["formula"]} '
+          f'({len(df)} rows)', flush=True)
+    return {'ok': True, 'result': result}
+
+
+def send_request(request, address=None):
+    with Client(get_address(address), authkey=get_authkey()) as conn:
+        conn.send(request)
+        reply = conn.recv()
+    if not reply['ok']:
+        raise RuntimeError(f'rworker: {reply["error"]}')
+    return reply
+
+
+def is_running(address=None):
+    try:
+        send_request({'cmd': 'ping'}, address)
+        return True
+    except (OSError, EOFError, AuthenticationError):
+        return False
+
+
+def fit_remote(formula, df, family='gaussian', REML=True, control='',
+               address=None):
+    '''
+    Fits formula to df in the service and returns the fit result
+    '''
+    payload, shm = pack_frame(df)
+    try:
+        reply = send_request({'cmd': 'fit', 'formula': formula,
+                              'family': family, 'REML': REML,
+                              'control': control, 'data': payload}, address)
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    return reply['result']
+
+
+def start_server(address=None, backend='pymer4', timeout=300):
+    '''
+    Starts the service in the background (logging to LOG_FP) and waits until
+        it accepts requests
+    '''
+    address = get_address(address)
+    cmd = [sys.executable, os.path.join(DIR, 'rworker.py'), 'serve',
+           '--address', ':'.join(map(str, address))
+                        if isinstance(address, tuple) else address,
+           '--backend', backend]
+    kwargs = {'creationflags': subprocess.DETACHED_PROCESS} \
+        if sys.platform == 'win32' else {'start_new_session': True}
+    print(f'Starting rworker (log: {LOG_FP})...')
+    with open(LOG_FP, 'a') as log:
+        process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL, **kwargs)
+    t0 = time.perf_counter()
+    while not is_running(address):
+        if process.poll() is not None:
+            raise RuntimeError(f'rworker exited, see {LOG_FP}')
+        if time.perf_counter() - t0 > timeout:
+            raise TimeoutError(f'rworker did not start within {timeout} s')
+        time.sleep(.2)
+
+
+def ensure_server(address=None, backend='pymer4'):
+    '''
+    Starts the service unless it is running. Clients that find it missing at
+        the same time (e.g., the workers of a process pool) take turns, so
+        only the first starts it and the others then find it running.
+    '''
+    if is_running(address):
+        return
+    with startup_lock(address):
+        if not is_running(address):
+            start_server(address, backend)
+
+
+@contextmanager
+def startup_lock(address=None):
+    '''
+    An exclusive lock (a locked file in the temporary directory) per address
+    '''
+    name = hashlib.sha256(repr(get_address(address)).encode()).hexdigest()
+    with file_lock(os.path.join(tempfile.gettempdir(),
+                                f'rworker-{name[:16]}.lock')):
+        yield
+
+
+def stop_server(address=None):
+    if is_running(address):
+        send_request({'cmd': 'shutdown'}, address)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='A persistent R/lme4 worker (see rworker.py)')
+    parser.add_argument('cmd', choices=['serve', 'start', 'stop', 'status'])
+    parser.add_argument('--address', default=None)
+    parser.add_argument('--backend', default='pymer4',
+                        help='the backend that runs the fits')
+    args = parser.parse_args(argv)
+
+    if args.cmd == 'serve':
+        serve(args.address, args.backend)
+    elif args.cmd == 'start':
+        ensure_server(args.address, args.backend)
+    elif args.cmd == 'stop':
+        stop_server(args.address)
+    elif is_running(args.address):
+        print(send_request({'cmd': 'ping'}, args.address))
+    else:
+        print(f'No rworker at {get_address(args.address)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+import argparse
+import os
+import sqlite3
+import time
+from concurrent.futures import as_completed
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from model_backends import get_backend
+from SuppMat_delay_discount import _fit_delay_path, finish_delay_plot, \
+    get_data_key, open_sweep_pool, plot_delay_stats, prepare_sweep_data, \
+    split_delay_path
+
+'''
+Resumable sweeps of the delay discount model (see SuppMat_delay_discount.py)
+    over the grid decay x depth x reset_on_block x both_E x study. Every
+    finished fit is written at once to a local SQLite database (DB_FP by
+    default): its logLike, convergence, warnings, optimizer iterations and
+    runtime in the fits table, and its coefficients (estimates, SEs, Z-stats
+    and p-values) in the coefs table. A fit is identified by its settings and
+    the model backend, and run_sweep(...) skips the fits already in the
+    database, so an interrupted sweep picks up where it stopped when it is
+    rerun, and the grid can be extended later (e.g., with another depth).
+The sweep runs one (study, reset_on_block, depth) at a time, as each needs
+    its own expectations (see prepare_sweep_data(...)), which are computed
+    only for the decays still missing. plot_sweep(...) draws
+    delay_discount_analysis(...)'s plot from the database, and
+    get_best_decays(...) finds the best decay per setting with one query.
+'''
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+DB_FP = os.path.join(DIR, 'sweep_results.sqlite')
+
+KEY_COLS = ['study', 'decay', 'depth', 'reset_on_block', 'both_E', 'backend']
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS fits (
+    study INTEGER, decay REAL, depth INTEGER, reset_on_block INTEGER,
+    both_E INTEGER, backend TEXT,
+    logLike REAL, converged INTEGER, warnings TEXT, n_iter INTEGER,
+    warm_started INTEGER, runtime_s REAL, finished TEXT,
+    PRIMARY KEY ({', '.join(KEY_COLS)}));
+CREATE TABLE IF NOT EXISTS coefs (
+    study INTEGER, decay REAL, depth INTEGER, reset_on_block INTEGER,
+    both_E INTEGER, backend TEXT,
+    term TEXT, estimate REAL, se REAL, z REAL, p REAL,
+    PRIMARY KEY ({', '.join(KEY_COLS)}, term));
+'''
+
+
+def open_store(db_fp=DB_FP):
+    con = sqlite3.connect(db_fp)
+    con.execute('PRAGMA journal_mode=WAL')  # the store can be read mid-sweep
+    con.executescript(SCHEMA)
+    return con
+
+
+def get_sweep_jobs(studies=(2, 4), decays=np.linspace(.01, .99, 99),
+                   depths=(400,), reset_on_blocks=(False, True),
+                   both_Es=(True, False)):
+    '''
+    The (study, delay, both_E, reset_on_block, depth) jobs of the grid, with
+        the decays of each model contiguous (see split_delay_path(...))
+    '''
+    return [(study, round(float(decay), 6), both_E, reset_on_block, depth)
+            for study in studies for reset_on_block in reset_on_blocks
+            for depth in depths for both_E in both_Es for decay in decays]
+
+
+def get_key(job, backend_name):
+    study, decay, both_E, reset_on_block, depth = job
+    return int(study), round(float(decay), 6), int(depth), \
+        int(reset_on_block), int(both_E), backend_name
+
+
+def get_done_keys(con, backend_name):
+    rows = con.execute(f'SELECT {", ".join(KEY_COLS)} FROM fits '
+                       f'WHERE backend = ?', (backend_name,))
+    return set(rows)
+
+
+def save_fit(con, job, result, backend_name):
+    '''
+    Writes a fit and its coefficients in one transaction
+    '''
+    key = get_key(job, backend_name)
+    coefs = result['coefs']
+    n_iter = result.get('n_iter')
+    stat = coefs['Z-stat'] if 'Z-stat' in coefs else coefs['T-stat']
+    with con:
+        con.execute(
+            'INSERT OR REPLACE INTO fits VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            key + (float(result['logLike']),
+                   int(result.get('converged', not result['warnings'])),
+                   '\n'.join(map(str, result['warnings'])),
+                   None if n_iter is None else int(n_iter),
+                   int(result.get('warm_started', False)),
+                   result.get('runtime'), time.strftime('%Y-%m-%d %H:%M:%S')))
+        con.executemany(
+            'INSERT OR REPLACE INTO coefs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [key + (term, float(coefs.loc[term, 'Estimate']),
+                    float(coefs.loc[term, 'SE']), float(stat[term]),
+                    float(coefs.loc[term, 'P-val']))
+             for term in coefs.index])
+
+
+def run_sweep(studies=(2, 4), decays=np.linspace(.01, .99, 99),
+              depths=(400,), reset_on_blocks=(False, True),
+              both_Es=(True, False), db_fp=DB_FP, n_workers=None,
+              backend=None, warm_start=False):
+    '''
+    Fits every job of the grid that is not yet in the database, saving each
+        fit as soon as it finishes. With warm_start, the fits along the
+        decays of a model start from the previous fit (see
+        run_delay_sweep(...)), and a path's fits are saved once the whole
+        path is done. Returns the fits table of the grid.
+    '''
+    pd.options.mode.chained_assignment = None
+    backend = get_backend(backend)
+    n_workers = n_workers or os.cpu_count()
+    con = open_store(db_fp)
+    jobs = get_sweep_jobs(studies, decays, depths, reset_on_blocks, both_Es)
+    done = get_done_keys(con, backend.name)
+    todo = [job for job in jobs if get_key(job, backend.name) not in done]
+    print(f'{len(jobs) - len(todo)} of {len(jobs)} fits already in {db_fp}')
+
+    for data_key in dict.fromkeys(map(get_data_key, todo)):
+        data_jobs = [job for job in todo if get_data_key(job) == data_key]
+        if warm_start:
+            paths = split_delay_path(data_jobs, n_workers)
+        else:
+            paths = [[job] for job in data_jobs]
+        study, reset_on_block, depth = data_key
+        desc = f'Study {study} | {reset_on_block=} | {depth=}'
+        with open_sweep_pool(prepare_sweep_data(data_jobs), n_workers,
+                             backend) as executor:
+            futures = {executor.submit(_fit_delay_path, path): path
+                       for path in paths}
+            for future in tqdm(as_completed(futures), total=len(futures),
+                               desc=desc):
+                for job, result in zip(futures[future], future.result()):
+                    save_fit(con, job, result, backend.name)
+    df = query_fits(con, backend=backend.name, study=studies, depth=depths)
+    con.close()
+    return df
+
+
+def query_fits(con=DB_FP, **filters):
+    '''
+    The fits table (as a dataframe) filtered by settings, e.g.,
+        query_fits(study=2, depth=400). A filter given as a list or tuple
+        (study=(2, 4)) matches any of its values. con can be a connection or
+        a database path.
+    '''
+    return query_table(con, 'fits', filters)
+
+
+def query_coefs(con=DB_FP, **filters):
+    '''
+    The coefs table, filtered like query_fits(...)
+    '''
+    return query_table(con, 'coefs', filters)
+
+
+def query_table(con, table, filters):
+    if isinstance(con, str):
+        with closing(sqlite3.connect(con)) as con:
+            return query_table(con, table, filters)
+    where = []
+    params = []
+    for name, value in filters.items():
+        if name not in KEY_COLS:
+            raise ValueError(f'Unknown filter: {name} (use {KEY_COLS})')
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, np.ndarray)):
+            where.append(f'{name} IN ({", ".join("?" * len(value))})')
+            params += [to_sql_value(v) for v in value]
+        else:
+            where.append(f'{name} = ?')
+            params.append(to_sql_value(value))
+    sql = f'SELECT * FROM {table}'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += f' ORDER BY {", ".join(KEY_COLS)}'
+    return pd.read_sql_query(sql, con, params=params)
+
+
+def to_sql_value(value):
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def get_best_decays(con=DB_FP, backend=None):
+    '''
+    The decay with the highest logLike for every (study, depth,
+        reset_on_block, both_E, backend)
+    '''
+    if isinstance(con, str):
+        with closing(sqlite3.connect(con)) as con:
+            return get_best_decays(con, backend)
+    sql = '''
+        SELECT study, depth, reset_on_block, both_E, backend, decay, logLike,
+               n_fits
+        FROM (SELECT *, ROW_NUMBER() OVER win AS rank,
+                     COUNT(*) OVER (PARTITION BY study, depth, reset_on_block,
+                                                 both_E, backend) AS n_fits
+              FROM fits
+              WINDOW win AS (PARTITION BY study, depth, reset_on_block,
+                                          both_E, backend
+                             ORDER BY logLike DESC))
+        WHERE rank = 1'''
+    params = []
+    if backend is not None:
+        sql += ' AND backend = ?'
+        params.append(backend)
+    return pd.read_sql_query(sql, con, params=params)
+
+
+def plot_sweep(study, both_E=True, reset_on_block=False, depth=400,
+               backend=None, db_fp=DB_FP):
+    '''
+    delay_discount_analysis(...)'s plot, drawn from the fits in the database
+    '''
+    backend = backend or get_backend(backend).name
+    filters = {'study': study, 'both_E': both_E,
+               'reset_on_block': reset_on_block, 'depth': depth,
+               'backend': backend}
+    with closing(sqlite3.connect(db_fp)) as con:
+        df_fits = query_fits(con, **filters)
+        df_coefs = query_coefs(con, **filters)
+    if not len(df_fits):
+        print(f'No fits in {db_fp} for {filters}')
+        return
+    df_coefs = df_coefs.rename(columns={'estimate': 'Estimate', 'se': 'SE',
+                                        'z': 'Z-stat', 'p': 'P-val'})
+    coefs_by_decay = dict(list(df_coefs.groupby('decay')))
+    for row in df_fits.itertuples():
+        coefs = coefs_by_decay[row.decay].set_index('term')
+        plot_delay_stats(row.decay, row.logLike, coefs)
+    finish_delay_plot(list(df_fits['logLike']),
+                      f'Study {study} | {both_E=} | {reset_on_block=} | '
+                      f'{depth=}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Resumable delay discount sweeps (see sweep_store.py)')
+    parser.add_argument('--studies', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--n-decays', type=int, default=99,
+                        help='decays evenly spaced over [.01, .99]')
+    parser.add_argument('--depths', type=int, nargs='+', default=[400])
+    parser.add_argument('--reset-on-block', type=int, nargs='+',
+                        default=[0, 1], choices=[0, 1])
+    parser.add_argument('--both-E', type=int, nargs='+', default=[1, 0],
+                        choices=[0, 1])
+    parser.add_argument('--db', default=DB_FP)
+    parser.add_argument('--n-workers', type=int, default=None)
+    parser.add_argument('--backend', default=None)
+    parser.add_argument('--warm-start', action='store_true')
+    args = parser.parse_args(argv)
+
+    run_sweep(args.studies, np.linspace(.01, .99, args.n_decays),
+              args.depths, [bool(r) for r in args.reset_on_block],
+              [bool(b) for b in args.both_E], db_fp=args.db,
+              n_workers=args.n_workers, backend=args.backend,
+              warm_start=args.warm_start)
+    print(get_best_decays(args.db, get_backend(args.backend).name)
+          .to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.special import expit
+
+from data_store import write_csv_chunks
+from Main_process_data_expectations import add_lag_features
+
+'''
+Generates synthetic datasets with the schema of the raw data, for testing how
+    the processing and modeling scale past the shipped data (~32k rows):
+    - generate_UG_chunks(...): Ultimatum Game data laid out like
+        UG_data/RoleChange_Study{2,4}_anonymized.csv
+    - generate_PGG_chunks(...): public goods game data laid out like the raw
+        Herrmann et al. (2008) data (PGG_data/Herrmann_Data.csv), three rows
+        per subject and period (one per other group member)
+Both yield dataframes of chunk_size participants (or groups) at a time, so
+    memory stays bounded however large the dataset is, and
+    data_store.write_csv_chunks(...) appends the chunks to a .csv. Participant
+    (group) i is always generated from its own seeded generator, so the data
+    does not depend on the chunk size.
+
+In the UG data, the computer partner plays one of the STRATEGIES, which
+    set what it proposes when the participant is the responder (role 'r')
+    and whether it accepts the participant's proposals (role 'p'):
+    - 'generous' / 'selfish': takes little / a lot and mostly accepts /
+        rejects
+    - 'reciprocity': takes what the participant took in their last proposal
+        and accepts proposals that take no more than it last took
+    - 'anti_reciprocity': the opposite of reciprocity
+    - 'control' / 'replication': takes 5-9 uniformly at random and accepts
+        depending on the take
+Participants propose and rate offers based on the offers they received so
+    far in the block, so E_p and E_r carry signal. With missing_frac, trials
+    time out (no take or rating), as in the real data.
+
+write_synthetic_data(out_dir, ...) writes RoleChange_Study{2,4}_anonymized.csv
+    and Herrmann_Data.csv to out_dir, which proc_data(...),
+    process_PGG_data(...) and the pipeline (--data-dir) take as data_dir.
+'''
+
+UG_RESPONSE_COLS = ['subjectTake', 'response_bool', 'proposerTake',
+                    'subject_response', 'subject_response_bool']
+UG_COLS = {2: ['condition', 'id', 'excluded', 'block_number', 'role'] +
+              UG_RESPONSE_COLS +
+              [f'prev_{col}' for col in UG_RESPONSE_COLS] +
+              [f'prev_prev_{col}' for col in UG_RESPONSE_COLS] +
+              ['deception', 'deception_scale']}
+UG_COLS[4] = UG_COLS[2][:1] + ['invest', 'payout', 'payout_r', 'payout_p'] + \
+             UG_COLS[2][1:]
+PGG_COLS = ['subjectid', 'groupid', 'city', 'period', 'p',
+            'otherscontribution', 'punishment', 'senderscontribution',
+            'recpun', 'female', 'age']
+
+# (intercept, slope) of the logit of the partner accepting a take of 5-9,
+#   for the strategies that do not depend on history
+STRATEGIES = {'generous': {'take': (5, 6), 'accept': (2., -.5)},
+              'selfish': {'take': (8, 9), 'accept': (-1., -1.)},
+              'control': {'take': (5, 9), 'accept': (.5, -1.)},
+              'replication': {'take': (5, 9), 'accept': (.5, -1.)},
+              'reciprocity': {'take': (5, 9), 'accept': None},
+              'anti_reciprocity': {'take': (5, 9), 'accept': None}}
+CITIES = ['Boston', 'Melbourne', 'Bonn', 'Zurich', 'Samara', 'Muscat',
+          'Athens', 'Seoul', 'Chengdu', 'Riyadh', 'Istanbul', 'Minsk']
+
+
+def get_unit_rng(seed, i):
+    '''
+    The generator of participant (or group) i: depends only on seed and i
+    '''
+    return np.random.default_rng(np.random.SeedSequence(seed,
+                                                        spawn_key=(i,)))
+
+
+def generate_UG_chunks(n_participants=100, n_blocks=8, trials_per_block=16,
+                       strategies=('generous', 'selfish', 'reciprocity'),
+                       study=4, missing_frac=.05, excluded_frac=.05, seed=0,
+                       chunk_size=1000):
+    '''
+    Yields the UG data of chunk_size participants at a time. For study=4,
+        every block has its own partner strategy (cycling through strategies
+        in a random order) and ends with an investment row. For study=2,
+        each participant faces one strategy throughout, and there are no
+        invest/payout columns.
+    '''
+    unknown = set(strategies) - set(STRATEGIES)
+    if unknown:
+        raise ValueError(f'Unknown strategies: {unknown}. '
+                         f'Options: {list(STRATEGIES)}')
+    for start in range(0, n_participants, chunk_size):
+        ids = range(start, min(start + chunk_size, n_participants))
+        yield generate_UG_participants(ids, n_blocks, trials_per_block,
+                                       strategies, study, missing_frac,
+                                       excluded_frac, seed)
+
+
+def generate_UG_participants(ids, n_blocks, trials_per_block, strategies,
+                             study, missing_frac, excluded_frac, seed):
+    n, T = len(ids), trials_per_block
+    rngs = [get_unit_rng(seed, i) for i in ids]
+    # participant traits: mean take, how much they adapt to the offers they
+    #   received, rating bias
+    traits = np.array([rng.normal([7., .5, 0.], [.8, .3, .5])
+                       for rng in rngs])
+    take_mean, adapt, rating_bias = traits.T
+    # the random draws of every block and trial (done per participant)
+    U = np.array([rng.random((n_blocks, T, 6)) for rng in rngs])
+    if study == 2:
+        conds = np.array([[strategies[rng.integers(len(strategies))]] *
+                          n_blocks for rng in rngs])
+    else:
+        conds = np.array([[strategies[k % len(strategies)] for k in
+                           rng.permutation(n_blocks) + rng.integers(
+                               len(strategies))] for rng in rngs])
+    excluded = np.array([rng.random() < excluded_frac for rng in rngs],
+                        dtype=np.int64)
+    deception = np.array([rng.integers(2) for rng in rngs])
+    deception_scale = np.array([rng.integers(1, 6) for rng in rngs])
+
+    cols = {col: np.full((n, n_blocks, T), np.nan)
+            for col in UG_RESPONSE_COLS + ['invest']}
+    roles = np.where(U[..., 0] < .5, 'p', 'r')
+    idx = np.arange(n)
+    for b in range(n_blocks):
+        strategy = conds[:, b]
+        received_sum = np.zeros(n)  # the offers received so far in the block
+        received_n = np.zeros(n)
+        last_take = np.full(n, np.nan)  # the participant's last take
+        last_partner_take = np.full(n, np.nan)
+        for t in range(T):
+            u = U[:, b, t]
+            E_r = np.where(received_n > 0,
+                           received_sum / np.maximum(received_n, 1), 7.)
+            timeout = u[:, 1] < missing_frac
+            is_p = roles[:, b, t] == 'p'
+
+            # participant proposes: takes more if they have been offered less
+            take = np.clip(np.round(take_mean + adapt * (E_r - 7) +
+                                    (u[:, 2] - .5) * 2), 5, 9)
+            accept = np.zeros(n, dtype=bool)
+            for name, settings in STRATEGIES.items():
+                m = strategy == name
+                if not m.any() or settings['accept'] is None:
+                    continue
+                a, slope = settings['accept']
+                accept[m] = u[m, 3] < expit(a + slope * (take[m] - 7))
+            first = np.isnan(last_partner_take)  # nothing to reciprocate yet
+            m = strategy == 'reciprocity'
+            accept[m] = (take <= last_partner_take)[m] | first[m]
+            m = strategy == 'anti_reciprocity'
+            accept[m] = (take > last_partner_take)[m] | first[m]
+            cols['subjectTake'][is_p, b, t] = np.where(timeout, np.nan,
+                                                       take)[is_p]
+            cols['response_bool'][is_p, b, t] = (accept & ~timeout)[is_p]
+
+            # partner proposes, and the participant rates the offer
+            partner_take = np.empty(n)
+            for name, settings in STRATEGIES.items():
+                m = strategy == name
+                lo, hi = settings['take']
+                partner_take[m] = lo + np.floor(u[m, 4] * (hi - lo + 1))
+            for name, sign in [('reciprocity', 1), ('anti_reciprocity', -1)]:
+                m = (strategy == name) & ~np.isnan(last_take)
+                partner_take[m] = 7 + sign * (last_take[m] - 7)
+            rating = np.clip(np.round(.8 * (7 - partner_take) +
+                                      .5 * (E_r - partner_take) +
+                                      rating_bias + (u[:, 5] - .5) * 2),
+                             -2, 2) + 0.  # + 0. turns -0. into 0.
+            is_r = ~is_p
+            cols['proposerTake'][is_r, b, t] = partner_take[is_r]
+            cols['subject_response'][is_r, b, t] = np.where(
+                timeout, np.nan, rating)[is_r]
+
+            received_sum[is_r] += partner_take[is_r]
+            received_n[is_r] += 1
+            took = is_p & ~timeout
+            last_take[took] = take[took]
+            last_partner_take[is_r] = partner_take[is_r]
+        if study == 4:  # invest more after generous partners
+            E_r = received_sum / np.maximum(received_n, 1)
+            cols['invest'][idx, b, T - 1] = np.clip(np.round(
+                10 + 3 * (7 - E_r) + rating_bias * 2), 0, 20)
+    rating = cols['subject_response']
+    cols['subject_response_bool'] = np.where(
+        rating > 0, 1., np.where(rating < 0, 0., np.nan))
+
+    df = pd.DataFrame({col: cols[col].ravel() for col in UG_RESPONSE_COLS})
+    df.insert(0, 'role', roles.ravel())
+    df.insert(0, 'block_number', np.tile(np.repeat(np.arange(n_blocks), T), n))
+    df.insert(0, 'excluded', np.repeat(excluded, n_blocks * T))
+    df.insert(0, 'id', np.repeat(np.asarray(ids, dtype=np.int64),
+                                 n_blocks * T))
+    df.insert(0, 'condition', np.repeat(conds.ravel(), T))
+    df['deception'] = np.repeat(deception, n_blocks * T)
+    df['deception_scale'] = np.repeat(deception_scale, n_blocks * T)
+    if study == 4:
+        df = add_invest_rows(df, cols['invest'].ravel())
+        accepted_r = df['subject_response'] > 0
+        df['payout_r'] = np.where(accepted_r, 10 - df['proposerTake'], 0.)
+        df.loc[df['subject_response'].isna(), 'payout_r'] = np.nan
+        df['payout_p'] = np.where(df['response_bool'] == 1,
+                                  df['subjectTake'], 0.)
+        df.loc[df['subjectTake'].isna(), 'payout_p'] = np.nan
+        df['payout'] = df['payout_r'].fillna(df['payout_p'])
+
+    df = add_lag_features(df, UG_RESPONSE_COLS, k=2)
+    return df[UG_COLS[study]]
+
+
+def add_invest_rows(df, invest):
+    '''
+    Moves the investment of each block from its last trial to a row of its
+        own after it, as in the Study 4 data
+    '''
+    has_invest = ~np.isnan(invest)
+    df_invest = df.loc[has_invest, ['condition', 'id', 'excluded',
+                                    'block_number', 'deception',
+                                    'deception_scale']]
+    df_invest['role'] = 'p'
+    df_invest['invest'] = invest[has_invest]
+    df['invest'] = np.nan
+    df = pd.concat([df, df_invest])
+    # the invest row sorts after the trial it was taken from
+    order = np.lexsort((np.r_[np.zeros(len(invest)), np.ones(len(df_invest))],
+                        np.r_[np.arange(len(invest)),
+                              np.flatnonzero(has_invest)]))
+    return df.iloc[order].reset_index(drop=True)
+
+
+def generate_PGG_chunks(n_groups=100, n_periods=10, cities=CITIES,
+                        cooperator_frac=.3, free_rider_frac=.2,
+                        antisocial_frac=.1, missing_frac=0., seed=0,
+                        chunk_size=1000, include_N_experiment=False):
+    '''
+    Yields the public goods game data of chunk_size groups (of four players)
+        at a time, in the raw Herrmann et al. (2008) layout. Players are
+        cooperators, free riders or conditional cooperators (who contribute
+        what the others contributed in the previous period). Players punish
+        those who contributed less than them and, with antisocial_frac,
+        also those who contributed more. With missing_frac, single partner
+        rows are dropped, which leaves the subject-period malformed (see
+        combine_row_triplets(...)). include_N_experiment adds the
+        no-punishment periods, which come first, as in the real data.
+    '''
+    for start in range(0, n_groups, chunk_size):
+        groups = range(start, min(start + chunk_size, n_groups))
+        yield pd.concat([generate_PGG_group(g, n_periods, cities,
+                                            cooperator_frac, free_rider_frac,
+                                            antisocial_frac, missing_frac,
+                                            seed, include_N_experiment)
+                         for g in groups], ignore_index=True)
+
+
+def generate_PGG_group(g, n_periods, cities, cooperator_frac,
+                       free_rider_frac, antisocial_frac, missing_frac, seed,
+                       include_N_experiment):
+    rng = get_unit_rng(seed, g)
+    subjectids = (g + 1) * 10 + np.arange(1, 5)
+    kind = rng.choice(3, size=4, p=[cooperator_frac, free_rider_frac,
+                                    1 - cooperator_frac - free_rider_frac])
+    female = rng.integers(2, size=4)
+    age = np.round(rng.normal(21.5, 3, size=4)).clip(17, 40)
+    treatments = ['N-experiment', 'P-experiment'] if include_N_experiment \
+        else ['P-experiment']
+    others = np.array([[j for j in range(4) if j != i] for i in range(4)])
+
+    rows = []
+    for treatment in treatments:
+        contrib = rng.uniform(5, 15, size=4)
+        for period in range(1, n_periods + 1):
+            if period > 1:  # conditional cooperators match the others
+                contrib = (contrib.sum() - contrib) / 3
+            contrib = np.where(kind == 0, rng.integers(15, 21, size=4),
+                               np.where(kind == 1, rng.integers(0, 4, size=4),
+                                        np.round(contrib +
+                                                 rng.normal(0, 2, 4))))
+            contrib = contrib.clip(0, 20)
+            punishment = np.zeros((4, 3))
+            if treatment == 'P-experiment':
+                gap = contrib[:, None] - contrib[others]  # own - other's
+                p_punish = expit((gap - 5) / 2)
+                antisocial = rng.random((4, 1)) < antisocial_frac
+                p_punish = np.where(antisocial & (gap < 0), .5, p_punish)
+                punish = rng.random((4, 3)) < p_punish
+                punishment = np.where(punish, rng.integers(1, 6, (4, 3)), 0)
+            recpun = np.zeros(4)
+            np.add.at(recpun, others, punishment)
+            for i in range(4):
+                for k, j in enumerate(others[i]):
+                    rows.append((subjectids[i], g + 1,
+                                 cities[g % len(cities)], period, treatment,
+                                 contrib[j], punishment[i, k], contrib[i],
+                                 recpun[i], female[i], age[i]))
+    df = pd.DataFrame(rows, columns=PGG_COLS)
+    for col in ['otherscontribution', 'punishment', 'senderscontribution',
+                'recpun', 'female']:
+        df[col] = df[col].astype(np.int64)
+    if missing_frac:
+        df = df[rng.random(len(df)) >= missing_frac]
+    return df
+
+
+def write_synthetic_data(out_dir, studies=(2, 4, 3), n_participants=100,
+                         n_groups=100, missing_frac=.05, seed=0,
+                         chunk_size=1000, **kwargs):
+    '''
+    Writes the raw data of studies to out_dir, named as the loaders expect.
+        kwargs go to generate_UG_chunks(...).
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    fps = []
+    for study in studies:
+        if study == 3:
+            fp = os.path.join(out_dir, 'Herrmann_Data.csv')
+            chunks = generate_PGG_chunks(n_groups, missing_frac=missing_frac,
+                                         seed=seed, chunk_size=chunk_size)
+        else:
+            fp = os.path.join(out_dir,
+                              f'RoleChange_Study{study}_anonymized.csv')
+            chunks = generate_UG_chunks(n_participants, study=study,
+                                        missing_frac=missing_frac, seed=seed,
+                                        chunk_size=chunk_size, **kwargs)
+        n_rows = write_csv_chunks(chunks, fp)
+        print(f'Wrote {n_rows} rows: {fp}')
+        fps.append(fp)
+    return fps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Writes synthetic raw data (see synthetic_data.py)')
+    parser.add_argument('out_dir')
+    parser.add_argument('--studies', nargs='+', type=int, default=[2, 4, 3])
+    parser.add_argument('--participants', type=int, default=100)
+    parser.add_argument('--blocks', type=int, default=8)
+    parser.add_argument('--trials', type=int, default=16,
+                        help='trials per block')
+    parser.add_argument('--strategies', nargs='+',
+                        default=['generous', 'selfish', 'reciprocity'])
+    parser.add_argument('--groups', type=int, default=100,
+                        help='Herrmann groups (of four players)')
+    parser.add_argument('--missing', type=float, default=.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+    write_synthetic_data(args.out_dir, studies=args.studies,
+                         n_participants=args.participants,
+                         n_groups=args.groups, missing_frac=args.missing,
+                         seed=args.seed, chunk_size=args.chunk_size,
+                         n_blocks=args.blocks, trials_per_block=args.trials,
+                         strategies=tuple(args.strategies))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,16 @@
-from itertools import cycle
+import os
+import time
 import pandas as pd
 from collections import defaultdict
-from Study124.Agent import get_exponentially_weighted_mean
+from Study124.Agent import get_exponentially_weighted_mean, get_grouped_ewm
+from Study124.data_store import iter_csv_chunks, read_csv, write_csv_chunks
+from Study124.profiling import profiled
 import numpy as np
 
 from tqdm import tqdm
 
+DIR = os.path.dirname(os.path.abspath(__file__))
+
 
 def M(l):
     if len(l):
@@ -119,6 +124,7 @@ class RowProcessor:
 
         return r_avg_prev, E_r_person, E_r_sans_trial, E_r_sans_person
 
+    @profiled('RowProcessor.process_row', per_call=False)
     def process_row(self, row):
         E_p = self.update_get_E_p(row)
         r_avg_prev, E_r_person, E_r_sans_trial, E_r_sans_person = \
@@ -151,7 +157,7 @@ class RowProcessor:
 
         return out_l
 
-def combine_row_triplets(df):
+def combine_row_triplets(df, drop_malformed=True):
     '''
     The Herrmann et al. (2008) data is organized such that for each trial of
         each player, there are three rows, corresponding to the three other
@@ -160,44 +166,270 @@ def combine_row_triplets(df):
         redundancy.
     This function combines the three rows into one row with seperate columns
         for each player's contribution and punishment.
+    The rows are matched on (subjectid, period), with the partners numbered
+        in the order their rows appear. Subject-periods that don't have exactly
+        three rows are reported and dropped (or raise a ValueError if
+        drop_malformed is False).
     '''
-    num_cycle = cycle([0, 1, 2])
-    df['partner_relative'] = [next(num_cycle) for _ in range(len(df))]
     df = df[df['p'] == 'P-experiment']
+    keys = ['subjectid', 'period']
+    size = df.groupby(keys, sort=False)['subjectid'].transform('size')
+    malformed = size.to_numpy() != 3
+    if malformed.any():
+        df_bad = df.loc[malformed, keys].value_counts(sort=False)
+        msg = f'{len(df_bad)} (subjectid, period) groups do not have three ' \
+              f'partner rows:\n{df_bad.head(20).to_string()}'
+        if not drop_malformed:
+            raise ValueError(msg)
+        print(msg)
+        df = df[~malformed]
+
+    grouped = df.groupby(keys, sort=False)
+    trial = grouped.ngroup().to_numpy()  # in order of first appearance
+    partner = grouped.cumcount().to_numpy()
+    r = np.empty((trial.max() + 1, 3), dtype=df['otherscontribution'].dtype)
+    punish = np.empty((trial.max() + 1, 3), dtype=df['punishment'].dtype)
+    r[trial, partner] = df['otherscontribution'].to_numpy()
+    punish[trial, partner] = df['punishment'].to_numpy()
 
-    df0 = df[df['partner_relative'] == 0].reset_index()
-    df1 = df[df['partner_relative'] == 1].reset_index()
-    df2 = df[df['partner_relative'] == 2].reset_index()
-    df0.rename(columns={'otherscontribution': 'r_0', 'punishment': 'punish_0',
-                        'senderscontribution': 's_contrib', 'subjectid': 'sn'},
-               inplace=True)
-    df0['r_1'] = df1['otherscontribution']
-    df0['r_2'] = df2['otherscontribution']
-    df0['punish_1'] = df1['punishment']
-    df0['punish_2'] = df2['punishment']
-    df = df0
+    df = df[partner == 0].reset_index()
+    df.rename(columns={'otherscontribution': 'r_0', 'punishment': 'punish_0',
+                       'senderscontribution': 's_contrib', 'subjectid': 'sn'},
+              inplace=True)
+    df['r_1'] = r[:, 1]
+    df['r_2'] = r[:, 2]
+    df['punish_1'] = punish[:, 1]
+    df['punish_2'] = punish[:, 2]
 
     df['r_avg'] = df[['r_0', 'r_1', 'r_2']].mean(axis=1)
     return df
 
-def process_PGG_data(decay=1.0):
-    fp_in = r'PGG_data\Herrmann_Data.csv'
-    df = pd.read_csv(fp_in)
-    df = combine_row_triplets(df)
+def get_PGG_expectations(df, decay=1.0, depth=20):
+    '''
+    Vectorized version of applying RowProcessor.process_row(...) to every row
+        of df (the output of combine_row_triplets(...)). Rather than updating
+        per-subject lists row by row, each expectation is computed for all rows
+        at once from running sums within each subject (sn), and the three
+        targets are stacked into the same long format: three rows per row of
+        df, in the same order and with the same columns.
+    The averages are taken in the same order of operations as RowProcessor,
+        so with decay = 1 the output is identical to it, not just close.
+    '''
+    n = len(df)
+    sn_codes = pd.factorize(df['sn'])[0]
+    order = np.argsort(sn_codes, kind='stable')  # rows of a subject together
+    groups = sn_codes[order]
+    t = np.arange(n) - np.searchsorted(groups, groups)  # trial number within sn
+    first = t == 0
+
+    def ewm(col):
+        return get_grouped_ewm(df[col].to_numpy(dtype=np.float64)[order],
+                               groups, decay, depth)
+
+    def prev(values):
+        # shifts values (in sorted order) by one trial within each subject
+        out = np.empty(n)
+        out[1:] = values[:-1]
+        out[first] = np.nan
+        return out
+
+    def cumulative_mean_before(values):
+        # M(...) of the previous trials, which (like sum()) propagates NaN.
+        #   The trials are laid out as a subjects x trials matrix so that the
+        #   cumulative sums run within subject and in the same order as sum()
+        padded = np.zeros((groups[-1] + 1, t.max() + 1))
+        padded[groups, t] = values
+        return prev(np.cumsum(padded, axis=1)[groups, t] / (t + 1))
+
+    E_p = ewm('s_contrib')
+    r_avg_prev = prev(df['r_avg'].to_numpy(dtype=np.float64)[order])
+    E_r_incl = [ewm(f'r_{i}') for i in range(3)]  # includes the current trial
+    E_r_person = [prev(E) for E in E_r_incl]
+
+    with np.errstate(invalid='ignore'):
+        w_person = decay * t / (t + 1)
+    E_r_sans_trial = []
+    E_r_sans_person = []
+    for i in range(3):
+        vals = [E_r_person[j] if i == j else E_r_incl[j] for j in range(3)]
+        weights = [w_person if i == j else 1.0 for j in range(3)]
+        E_r_sans_trial.append((vals[0] * weights[0] + vals[1] * weights[1] +
+                               vals[2] * weights[2]) /
+                              (weights[0] + weights[1] + weights[2]))
+        others = [vals[j] for j in range(3) if j != i]
+        E_r_sans_person.append((others[0] + others[1]) / 2)
+
+    recpun = df['recpun'].to_numpy(dtype=np.float64)[order]
+    punish = df[['punish_0', 'punish_1', 'punish_2']].to_numpy(dtype=np.float64)[order]
+    punish_avg = (punish[:, 0] + punish[:, 1] + punish[:, 2]) / 3
+    E_punished = cumulative_mean_before(recpun)
+    E_punish = cumulative_mean_before(punish_avg)
+    prev_punished = prev(recpun)
 
-    RP = RowProcessor() # Much like the Agent class for the UG studies (1, 2 & 4)
-                        # the Herrmann data is processed by essentially
-                        # simulating agents that process the data row by row.
+    unsort = np.empty(n, dtype=np.int64)
+    unsort[order] = np.arange(n)
+
+    def per_target(arrays):
+        return np.column_stack(arrays)[unsort].ravel()
+
+    def per_row(values):
+        return np.repeat(values[unsort], 3)
+
+    out = {'E_p': per_row(E_p),
+           'r_avg_prev': per_row(r_avg_prev),
+           'E_r_specific': per_target(E_r_person),
+           'E_r_sans_trial': per_target(E_r_sans_trial),
+           'E_r_sans_person': per_target(E_r_sans_person),
+           'r': df[['r_0', 'r_1', 'r_2']].to_numpy().ravel(),
+           'punish': df[['punish_0', 'punish_1', 'punish_2']].to_numpy().ravel(),
+           'target': np.tile(np.arange(3), n)}
+    for col in RowProcessor().kept_cols:
+        out[col] = np.repeat(df[col].to_numpy(), 3)
+    out['E_punished'] = per_row(E_punished)
+    out['E_punish'] = per_row(E_punish)
+    out['prev_punished'] = per_row(prev_punished)
+    return pd.DataFrame(out)
+
+
+def get_PGG_expectations_by_row(df, decay=1.0, depth=20, RP=None):
+    '''
+    RP can be a RowProcessor that already processed earlier rows (e.g., the
+        previous chunks of process_PGG_data_chunked(...)), whose per-subject
+        histories then carry on into df. The three output rows of each row
+        are collected straight into columns rather than as a list of dicts
+        per row.
+    '''
+    if RP is None:
+        RP = RowProcessor(decay, depth) # Much like the Agent class for the UG studies (1, 2 & 4)
+                                        # the Herrmann data is processed by essentially
+                                        # simulating agents that process the data row by row.
+    out = defaultdict(list)
+
+    def process_row(row):
+        for out_row in RP.process_row(row):
+            for col, value in out_row.items():
+                out[col].append(value)
 
     tqdm.pandas(desc='apply progress...')
-    l_of_l = df.progress_apply(RP.process_row, axis=1)
-    l = [item for sublist in l_of_l for item in sublist]
-    df_out = pd.DataFrame(l)
+    df.progress_apply(process_row, axis=1)
+    return pd.DataFrame(out)
+
+
+def get_combined_rows_from_processed(df_processed=None):
+    '''
+    The raw Herrmann et al. data isn't distributed with this repository, but
+        the per-trial rows that combine_row_triplets(...) produces can be
+        recovered from the processed file (recpun is the next trial's
+        prev_punished, except for the last trial, which no output depends
+        on).
+    '''
+    if df_processed is None:
+        fp = os.path.join(DIR, 'PGG_data', 'Herrmann_Data_Processed.csv')
+        df_processed = pd.read_csv(fp)
+    df = df_processed[df_processed['target'] == 0].reset_index(drop=True)
+    df = df[RowProcessor().kept_cols].copy()
+    for i in range(3):
+        df_i = df_processed[df_processed['target'] == i].reset_index(drop=True)
+        df[f'r_{i}'] = df_i['r']
+        df[f'punish_{i}'] = df_i['punish']
+    df['r_avg'] = df[['r_0', 'r_1', 'r_2']].mean(axis=1)
+    prev_punished = df_processed.loc[df_processed['target'] == 0,
+                                     'prev_punished'].reset_index(drop=True)
+    df['recpun'] = prev_punished.groupby(df['sn']).shift(-1)
+    return df
+
+
+def check_vectorized_PGG():
+    '''
+    Times get_PGG_expectations(...) against the RowProcessor on the rows
+        recovered from the processed file (get_combined_rows_from_processed)
+        and checks that their outputs are identical byte for byte. Both are
+        also compared to the processed file. It was written with older
+        numpy/pandas versions, which round some averages differently in the
+        last digit (e.g., 10 / 3 is written as 3.333333333333333), so that
+        comparison allows for floating point error.
+    '''
+    fp = os.path.join(DIR, 'PGG_data', 'Herrmann_Data_Processed.csv')
+    df_processed = pd.read_csv(fp)
+    df = get_combined_rows_from_processed(df_processed)
+
+    outs = {}
+    for name, func in [('vectorized', get_PGG_expectations),
+                       ('RowProcessor', get_PGG_expectations_by_row)]:
+        t0 = time.perf_counter()
+        outs[name] = func(df)
+        print(f'{name}: {time.perf_counter() - t0:.3f} s')
+        pd.testing.assert_frame_equal(outs[name], df_processed, rtol=1e-12,
+                                      check_dtype=False)
+    same = outs['vectorized'].to_csv(index=False) == \
+        outs['RowProcessor'].to_csv(index=False)
+    print(f'Both match the processed file. Byte-for-byte identical: {same}')
+
+
+def process_PGG_data(decay=1.0, vectorized=True, data_dir=None):
+    '''
+    Reads Herrmann_Data.csv, adds the expectations and saves the result as
+        Herrmann_Data_Processed*.csv, in PGG_data/ or in data_dir (e.g., the
+        synthetic data of Study124/synthetic_data.py). Returns the processed
+        dataframe.
+    '''
+    data_dir = data_dir or os.path.join(DIR, 'PGG_data')
+    fp_in = os.path.join(data_dir, 'Herrmann_Data.csv')
+    df = read_csv(fp_in)
+    df = combine_row_triplets(df)
+
+    if vectorized:
+        df_out = get_PGG_expectations(df, decay=decay)
+    else:
+        df_out = get_PGG_expectations_by_row(df, decay=decay)
 
     decay_str = '' if decay == 1.0 else f'_decay_{decay}'
-    fp_out = fr'PGG_data\Herrmann_Data_Processed{decay_str}.csv'
+    fp_out = os.path.join(data_dir, f'Herrmann_Data_Processed{decay_str}.csv')
 
     df_out.to_csv(fp_out, index=False)
+    return df_out
+
+
+@profiled()
+def process_PGG_data_chunked(decay=1.0, vectorized=True, data_dir=None,
+                             chunk_size=100_000):
+    '''
+    Out-of-core process_PGG_data(...). Herrmann_Data.csv is read in chunks of
+        about chunk_size rows that don't split groups (groupid), and each
+        processed chunk is appended to the output as soon as it is ready, so
+        memory depends on chunk_size rather than on the size of the dataset.
+        With vectorized=False, one RowProcessor runs through all the chunks,
+        carrying every subject's history over, so a subject's rows may even
+        be spread over the file. The vectorized version computes each chunk
+        on its own and so requires each group's rows to be contiguous (a
+        ValueError is raised otherwise, and the output file is left as it
+        was, see write_csv_chunks(...)). Returns the number of rows written.
+    '''
+    data_dir = data_dir or os.path.join(DIR, 'PGG_data')
+    fp_in = os.path.join(data_dir, 'Herrmann_Data.csv')
+    decay_str = '' if decay == 1.0 else f'_decay_{decay}'
+    fp_out = os.path.join(data_dir, f'Herrmann_Data_Processed{decay_str}.csv')
+    RP = None if vectorized else RowProcessor(decay)
+    seen = set()
+
+    def processed():
+        for df in iter_csv_chunks(fp_in, 'groupid', chunksize=chunk_size):
+            df = df[df['p'] == 'P-experiment']
+            if not len(df):
+                continue
+            df = combine_row_triplets(df)
+            if not vectorized:
+                yield get_PGG_expectations_by_row(df, RP=RP)
+                continue
+            subjects = set(pd.unique(df['sn']))
+            if subjects & seen:
+                raise ValueError(f'The rows of subjects {subjects & seen} are '
+                                 f'not contiguous. Sort {fp_in} by groupid '
+                                 f'or use vectorized=False.')
+            seen.update(subjects)
+            yield get_PGG_expectations(df, decay=decay)
+
+    return write_csv_chunks(processed(), fp_out)
 
 if __name__ == '__main__':
     process_PGG_data(decay=1.0)
\ No newline at end of file
@@ -1,8 +1,27 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
 
+from Study124.fit_cache import fit_lmer, get_model_frame
+from Study124.model_backends import get_backend
+from Study124.model_comparison import compare_models
+from Study124.resampling import resample_delta_loglik, run_replicates
+from Study124.data_store import read_csv
+from Study124.profiling import profiled
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The optimx optimizer helps with achieving convergence.
+#   Requires the optimx R package
+E_EXV_CONTROL = "optimizer='optimx', " \
+                "optCtrl = list(method='nlminb'," \
+                "kkt=FALSE)"
+
 
 def rescale(col):
     return (col - col.mean()) / col.std()
@@ -14,9 +33,14 @@ def add_ExV(df, col):
 
 
 def do_lmer_by_city(key_p = 'ExV_p_w_curr_abs', key_r = 'ExV_r_sans_trial_abs',
-                    random_grps='sn', do_rfx=True):
+                    random_grps='sn', do_rfx=True, backend=None,
+                    n_workers=None):
     '''
-    Plots model fit by study for a pair of expectation variables
+    Plots model fit by study for a pair of expectation variables. For every
+        city, the base model and its key_p and key_r extensions are compared
+        at once (see do_city_comparison(...)). The cities are run in parallel
+        with n_workers processes (see fit_city_jobs(...)). n_workers=1 fits
+        them serially.
     '''
     df = load_and_basic_preprocess()
     cities = df['city'].unique()
@@ -24,25 +48,21 @@ def do_lmer_by_city(key_p = 'ExV_p_w_curr_abs', key_r = 'ExV_r_sans_trial_abs',
     fits_r = []
     p_higher = []
 
-    for city in tqdm(cities, desc='looping cities'):
-        df_city = df[df['city'] == city]
-        N = len(df_city.sn.unique())
-        fixed_ef_base = '1 + r + E_punished'
-        rand_ef_base = fixed_ef_base if do_rfx else '1'
-        formula_base = f'punish ~ {fixed_ef_base} + ({rand_ef_base} | {random_grps})'
-        fit_base, coefs_base = do_city_lmer(df_city, formula_base)
-
-        fixed_ef_p = f'1 + r + {key_p} + E_punished'
-        rand_ef_p = fixed_ef_p if do_rfx else '1'
-        formula_p = f'punish ~ {fixed_ef_p} + ({rand_ef_p} | {random_grps})'
-        fit_p, coefs_p = do_city_lmer(df_city, formula_p)
-        fit_p -= fit_base
-
-        fixed_ef_r = f'1 + r + {key_r} + E_punished'
-        rand_ef_r = fixed_ef_r if do_rfx else '1'
-        formula_r = f'punish ~ {fixed_ef_r} + ({rand_ef_r} | {random_grps})'
-        fit_r, coefs_r = do_city_lmer(df_city, formula_r)
-        fit_r -= fit_base
+    fixed_ef_base = '1 + r + E_punished'
+    rand_ef_base = fixed_ef_base if do_rfx else '1'
+    formula_base = f'punish ~ {fixed_ef_base} + ({rand_ef_base} | {random_grps})'
+    candidates = (('p', key_p), ('r', key_r))
+
+    jobs = [(city, formula_base, candidates, do_rfx) for city in cities]
+    results = fit_city_jobs(df, jobs, n_workers=n_workers, backend=backend)
+
+    for city, job in zip(cities, jobs):
+        N = len(df.loc[df['city'] == city, 'sn'].unique())
+        df_comparison, coefs = results[job]
+        fit_p = df_comparison.loc['p', 'd_logLike']
+        coefs_p = coefs['p']
+        fit_r = df_comparison.loc['r', 'd_logLike']
+        coefs_r = coefs['r']
         if coefs_p.loc[key_p]['P-val'] < 0.05 and coefs_r.loc[key_r]['P-val'] < 0.05:
             c = 'purple'
         elif coefs_p.loc[key_p]['P-val'] < 0.05:
@@ -79,18 +99,153 @@ def do_lmer_by_city(key_p = 'ExV_p_w_curr_abs', key_r = 'ExV_r_sans_trial_abs',
     plt.show()
 
 
-def do_city_lmer(df_city, formula):
-    from pymer4.models import Lmer
-    mod = Lmer(formula, data=df_city)
-    mod.fit(REML=False, summary=False)
-    fit = mod.logLike
-    print(mod.coefs)
-    return fit, mod.coefs
+@profiled()
+def do_city_lmer(df_city, formula, backend=None):
+    result = fit_lmer(formula, df_city, REML=False, backend=backend)
+    fit = result['logLike']
+    print(result['coefs'])
+    return fit, result['coefs']
+
+
+@profiled()
+def do_city_comparison(df_city, formula_base, candidates, extend_rfx=False,
+                       backend=None):
+    '''
+    Compares formula_base with its extensions by each of the candidates
+        ({name: term}, see compare_models(...)). Returns the comparison table
+        and the coefs of every model.
+    '''
+    df_comparison, fits = compare_models(df_city, formula_base, candidates,
+                                         REML=False, backend=backend,
+                                         extend_rfx=extend_rfx)
+    print(df_comparison[['logLike', 'd_logLike', 'chi2', 'd_params', 'p']])
+    return df_comparison, {name: fit['coefs'] for name, fit in fits.items()}
+
+
+def run_city_job(df_city, job, backend=None):
+    '''
+    A job is either (city, formula), fit by do_city_lmer(...), or (city,
+        formula_base, candidates, extend_rfx), with candidates as ((name,
+        term), ...) pairs, compared by do_city_comparison(...)
+    '''
+    if len(job) == 2:
+        return do_city_lmer(df_city, job[1], backend)
+    _, formula_base, candidates, extend_rfx = job
+    return do_city_comparison(df_city, formula_base, dict(candidates),
+                              extend_rfx, backend)
+
+
+def get_job_formula(job):
+    '''
+    A string naming every column a job uses (see get_model_frame(...))
+    '''
+    if len(job) == 2:
+        return job[1]
+    return ' '.join([job[1]] + [term for _, term in job[2]])
 
 
-def load_and_basic_preprocess():
-    in_fp = fr'PGG_data\Herrmann_Data_Processed.csv'
-    df = pd.read_csv(in_fp)
+def fit_city_jobs(df, jobs, n_workers=None, backend=None):
+    '''
+    Runs each job (see run_city_job(...)) on its city's rows. Returns a dict
+        {job: result}, e.g., {(city, formula): (fit, coefs)}.
+    For n_workers != 1, the columns used by the formulas are saved once as
+        .npy files in a temporary directory, which each worker memory-maps,
+        so only the jobs are sent to the workers. Columns without a numpy
+        dtype (e.g., text or categoricals) are saved as category codes
+        (see encode_city_column(...)). Each
+        worker rebuilds exactly the df_city slice the serial loop would fit
+        (same rows, order and dtypes), so the results are identical to
+        those of n_workers=1, whatever the number of workers.
+    '''
+    if n_workers == 1:
+        results = {}
+        for job in tqdm(jobs, desc='fitting cities'):
+            df_city = df[df['city'] == job[0]]
+            results[job] = run_city_job(df_city, job, backend)
+        return results
+
+    formula_cols = set()
+    for job in jobs:
+        formula_cols.update(get_model_frame(get_job_formula(job),
+                                            df.head(0)).columns)
+    cols = [col for col in df.columns if col in formula_cols]
+    city_codes, cities = pd.factorize(df['city'])
+    with tempfile.TemporaryDirectory() as mmap_dir:
+        np.save(os.path.join(mmap_dir, 'city.npy'), city_codes)
+        col_dtypes = {}
+        for i, col in enumerate(cols):
+            values, col_dtypes[col] = encode_city_column(df[col])
+            np.save(os.path.join(mmap_dir, f'{i}.npy'), values,
+                    allow_pickle=False)
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=_init_city_worker,
+                                 initargs=(mmap_dir, cols, col_dtypes,
+                                           list(cities), backend)) as pool:
+            fits = list(tqdm(pool.map(_fit_city_job, jobs), total=len(jobs),
+                             desc='fitting cities'))
+    return dict(zip(jobs, fits))
+
+
+def encode_city_column(col):
+    '''
+    Returns the values of col to save as .npy and the dtype info needed to
+        restore col from them: None for numpy dtypes, which are saved as they
+        are, else (categories, dtype), with col saved as category codes
+    '''
+    if isinstance(col.dtype, np.dtype) and col.dtype.kind in 'biufmM':
+        return col.to_numpy(), None
+    try:
+        cat = col.astype('category')
+    except TypeError as e:  # e.g., unhashable objects
+        raise TypeError(f'Column {col.name} ({col.dtype}) cannot be shared '
+                        f'with the workers; use n_workers=1: {e}')
+    return cat.cat.codes.to_numpy(), (cat.cat.categories, col.dtype)
+
+
+def decode_city_column(values, col_dtype):
+    if col_dtype is None:
+        return values
+    categories, dtype = col_dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return pd.Categorical.from_codes(values, dtype=dtype)
+    return pd.Categorical.from_codes(values, categories).astype(dtype)
+
+
+_city_data = {}  # filled in each worker by _init_city_worker(...)
+
+
+def _init_city_worker(mmap_dir, cols, col_dtypes, cities, backend):
+    _city_data['city'] = np.load(os.path.join(mmap_dir, 'city.npy'),
+                                 mmap_mode='r')
+    _city_data['columns'] = {
+        col: np.load(os.path.join(mmap_dir, f'{i}.npy'), mmap_mode='r')
+        for i, col in enumerate(cols)}
+    _city_data['col_dtypes'] = col_dtypes
+    _city_data['city_to_code'] = {city: i for i, city in enumerate(cities)}
+    _city_data['backend'] = backend
+    pd.options.mode.chained_assignment = None
+    if get_backend(backend).name == 'pymer4':
+        import pymer4.models  # imported once per worker, see model_backends.py
+
+
+def _fit_city_job(job):
+    is_city = _city_data['city'] == _city_data['city_to_code'][job[0]]
+    df_city = pd.DataFrame({
+        col: decode_city_column(values[is_city], _city_data['col_dtypes'][col])
+        for col, values in _city_data['columns'].items()})
+    return run_city_job(df_city, job, _city_data['backend'])
+
+
+def load_and_basic_preprocess(df=None):
+    '''
+    df can be processed data other than Herrmann_Data_Processed.csv, e.g.,
+        from process_PGG_data(data_dir=...)
+    '''
+    if df is None:
+        in_fp = os.path.join(DIR, 'PGG_data', 'Herrmann_Data_Processed.csv')
+        df = read_csv(in_fp)
+    else:
+        df = df.copy()
 
     df.dropna(subset=['E_p', 'E_r_sans_trial', 'E_punished'], inplace=True)
 
@@ -112,9 +267,50 @@ def load_and_basic_preprocess():
 def do_E_ExV_lmer(do_ExV=True, do_REML=False, do_rfx=True, do_p=True, do_r=True):
     # Note that do_REML should be False for significance testing of coefficients
     #   but True when looking at model fit (see, Meteyard & Davies, 2020).
-    from pymer4.models import Lmer
     df = load_and_basic_preprocess()
+    formula = get_E_ExV_formula(do_ExV=do_ExV, do_rfx=do_rfx, do_p=do_p,
+                                do_r=do_r)
+
+    print('Lmering...')
+    result = fit_lmer(formula, df, REML=do_REML, control=E_EXV_CONTROL)
+    print(result['coefs'])
+    print(f'Log-likelihood: {result["logLike"]:.2f}')
+
+    #  Log likelihood results (REML = True) (Table 1 in manuscript)
+    #              LL         ΔLL
+    # Base LL	37629.47
+    # E P	    37498.33	 131.14   (do_p = True & do_ExV = False)
+    # E R	    37505.51	 123.96   (do_r = True & do_ExV = False)
+    # ExV P	    36984.37	 645.10   (do_p = True & do_ExV = True)
+    # ExV R	    37373.78	 255.69   (do_r = True & do_ExV = True)
+    # compare_E_ExV_lmer(...) gets all the ΔLL rows in one call
+
+
+def compare_E_ExV_lmer(do_REML=True, do_rfx=True, backend=None):
+    '''
+    The Table 1 comparisons (see do_E_ExV_lmer(...)): the base model against
+        the base model plus E_p, E_r, ExV_p or ExV_r, fit in one
+        compare_models(...) call. Returns the comparison table.
+    '''
+    df = load_and_basic_preprocess()
+    formula_base = get_E_ExV_formula(do_ExV=False, do_rfx=do_rfx, do_p=False,
+                                     do_r=False)
+    candidates = {'E P': 'E_p', 'E R': 'E_r_sans_trial',
+                  'ExV P': 'ExV_p_abs', 'ExV R': 'ExV_r_sans_trial_abs'}
+    print('Lmering...')
+    # get_E_ExV_formula(...) only adds the terms to the random effects if
+    #   not do_rfx
+    df_comparison, _ = compare_models(df, formula_base, candidates,
+                                      REML=do_REML, control=E_EXV_CONTROL,
+                                      backend=backend, extend_rfx=not do_rfx)
+    print(df_comparison[['logLike', 'd_logLike', 'chi2', 'd_params', 'p']])
+    return df_comparison
+
 
+def get_E_ExV_formula(do_ExV=True, do_rfx=True, do_p=True, do_r=True):
+    '''
+    The formula of do_E_ExV_lmer(...)
+    '''
     # The patterns of significance do not change if additional random-levels
     #   are added (e.g., adding a city-level or group-level).
     if do_ExV:
@@ -129,26 +325,134 @@ def do_E_ExV_lmer(do_ExV=True, do_REML=False, do_rfx=True, do_p=True, do_r=True)
     rand_ef = '1' if do_rfx else fixed_ef
     formula = fr'punish ~ {fixed_ef} + ' \
                      fr'( {rand_ef} | sn)'
+    return formula
 
-    print('Lmering...')
-    # The optimx optimizer helps with achieving convergence.
-    #   Requires the optimx R package
-    mod = Lmer(formula, data=df)
-    summary = mod.fit(REML=do_REML, control="optimizer='optimx', "
-                                            "optCtrl = list(method='nlminb',"
-                                            "kkt=FALSE)")
+
+def resample_E_ExV_lmer(key='ExV_p_abs', method='bootstrap', n_reps=1000,
+                        do_rfx=True, do_REML=False, backend=None,
+                        n_workers=None, checkpoint_fp=None):
+    '''
+    Resampling uncertainty for one of the Table 1 ΔLL comparisons (see
+        do_E_ExV_lmer(...)): the base model vs. the base model plus key.
+        method='bootstrap' resamples participants (sn) and gives a CI for
+        ΔLL. method='permutation' shuffles key within participant and gives
+        a p-value. See Study124/resampling.py.
+    '''
+    df = load_and_basic_preprocess()
+    fixed_ef = '1 + r + E_punished'
+    rand_ef = '1' if do_rfx else fixed_ef
+    formula_base = f'punish ~ {fixed_ef} + ( {rand_ef} | sn)'
+    rand_ef = '1' if do_rfx else f'{fixed_ef} + {key}'
+    formula_full = f'punish ~ {fixed_ef} + {key} + ( {rand_ef} | sn)'
+    result = resample_delta_loglik(df, formula_base, formula_full,
+                                   cluster='sn', method=method,
+                                   permute_cols=[key], n_reps=n_reps,
+                                   REML=do_REML, backend=backend,
+                                   n_workers=n_workers,
+                                   checkpoint_fp=checkpoint_fp)
+    summary = f'ΔLL [{key}] = {result["observed"]:.2f}'
+    if method == 'bootstrap':
+        summary += f', 95% CI [{result["ci"][0]:.2f}, {result["ci"][1]:.2f}]'
+    else:
+        summary += f', permutation p = {result["p"]:.4f}'
     print(summary)
+    return result
 
-    #  Log likelihood results (REML = True) (Table 1 in manuscript)
-    #              LL         ΔLL
-    # Base LL	37629.47
-    # E P	    37498.33	 131.14   (do_p = True & do_ExV = False)
-    # E R	    37505.51	 123.96   (do_r = True & do_ExV = False)
-    # ExV P	    36984.37	 645.10   (do_p = True & do_ExV = True)
-    # ExV R	    37373.78	 255.69   (do_r = True & do_ExV = True)
+
+def resample_city_p_higher(key_p='ExV_p_w_curr_abs',
+                           key_r='ExV_r_sans_trial_abs', random_grps='sn',
+                           do_rfx=True, n_reps=1000, seed=0, backend=None,
+                           n_workers=None, batch_size=10, checkpoint_fp=None):
+    '''
+    Bootstrap uncertainty for do_lmer_by_city(...)'s count of the cities where
+        key_p fits better than key_r (p_higher). Participants are resampled
+        within each city, and every replicate reruns the per-city comparisons
+        (see get_city_d_logLiks(...)). Runs on resample_delta_loglik(...)'s
+        engine, so replicates are batched, parallel and checkpointed in the
+        same way (see Study124/resampling.py). Returns a dict with the
+        observed p_higher, the replicate p_higher counts, their 95% percentile
+        CI, the share of replicates in which key_p fits better for every city
+        and the number of replicates with a fit that did not converge.
+    '''
+    backend = get_backend(backend)
+    df = load_and_basic_preprocess()
+    fixed_ef_base = '1 + r + E_punished'
+    rand_ef_base = fixed_ef_base if do_rfx else '1'
+    formula_base = f'punish ~ {fixed_ef_base} + ({rand_ef_base} | {random_grps})'
+    candidates = [['p', key_p], ['r', key_r]]
+    df = get_model_frame(f'{formula_base} {key_p} {key_r} city', df)
+    settings = {'formula_base': formula_base, 'candidates': candidates,
+                'extend_rfx': do_rfx, 'cluster': random_grps,
+                'strata': 'city', 'method': 'bootstrap', 'seed': seed,
+                'backend': backend.name}
+    fit_kwargs = {'family': 'gaussian', 'REML': False, 'control': '',
+                  'backend': backend}
+
+    observed, _ = get_city_d_logLiks(df, formula_base, candidates, do_rfx,
+                                     random_grps, backend)
+    done = run_replicates(df, settings, _fit_city_p_higher_replicate, n_reps,
+                          fit_kwargs, n_workers=n_workers,
+                          batch_size=batch_size, checkpoint_fp=checkpoint_fp,
+                          desc='bootstrap p_higher')
+
+    p_highers = np.array([done[i]['p_higher'] for i in range(n_reps)])
+    p_higher = int(sum(d_p > d_r for d_p, d_r in observed.values()))
+    out = {'observed': p_higher,
+           'observed_by_city': observed,
+           'replicates': p_highers,
+           'ci': tuple(np.percentile(p_highers, [2.5, 97.5])),
+           'p_higher_share': {city: np.mean([done[i]['by_city'][city][0] >
+                                             done[i]['by_city'][city][1]
+                                             for i in range(n_reps)])
+                              for city in observed},
+           'n_not_converged': sum(not done[i]['converged']
+                                  for i in range(n_reps))}
+    print(f'p_higher = {out["observed"]} of {len(observed)} cities, '
+          f'95% CI [{out["ci"][0]:.1f}, {out["ci"][1]:.1f}]')
+    for city, share in out['p_higher_share'].items():
+        print(f'{city}: {key_p} fits better in {share:.1%} of replicates')
+    return out
+
+
+def get_city_d_logLiks(df, formula_base, candidates, extend_rfx,
+                       random_grps='sn', backend=None, use_cache=True):
+    '''
+    For every city, ΔlogLik per participant of the p and r extensions of
+        formula_base ({city: [d_p, d_r]}, NaN if a fit failed), as in
+        do_lmer_by_city(...), and whether every fit converged
+    '''
+    by_city = {}
+    converged = True
+    for city, df_city in df.groupby('city', sort=True):
+        N = df_city[random_grps].nunique()
+        try:
+            df_comparison, _ = compare_models(df_city, formula_base,
+                                              dict(candidates), REML=False,
+                                              backend=backend,
+                                              extend_rfx=extend_rfx,
+                                              use_cache=use_cache)
+        except (ValueError, np.linalg.LinAlgError) as e:
+            print(f'{city}: comparison failed: {e}')
+            by_city[city] = [np.nan, np.nan]
+            converged = False
+            continue
+        by_city[city] = [float(df_comparison.loc['p', 'd_logLike']) / N,
+                         float(df_comparison.loc['r', 'd_logLike']) / N]
+        converged &= bool(df_comparison['converged'].all())
+    return by_city, converged
+
+
+def _fit_city_p_higher_replicate(df_i, job):
+    settings = job['settings']
+    # Replicates are not cached (see resampling._fit_replicate(...))
+    by_city, converged = get_city_d_logLiks(
+        df_i, settings['formula_base'], settings['candidates'],
+        settings['extend_rfx'], settings['cluster'],
+        job['fit_kwargs']['backend'], use_cache=False)
+    return {'p_higher': int(sum(d_p > d_r for d_p, d_r in by_city.values())),
+            'by_city': by_city, 'converged': converged}
 
 def do_trial_mediation():
-    from pymer4.models import Lmer
     df = load_and_basic_preprocess()
 
     print('---------------------')
@@ -156,11 +460,11 @@ def do_trial_mediation():
     print('---------------------')
     formula = r's_contrib ~ 1 + r_avg_prev + prev_punished + ' \
               r'(1 +  r_avg_prev + prev_punished | sn)'
-    mod = Lmer(formula, data=df)
-    summary = mod.fit(REML=False, control = "optimizer='optimx', "
-                                            "optCtrl = list(method='nlminb', "
-                                            "kkt=FALSE)")
-    print(summary)
+    result = fit_lmer(formula, df, REML=False,
+                      control="optimizer='optimx', "
+                              "optCtrl = list(method='nlminb', "
+                              "kkt=FALSE)")
+    print(result['coefs'])
     print()
 
     print('---------------------')
@@ -169,11 +473,11 @@ def do_trial_mediation():
 
     formula = r'punish ~ 1 + r + s_contrib + r_avg_prev + prev_punished + ' \
               r'(1 + r + s_contrib + r_avg_prev + prev_punished | sn)'
-    mod = Lmer(formula, data=df)
-    summary = mod.fit(REML=False, control ="optimizer='optimx', "
-                                           "optCtrl = list(method='bobyqa', "
-                                           "kkt=FALSE)")
-    print(summary)
+    result = fit_lmer(formula, df, REML=False,
+                      control="optimizer='optimx', "
+                              "optCtrl = list(method='bobyqa', "
+                              "kkt=FALSE)")
+    print(result['coefs'])
 
 
 if __name__ == '__main__':